@@ -1,13 +1,24 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from collections import Counter
 import os
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
+import csv
 import json
+import math
+import re
+import hashlib
+import threading
+import time
+import uuid
 from fpdf import FPDF
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -34,12 +45,21 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
     'pool_recycle': 300,
 }
+# Optional per-worker in-memory IMEI index (trades memory for lookup speed)
+app.config['IMEI_MEMORY_INDEX'] = os.getenv('IMEI_MEMORY_INDEX', 'false').lower() == 'true'
+# Seconds a worker trusts its IMEI index before re-reading the shared version; this worker's own
+# sales and purchases show at once, other workers' changes can take this long to appear in lookups
+app.config['IMEI_INDEX_MAX_AGE'] = float(os.getenv('IMEI_INDEX_MAX_AGE', '2'))
+# First month of the fiscal year used by the fiscal report periods (July in Pakistan)
+app.config['FISCAL_YEAR_START_MONTH'] = int(os.getenv('FISCAL_YEAR_START_MONTH', '7'))
 
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+IMEI_MAX_LENGTH = 64  # Longest IMEI that fits the indexed IMEI columns
+
 # Simplified Models for new structure
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -57,7 +77,7 @@ class Brand(db.Model):
 
 class Model(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    brand_id = db.Column(db.Integer, db.ForeignKey('brand.id'), nullable=False)
+    brand_id = db.Column(db.Integer, db.ForeignKey('brand.id'), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     purchases = db.relationship('Purchase', backref='model', lazy=True)
@@ -72,6 +92,10 @@ class Supplier(db.Model):
     purchases = db.relationship('Purchase', backref='supplier', lazy=True)
 
 class Purchase(db.Model):
+    __table_args__ = (
+        db.Index('ix_purchase_user_date', 'user_id', 'date'),  # Recent purchases, transactions
+        db.Index('ix_purchase_user_model_date', 'user_id', 'model_id', 'date'),  # Ledger model filter
+    )
     id = db.Column(db.Integer, primary_key=True)
     model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False)
     inventory_type = db.Column(db.String(10), nullable=False)  # 'new' or 'used'
@@ -101,7 +125,39 @@ class Shop(db.Model):
     sales = db.relationship('Sale', backref='shop', lazy=True)
     payments = db.relationship('Payment', backref='shop', lazy=True)
 
+class Invoice(db.Model):
+    """Bill header: customer and totals of one sale bill, kept in step with its sales and payments"""
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'bill_number', name='uq_invoice_user_bill'),
+        db.Index('ix_invoice_user_date', 'user_id', 'date'),  # Transactions pages
+        db.Index('ix_invoice_user_shop_status', 'user_id', 'shop_id', 'payment_status', 'date'),  # Shop payments, aging
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    bill_number = db.Column(db.String(50), nullable=True)  # NULL for old sales saved without one
+    customer_type = db.Column(db.String(20), nullable=False)  # 'individual' or 'shop'
+    customer_name = db.Column(db.String(100), nullable=True)  # For individual customers
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=True)  # NULL for individual
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0)  # Sum of sale prices
+    paid_amount = db.Column(db.Float, nullable=False, default=0)
+    due_amount = db.Column(db.Float, nullable=False, default=0)
+    payment_status = db.Column(db.String(20), nullable=False, default='paid')  # 'paid', 'pending', 'partial'
+    due_date = db.Column(db.DateTime, nullable=True)
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Last sale or payment
+    shop = db.relationship('Shop')
+    sales = db.relationship('Sale', backref='invoice', lazy=True, order_by='Sale.id')
+
 class Sale(db.Model):
+    __table_args__ = (
+        # imei_number is TEXT, so MySQL needs a prefix length to index it
+        db.Index('ix_sale_user_imei', 'user_id', 'imei_number', mysql_length={'imei_number': IMEI_MAX_LENGTH}),
+        db.Index('ix_sale_user_date', 'user_id', 'date'),  # Recent sales, transactions, ledger
+        db.Index('ix_sale_user_model_date', 'user_id', 'model_id', 'date'),  # Transactions/ledger model filter
+        db.Index('ix_sale_user_shop_date', 'user_id', 'shop_id', 'date'),  # Shop details, shop payments
+        db.Index('ix_sale_user_bill', 'user_id', 'bill_number'),  # Bill lookups
+    )
     id = db.Column(db.Integer, primary_key=True)
     model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False)
     imei_number = db.Column(db.Text, nullable=False)  # Supports any IMEI format/length
@@ -117,11 +173,15 @@ class Sale(db.Model):
     due_amount = db.Column(db.Float, default=0.0)
     due_date = db.Column(db.DateTime, nullable=True)  # Optional due date
     bill_number = db.Column(db.String(50), nullable=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=True, index=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref='sales')
 
 class Payment(db.Model):
+    __table_args__ = (
+        db.Index('ix_payment_user_shop_date', 'user_id', 'shop_id', 'payment_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
@@ -133,6 +193,9 @@ class Payment(db.Model):
     user = db.relationship('User', backref='payments')
 
 class Incentive(db.Model):
+    __table_args__ = (
+        db.Index('ix_incentive_user_period', 'user_id', 'year', 'month'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     brand_id = db.Column(db.Integer, db.ForeignKey('brand.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
@@ -155,10 +218,1130 @@ class SupplierPayment(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', backref='supplier_payments')
 
+class DeviceUnit(db.Model):
+    """One row per purchased IMEI - indexed mirror of Purchase.imei_numbers"""
+    __table_args__ = (
+        db.Index('ix_device_unit_user_imei', 'user_id', 'imei'),
+        db.Index('ix_device_unit_user_imei_reversed', 'user_id', 'imei_reversed'),
+        db.UniqueConstraint('user_id', 'stock_imei', name='uq_device_unit_stock_imei'),
+        db.Index('ix_device_unit_user_status', 'user_id', 'status', 'purchase_id'),  # Inventory pages
+        db.Index('ix_device_unit_user_model', 'user_id', 'model_id', 'status'),  # Inventory model filter
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    imei = db.Column(db.String(IMEI_MAX_LENGTH), nullable=False)
+    imei_reversed = db.Column(db.String(IMEI_MAX_LENGTH), nullable=True)  # For suffix searches
+    # Copy of imei while the unit is in stock, NULL once sold (one in-stock unit per IMEI)
+    stock_imei = db.Column(db.String(IMEI_MAX_LENGTH), nullable=True)
+    position = db.Column(db.Integer, nullable=False, default=0)  # Index in Purchase.imei_numbers
+    purchase_id = db.Column(db.Integer, db.ForeignKey('purchase.id'), nullable=False, index=True)
+    model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='in_stock')  # 'in_stock', 'sold' or 'superseded' (older duplicate found by the backfill)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    purchase = db.relationship('Purchase', backref='device_units')
+    sale = db.relationship('Sale')
+
+class CacheVersion(db.Model):
+    """Version counters shared by all workers to invalidate in-process caches"""
+    key = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class ImeiFilter(db.Model):
+    """Per-user Bloom filter of purchased IMEIs (lets validate_imei skip lookups for new IMEIs)"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    bits = db.Column(db.LargeBinary(length=16 * 1024 * 1024), nullable=False)
+    num_bits = db.Column(db.Integer, nullable=False)
+    num_hashes = db.Column(db.Integer, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)  # Rebuilt larger once item_count passes this
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class StockLevel(db.Model):
+    """Running stock counters per user, model and inventory type, kept in step with purchases and sales"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    model_id = db.Column(db.Integer, db.ForeignKey('model.id'), primary_key=True)
+    inventory_type = db.Column(db.String(10), primary_key=True)  # 'new' or 'used'
+    purchased = db.Column(db.Integer, nullable=False, default=0)
+    sold = db.Column(db.Integer, nullable=False, default=0)
+    available = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ShopBalance(db.Model):
+    """Running receivables per user and shop, kept in step with shop sales and payments"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), primary_key=True)
+    billed = db.Column(db.Float, nullable=False, default=0)  # Sum of sale prices
+    paid = db.Column(db.Float, nullable=False, default=0)
+    outstanding = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # Last sale or payment
+
+class ProfitRollup(db.Model):
+    """Monthly sales and incentive totals per brand, model, inventory and customer type, kept in step with sales"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)  # 1-12
+    brand_id = db.Column(db.Integer, db.ForeignKey('brand.id'), primary_key=True)
+    model_id = db.Column(db.Integer, primary_key=True)  # 0 for brand incentive rows
+    inventory_type = db.Column(db.String(10), primary_key=True)  # '' for brand incentive rows
+    customer_type = db.Column(db.String(20), primary_key=True)  # '' for brand incentive rows
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    incentives = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BillSequence(db.Model):
+    """Last bill number handed out per user, bill prefix and day"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    prefix = db.Column(db.String(20), primary_key=True)  # 'BILL' or 'PURCHASE'
+    day = db.Column(db.Date, primary_key=True)
+    last_number = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CalendarMonth(db.Model):
+    """Calendar dimension: one row per month with its date range and fiscal period"""
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)  # 1-12
+    month_start = db.Column(db.DateTime, nullable=False)
+    next_month_start = db.Column(db.DateTime, nullable=False)
+    fiscal_year = db.Column(db.Integer, nullable=False)  # Calendar year the fiscal year starts in
+    fiscal_quarter = db.Column(db.Integer, nullable=False)  # 1-4
+
+class ScanSession(db.Model):
+    """Server-side buffer of scanned IMEIs, committed later as one purchase or multi-sale"""
+    id = db.Column(db.String(32), primary_key=True)  # Random token handed to the client
+    mode = db.Column(db.String(10), nullable=False)  # 'purchase' or 'sale'
+    status = db.Column(db.String(10), nullable=False, default='open')  # 'open' or 'committed'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    items = db.relationship('ScanSessionItem', backref='scan_session', lazy=True,
+                            order_by='ScanSessionItem.id', cascade='all, delete-orphan')
+
+class ScanSessionItem(db.Model):
+    """One validated IMEI in a scan session"""
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'imei', name='uq_scan_session_item_imei'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), db.ForeignKey('scan_session.id'), nullable=False)
+    imei = db.Column(db.String(IMEI_MAX_LENGTH), nullable=False)
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    """Outcome of a write form POST, stored under the key the form was rendered with so resubmits replay it"""
+    __table_args__ = (
+        db.Index('ix_idempotency_key_user_created', 'user_id', 'created_at'),  # Expiry cleanup
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    key = db.Column(db.String(64), primary_key=True)
+    endpoint = db.Column(db.String(50), nullable=False)  # e.g. 'add_sale'
+    request_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the submitted form values
+    result_url = db.Column(db.String(500), nullable=True)  # Where the original request redirected
+    message = db.Column(db.Text, nullable=True)  # Flash message of the original request
+    resource_ids = db.Column(db.Text, nullable=True)  # JSON list of the row ids written
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
+# IMEI lookup helpers (backed by the indexed device_unit table)
+def find_device_unit(user_id, imei):
+    """Return the latest DeviceUnit for an IMEI, or None"""
+    return DeviceUnit.query.filter_by(
+        user_id=user_id,
+        imei=imei
+    ).order_by(DeviceUnit.id.desc()).first()
+
+IMEI_LOOKUP_CHUNK = 500  # Keeps IN (...) lists under database parameter limits
+
+def latest_sale_dates(user_id, imeis):
+    """Map each IMEI in `imeis` that has a Sale row to its latest sale date.
+
+    One grouped query per IMEI_LOOKUP_CHUNK IMEIs on the (user_id, imei_number)
+    index. IMEIs that were never sold are left out.
+    """
+    imeis = list(imeis)
+    sold = {}
+    for start in range(0, len(imeis), IMEI_LOOKUP_CHUNK):
+        chunk = imeis[start:start + IMEI_LOOKUP_CHUNK]
+        rows = db.session.query(
+            Sale.imei_number, db.func.max(Sale.date)
+        ).filter(
+            Sale.user_id == user_id,
+            Sale.imei_number.in_(chunk)
+        ).group_by(Sale.imei_number).all()
+        sold.update(rows)
+    return sold
+
+def resolve_imeis(user_id, imei_list):
+    """Resolve many IMEIs at once.
+
+    Returns (found, not_found, already_sold) in input order, where found is a
+    list of dicts with imei, unit, purchase, model and brand. Runs two queries
+    per IMEI_LOOKUP_CHUNK IMEIs: the device unit join, then a sale check that
+    also catches units sold without their status being updated.
+    """
+    latest = {}
+    for start in range(0, len(imei_list), IMEI_LOOKUP_CHUNK):
+        chunk = imei_list[start:start + IMEI_LOOKUP_CHUNK]
+        rows = db.session.query(DeviceUnit, Purchase, Model, Brand).join(
+            Purchase, DeviceUnit.purchase_id == Purchase.id
+        ).outerjoin(
+            Model, DeviceUnit.model_id == Model.id
+        ).outerjoin(
+            Brand, Model.brand_id == Brand.id
+        ).filter(
+            DeviceUnit.user_id == user_id,
+            DeviceUnit.imei.in_(chunk)
+        ).order_by(DeviceUnit.id).all()
+        # Ordered by id, so the newest unit for a re-purchased IMEI wins
+        for row in rows:
+            latest[row[0].imei] = row
+
+    sale_dates = latest_sale_dates(
+        user_id, [imei for imei, row in latest.items() if row[0].status != 'sold']
+    )
+
+    found, not_found, already_sold = [], [], []
+    for imei in imei_list:
+        row = latest.get(imei)
+        if row is None:
+            not_found.append(imei)
+        elif row[0].status == 'sold':
+            already_sold.append(imei)
+        elif imei in sale_dates and sale_dates[imei] >= row[1].date:
+            # Sold after this purchase but the unit was never marked
+            already_sold.append(imei)
+        else:
+            unit, purchase, model, brand = row
+            found.append({
+                'imei': imei,
+                'unit': unit,
+                'purchase': purchase,
+                'model': model,
+                'brand': brand
+            })
+    return found, not_found, already_sold
+
+def add_device_units(purchase, imei_list):
+    """Create one in-stock DeviceUnit per IMEI of a purchase (caller commits)"""
+    if purchase.id is None:
+        db.session.flush()
+    units = [
+        DeviceUnit(
+            imei=imei,
+            imei_reversed=imei[::-1],
+            stock_imei=imei,
+            position=position,
+            purchase_id=purchase.id,
+            model_id=purchase.model_id,
+            status='in_stock',
+            user_id=purchase.user_id
+        )
+        for position, imei in enumerate(imei_list)
+    ]
+    db.session.add_all(units)
+    return units
+
+class SaleConflictError(Exception):
+    """Devices in a sale are no longer in stock, usually because another checkout sold them first"""
+    def __init__(self, imeis):
+        self.imeis = list(imeis)
+        super().__init__(f'No longer in stock: {", ".join(self.imeis)} - it may have just been sold '
+                         f'at another checkout. Search again and retry the sale.')
+
+# Sales lock rows in one order - device units, then the bill sequence, then counters and
+# shop balances - so two checkouts wait for each other instead of deadlocking
+SALE_RETRY_MESSAGE = 'Another checkout was saving at the same moment and nothing was saved. Please retry the sale.'
+
+def is_lock_conflict(error):
+    """True if an OperationalError is a deadlock or lock wait timeout, which a retry can get past"""
+    code = error.orig.args[0] if error.orig is not None and error.orig.args else None
+    # MySQL 1205 lock wait timeout, 1213 deadlock; SQLite reports a busy database
+    return code in (1205, 1213) or 'database is locked' in str(error.orig)
+
+def claim_device_unit(user_id, imei):
+    """Move the in-stock unit for an IMEI to sold (caller commits and links the sale); SaleConflictError if it is gone"""
+    unit = DeviceUnit.query.filter_by(user_id=user_id, stock_imei=imei).first()
+    # Compare-and-set: only one transaction can move the unit out of stock. A concurrent
+    # seller blocks on the row lock, then matches no row once the first one commits.
+    if not unit or not claim_device_units([unit.id]):
+        raise SaleConflictError([imei])
+    return unit
+
+def claim_device_units(unit_ids):
+    """Move several in-stock units to sold with compare-and-set UPDATEs (caller commits and links sales).
+
+    Returns False if any unit was already sold, leaving the caller to roll back.
+    """
+    unit_ids = list(unit_ids)
+    claimed = 0
+    for start in range(0, len(unit_ids), IMEI_LOOKUP_CHUNK):
+        claimed += DeviceUnit.query.filter(
+            DeviceUnit.id.in_(unit_ids[start:start + IMEI_LOOKUP_CHUNK]),
+            DeviceUnit.status == 'in_stock'
+        ).update({DeviceUnit.status: 'sold', DeviceUnit.stock_imei: None}, synchronize_session=False)
+    return claimed == len(unit_ids)
+
+def upsert_row(model_class, values, on_conflict):
+    """INSERT values, or apply the on_conflict column changes to the existing row (caller commits).
+
+    One statement on MySQL and SQLite. An UPDATE that misses the row followed by an INSERT
+    deadlocks on MySQL when two transactions create the same key: both take a gap lock on the
+    miss and each INSERT waits for the other's.
+    """
+    table = model_class.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'mysql':
+        stmt = mysql_insert(table).values(**values)
+        db.session.execute(stmt.on_duplicate_key_update(**on_conflict))
+    elif dialect == 'sqlite':
+        stmt = sqlite_insert(table).values(**values)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key], set_=on_conflict
+        ))
+    else:
+        key = {column.name: values[column.name] for column in table.primary_key}
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(table).values(**values))
+        except IntegrityError:
+            db.session.execute(db.update(table).filter_by(**key).values(**on_conflict))
+
+# Shared cache versions
+def get_cache_version(key):
+    """Current shared version for a cache key (0 if never bumped)"""
+    return db.session.query(CacheVersion.version).filter_by(key=key).scalar() or 0
+
+def bump_cache_version(key):
+    """Increment a shared cache version inside the current transaction"""
+    upsert_row(CacheVersion, dict(key=key, version=1), dict(version=CacheVersion.version + 1))
+    return get_cache_version(key)
+
+# Bill numbers look like BILL-20250131-0001 and restart at 1 every day
+BILL_PREFIXES = {'sale': 'BILL', 'purchase': 'PURCHASE'}
+
+def next_bill_number(user_id, kind='sale'):
+    """Allocate today's next bill number inside the current transaction (caller commits)"""
+    prefix = BILL_PREFIXES[kind]
+    today = datetime.now().date()
+    stem = f"{prefix}-{today.strftime('%Y%m%d')}-"
+    key = dict(user_id=user_id, prefix=prefix, day=today)
+    
+    start = 0
+    if db.session.query(BillSequence.last_number).filter_by(**key).scalar() is None:
+        # First bill of the day: continue after numbers already used today, e.g. before the sequence existed
+        model_class = Sale if kind == 'sale' else Purchase
+        used = db.session.query(model_class.bill_number).filter(
+            model_class.user_id == user_id, model_class.bill_number.like(stem + '%')
+        ).all()
+        start = max((int(number[len(stem):]) for number, in used if number[len(stem):].isdigit()), default=0)
+    
+    # The upsert locks the row (a row lock on MySQL, the write lock on SQLite) until commit,
+    # so the number read back below cannot be handed out twice
+    now = datetime.utcnow()
+    upsert_row(
+        BillSequence,
+        dict(**key, last_number=start + 1, updated_at=now),
+        dict(last_number=BillSequence.last_number + 1, updated_at=now)
+    )
+    
+    number = db.session.query(BillSequence.last_number).filter_by(**key).scalar()
+    return f"{stem}{number:04d}"
+
+# Idempotency keys: write forms carry a random key, so a resubmitted form replays the first result
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
+@app.template_global()
+def new_idempotency_key():
+    """Fresh key for the hidden idempotency_key field of a write form"""
+    return uuid.uuid4().hex
+
+def idempotency_request_hash(endpoint):
+    """SHA-256 of the endpoint and submitted form values, to tell a resubmit from a reused key"""
+    fields = sorted((name, value) for name, value in request.form.items(multi=True) if name != 'idempotency_key')
+    return hashlib.sha256(json.dumps([endpoint, fields]).encode()).hexdigest()
+
+def replay_idempotent_result(record, request_hash):
+    """Redirect with the flash message of the request that first used this key"""
+    if record.request_hash != request_hash:
+        flash('This form was already submitted with other values. Reload the page and try again.', 'error')
+        return redirect(request.referrer or url_for('dashboard'))
+    if record.message:
+        flash(record.message, 'success')
+    return redirect(record.result_url or url_for('dashboard'))
+
+def claim_idempotency_key(endpoint):
+    """Claim the form's idempotency key in the current transaction.
+
+    Returns (record, None) when the request should go ahead, with record to pass to
+    save_idempotent_result, or (None, response) when the key was already used.
+    Forms without a key get (None, None).
+    """
+    key = (request.form.get('idempotency_key') or '').strip()[:64]
+    if not key:
+        return None, None
+    
+    request_hash = idempotency_request_hash(endpoint)
+    IdempotencyKey.query.filter(
+        IdempotencyKey.user_id == current_user.id,
+        IdempotencyKey.created_at < datetime.utcnow() - IDEMPOTENCY_KEY_TTL
+    ).delete(synchronize_session=False)
+    record = db.session.get(IdempotencyKey, (current_user.id, key))
+    if record:
+        return None, replay_idempotent_result(record, request_hash)
+    
+    record = IdempotencyKey(user_id=current_user.id, key=key, endpoint=endpoint, request_hash=request_hash)
+    try:
+        with db.session.begin_nested():
+            db.session.add(record)
+    except IntegrityError:
+        # The same form is being submitted concurrently; the insert waited for it to commit
+        db.session.rollback()
+        record = db.session.get(IdempotencyKey, (current_user.id, key))
+        return None, replay_idempotent_result(record, request_hash) if record else redirect(url_for('dashboard'))
+    return record, None
+
+def save_idempotent_result(record, result_url, message, resource_ids=()):
+    """Store the outcome on a claimed key, in the same transaction as the write (caller commits)"""
+    if record is None:
+        return
+    record.result_url = result_url
+    record.message = message
+    record.resource_ids = json.dumps(list(resource_ids))
+
+LOW_STOCK_THRESHOLD = 2
+
+def increment_counters(model_class, key, amounts):
+    """Add amounts to the counter row at key, creating it if needed (caller commits)"""
+    now = datetime.utcnow()
+    changes = {name: getattr(model_class, name) + amount for name, amount in amounts.items()}
+    upsert_row(model_class, dict(**key, **amounts, updated_at=now), dict(changes, updated_at=now))
+
+def adjust_stock(user_id, model_id, inventory_type, purchased=0, sold=0):
+    """Apply a purchase or sale to the stock counters inside the current transaction"""
+    increment_counters(
+        StockLevel,
+        dict(user_id=user_id, model_id=int(model_id), inventory_type=inventory_type),
+        dict(purchased=purchased, sold=sold, available=purchased - sold)
+    )
+
+def adjust_shop_balance(user_id, shop_id, billed=0, paid=0, outstanding=0):
+    """Apply a shop sale or payment to the shop balance (caller commits)"""
+    if not shop_id:
+        return
+    increment_counters(
+        ShopBalance,
+        dict(user_id=user_id, shop_id=int(shop_id)),
+        dict(billed=billed, paid=paid, outstanding=outstanding)
+    )
+
+def invoice_payment_status(paid_amount, due_amount):
+    """'paid', 'partial' or 'pending' for a bill's paid and due totals"""
+    if due_amount < 0.01:
+        return 'paid'
+    return 'partial' if paid_amount > 0 else 'pending'
+
+def create_invoice(user_id, bill_number, sales):
+    """Add the header for a new bill and link its sales to it (caller commits)"""
+    first = sales[0]
+    date = datetime.utcnow()
+    for sale in sales:
+        sale.date = sale.date or date
+    paid_amount = sum(sale.paid_amount for sale in sales)
+    due_amount = sum(sale.due_amount for sale in sales)
+    invoice = Invoice(
+        bill_number=bill_number,
+        customer_type=first.customer_type,
+        customer_name=first.customer_name,
+        shop_id=first.shop_id,
+        item_count=len(sales),
+        total_amount=sum(sale.sale_price for sale in sales),
+        paid_amount=paid_amount,
+        due_amount=due_amount,
+        payment_status=invoice_payment_status(paid_amount, due_amount),
+        due_date=first.due_date,
+        date=first.date,
+        user_id=user_id
+    )
+    db.session.add(invoice)
+    for sale in sales:
+        sale.invoice = invoice
+    return invoice
+
+def adjust_invoice(invoice_id, paid=0, due=0):
+    """Apply a payment on one of a bill's sales to the bill header (caller commits)"""
+    if not invoice_id:
+        return
+    Invoice.query.filter_by(id=invoice_id).update({
+        Invoice.paid_amount: Invoice.paid_amount + paid,
+        Invoice.due_amount: Invoice.due_amount + due,
+        Invoice.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+    # Separate statement: MySQL and SQLite disagree on whether SET sees the new totals
+    Invoice.query.filter_by(id=invoice_id).update({
+        Invoice.payment_status: db.case(
+            (Invoice.due_amount < 0.01, 'paid'),
+            (Invoice.paid_amount > 0, 'partial'),
+            else_='pending'
+        )
+    }, synchronize_session=False)
+
+def shop_credit_error(user_id, shop_id, new_due):
+    """Error message if new_due would take the shop past its credit limit (0 means no limit).
+
+    Locks the shop's balance row until the sale commits, so concurrent sales to one
+    shop are checked one after the other against the latest outstanding amount.
+    """
+    shop = db.session.get(Shop, int(shop_id)) if shop_id else None
+    if not shop or not shop.credit_limit or new_due <= 0:
+        return None
+    adjust_shop_balance(user_id, shop.id)  # Creates the row for a shop's first sale so there is one to lock
+    outstanding = db.session.query(ShopBalance.outstanding).filter_by(
+        user_id=user_id, shop_id=shop.id
+    ).with_for_update().scalar() or 0
+    if outstanding + new_due > shop.credit_limit:
+        return (f'{shop.name} would owe PKR {outstanding + new_due:,.2f}, '
+                f'over its credit limit of PKR {shop.credit_limit:,.2f}')
+    return None
+
+# Profit rollup rows for brand incentives use this model id, inventory type and customer type
+INCENTIVE_ROLLUP_MODEL_ID = 0
+INCENTIVE_ROLLUP_INVENTORY_TYPE = ''
+INCENTIVE_ROLLUP_CUSTOMER_TYPE = ''
+
+def add_sale_to_rollup(sale):
+    """Add a flushed sale to the monthly profit rollup (caller commits)"""
+    sale_date = sale.date or datetime.utcnow()
+    model = sale.model or db.session.get(Model, int(sale.model_id))
+    increment_counters(
+        ProfitRollup,
+        dict(user_id=sale.user_id, year=sale_date.year, month=sale_date.month, brand_id=model.brand_id,
+             model_id=model.id, inventory_type=sale.inventory_type, customer_type=sale.customer_type or ''),
+        dict(revenue=sale.sale_price, cost=sale.purchase_price, profit=sale.profit, units=1)
+    )
+
+def add_incentive_to_rollup(incentive):
+    """Add a brand incentive to the monthly profit rollup (caller commits)"""
+    increment_counters(
+        ProfitRollup,
+        dict(user_id=incentive.user_id, year=incentive.year, month=incentive.month, brand_id=int(incentive.brand_id),
+             model_id=INCENTIVE_ROLLUP_MODEL_ID, inventory_type=INCENTIVE_ROLLUP_INVENTORY_TYPE,
+             customer_type=INCENTIVE_ROLLUP_CUSTOMER_TYPE),
+        dict(incentives=incentive.amount)
+    )
+
+# Report periods resolve to half-open [start, end) datetime ranges, so filters compare the
+# raw date column against constants and can use the (user_id, date) indexes
+REPORT_PERIODS = {
+    'this_month': 'This Month',
+    'last_month': 'Last Month',
+    'last_12_months': 'Last 12 Months',
+    'this_year': 'This Year',
+    'fiscal_year': 'This Fiscal Year',
+    'last_fiscal_year': 'Last Fiscal Year',
+    'all': 'All Time',
+    'custom': 'Custom Range'
+}
+
+def add_months(value, months):
+    """First day of the month that is `months` after value's month"""
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def fiscal_year_of(year, month):
+    """Calendar year in which the fiscal year containing this month starts"""
+    return year if month >= app.config['FISCAL_YEAR_START_MONTH'] else year - 1
+
+def fiscal_quarter_of(month):
+    """Fiscal quarter (1-4) of a calendar month"""
+    return (month - app.config['FISCAL_YEAR_START_MONTH']) % 12 // 3 + 1
+
+def report_period(name='this_month', start=None, end=None, now=None):
+    """Resolve a named period, or a custom YYYY-MM-DD range with an inclusive end day, to start/end datetimes"""
+    now = now or datetime.now()
+    this_month = datetime(now.year, now.month, 1)
+    fiscal_start = datetime(fiscal_year_of(now.year, now.month), app.config['FISCAL_YEAR_START_MONTH'], 1)
+    
+    if name == 'this_month':
+        bounds = (this_month, add_months(this_month, 1))
+    elif name == 'last_month':
+        bounds = (add_months(this_month, -1), this_month)
+    elif name == 'last_12_months':
+        bounds = (add_months(this_month, -11), add_months(this_month, 1))
+    elif name == 'this_year':
+        bounds = (datetime(now.year, 1, 1), datetime(now.year + 1, 1, 1))
+    elif name == 'fiscal_year':
+        bounds = (fiscal_start, add_months(fiscal_start, 12))
+    elif name == 'last_fiscal_year':
+        bounds = (add_months(fiscal_start, -12), fiscal_start)
+    elif name == 'all':
+        bounds = (None, None)
+    elif name == 'custom':
+        try:
+            bounds = (datetime.strptime(start, '%Y-%m-%d') if start else None,
+                      datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None)
+        except ValueError:
+            raise ValueError('Custom dates must be in YYYY-MM-DD format')
+        if bounds[0] and bounds[1] and bounds[0] >= bounds[1]:
+            raise ValueError('The start date must not be after the end date')
+    else:
+        raise ValueError(f'Unknown report period: {name}')
+    
+    label = REPORT_PERIODS[name]
+    if name in ('fiscal_year', 'last_fiscal_year') and app.config['FISCAL_YEAR_START_MONTH'] != 1:
+        label = f"FY {bounds[0].year}-{str(bounds[0].year + 1)[-2:]}"
+    elif name == 'custom':
+        label = f"{start or '...'} to {end or '...'}"
+    return {'name': name, 'label': label, 'start': bounds[0], 'end': bounds[1]}
+
+def period_from_request(default='this_month'):
+    """report_period() from the period, start and end query arguments"""
+    return report_period(request.args.get('period') or default,
+                         request.args.get('start'), request.args.get('end'))
+
+def period_filter(column, period):
+    """start <= column < end on a raw date column"""
+    conditions = []
+    if period['start']:
+        conditions.append(column >= period['start'])
+    if period['end']:
+        conditions.append(column < period['end'])
+    return db.and_(db.true(), *conditions)
+
+def month_period_filter(year_column, month_column, period):
+    """Every (year, month) the period touches; the plain year range lets the index narrow the scan"""
+    conditions = []
+    if period['start']:
+        year, month = period['start'].year, period['start'].month
+        conditions += [year_column >= year,
+                       db.or_(year_column > year, month_column >= month)]
+    if period['end']:
+        last = period['end'] - timedelta(microseconds=1)
+        conditions += [year_column <= last.year,
+                       db.or_(year_column < last.year, month_column <= last.month)]
+    return db.and_(db.true(), *conditions)
+
+def is_whole_months(period):
+    """True when both ends fall on a month boundary, so the monthly rollup covers the period exactly"""
+    return all(bound is None or (bound.day == 1 and bound.time() == datetime.min.time())
+               for bound in (period['start'], period['end']))
+
+def period_profit(user_id, period):
+    """Sales profit, revenue, units and incentives in a period"""
+    # Incentives are recorded per month, so a partial month counts its whole incentive
+    rollup = db.session.query(
+        db.func.coalesce(db.func.sum(ProfitRollup.profit), 0),
+        db.func.coalesce(db.func.sum(ProfitRollup.revenue), 0),
+        db.func.coalesce(db.func.sum(ProfitRollup.units), 0),
+        db.func.coalesce(db.func.sum(ProfitRollup.incentives), 0)
+    ).filter(
+        ProfitRollup.user_id == user_id,
+        month_period_filter(ProfitRollup.year, ProfitRollup.month, period)
+    ).one()
+    sales_profit, revenue, units, incentives = rollup
+    
+    if not is_whole_months(period):
+        sales_profit, revenue, units = db.session.query(
+            db.func.coalesce(db.func.sum(Sale.profit), 0),
+            db.func.coalesce(db.func.sum(Sale.sale_price), 0),
+            db.func.count(Sale.id)
+        ).filter(Sale.user_id == user_id, period_filter(Sale.date, period)).one()
+    
+    return {'sales_profit': sales_profit, 'revenue': revenue, 'units': units, 'incentives': incentives}
+
+def profit_summary(user_id, period=None):
+    """Total and per-period (current month by default) sales profit and incentives"""
+    total_sales_profit, total_incentives = db.session.query(
+        db.func.coalesce(db.func.sum(ProfitRollup.profit), 0),
+        db.func.coalesce(db.func.sum(ProfitRollup.incentives), 0)
+    ).filter(ProfitRollup.user_id == user_id).one()
+    profits = period_profit(user_id, period or report_period('this_month'))
+    return {
+        'total_sales_profit': total_sales_profit,
+        'monthly_sales_profit': profits['sales_profit'],
+        'total_incentives': total_incentives,
+        'monthly_incentives': profits['incentives']
+    }
+
+def fill_calendar_months(first_year, last_year):
+    """Insert the missing calendar rows for these years; returns how many were added"""
+    existing = {
+        (row.year, row.month) for row in CalendarMonth.query.filter(
+            CalendarMonth.year >= first_year, CalendarMonth.year <= last_year
+        )
+    }
+    added = 0
+    for year in range(first_year, last_year + 1):
+        for month in range(1, 13):
+            if (year, month) in existing:
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.add(CalendarMonth(
+                        year=year, month=month,
+                        month_start=datetime(year, month, 1), next_month_start=add_months(datetime(year, month, 1), 1),
+                        fiscal_year=fiscal_year_of(year, month), fiscal_quarter=fiscal_quarter_of(month)
+                    ))
+                added += 1
+            except IntegrityError:
+                # A concurrent request added this month first
+                continue
+    if added:
+        db.session.commit()
+    return added
+
+# Profit cube: slices of the rollup by any combination of these dimensions
+PROFIT_CUBE_DIMENSIONS = ('brand', 'model', 'year', 'month', 'fiscal_year', 'fiscal_quarter',
+                          'inventory_type', 'customer_type')
+PROFIT_CUBE_FILTERS = ('brand_id', 'model_id', 'year', 'month', 'inventory_type', 'customer_type')
+
+def profit_cube(user_id, dimensions, filters=None, order_by_profit=False, limit=None, period=None):
+    """Sum the profit rollup grouped by the given dimensions over the months a period touches; returns a list of dicts"""
+    filters = {name: value for name, value in (filters or {}).items() if value not in (None, '')}
+    unknown = [name for name in dimensions if name not in PROFIT_CUBE_DIMENSIONS]
+    unknown += [name for name in filters if name not in PROFIT_CUBE_FILTERS]
+    if unknown:
+        raise ValueError(f'Unknown profit dimensions: {", ".join(unknown)}')
+    
+    columns = []
+    group_by = []
+    joins = []
+    for name in dimensions:
+        if name == 'brand':
+            columns += [ProfitRollup.brand_id, Brand.name.label('brand')]
+            group_by += [ProfitRollup.brand_id, Brand.name]
+            joins.append((Brand, Brand.id == ProfitRollup.brand_id))
+        elif name == 'model':
+            columns += [ProfitRollup.model_id, Model.name.label('model')]
+            group_by += [ProfitRollup.model_id, Model.name]
+            joins.append((Model, Model.id == ProfitRollup.model_id))
+        elif name in ('fiscal_year', 'fiscal_quarter'):
+            # Fiscal periods come from the calendar table instead of per-row date arithmetic
+            column = getattr(CalendarMonth, name)
+            columns.append(column)
+            group_by.append(column)
+            if CalendarMonth not in [target for target, _ in joins]:
+                joins.append((CalendarMonth, db.and_(CalendarMonth.year == ProfitRollup.year,
+                                                     CalendarMonth.month == ProfitRollup.month)))
+        else:
+            column = getattr(ProfitRollup, name)
+            columns.append(column)
+            group_by.append(column)
+    
+    if CalendarMonth in [target for target, _ in joins]:
+        first_year, last_year = db.session.query(
+            db.func.min(ProfitRollup.year), db.func.max(ProfitRollup.year)
+        ).filter(ProfitRollup.user_id == user_id).one()
+        if first_year is not None:
+            fill_calendar_months(first_year, last_year)
+    
+    query = db.session.query(
+        *columns,
+        db.func.sum(ProfitRollup.revenue).label('revenue'),
+        db.func.sum(ProfitRollup.cost).label('cost'),
+        db.func.sum(ProfitRollup.profit).label('profit'),
+        db.func.sum(ProfitRollup.units).label('units'),
+        db.func.sum(ProfitRollup.incentives).label('incentives')
+    ).filter(ProfitRollup.user_id == user_id)
+    for target, condition in joins:
+        query = query.join(target, condition)
+    for name, value in filters.items():
+        query = query.filter(getattr(ProfitRollup, name) == value)
+    if period:
+        query = query.filter(month_period_filter(ProfitRollup.year, ProfitRollup.month, period))
+    
+    # Incentives belong to a brand and month only, so leave them out of finer slices
+    sale_only = {'model', 'inventory_type', 'customer_type'}
+    if sale_only & (set(dimensions) | {name.replace('_id', '') for name in filters}):
+        query = query.filter(ProfitRollup.model_id != INCENTIVE_ROLLUP_MODEL_ID)
+    
+    if group_by:
+        query = query.group_by(*group_by)
+    if order_by_profit:
+        query = query.order_by(db.func.sum(ProfitRollup.profit).desc())
+    else:
+        query = query.order_by(*group_by)
+    if limit:
+        query = query.limit(limit)
+    return [dict(row._mapping) for row in query.all()]
+
+def available_stock(user_id, model_id, inventory_type):
+    """Current available count from the stock counters (primary key read)"""
+    return db.session.query(StockLevel.available).filter_by(
+        user_id=user_id, model_id=int(model_id), inventory_type=inventory_type
+    ).scalar() or 0
+
+def low_stock_message(user_id, stock_keys):
+    """Note about models that are running low after a sale, or an empty string"""
+    low = []
+    for model_id, inventory_type in dict.fromkeys(stock_keys):
+        available = available_stock(user_id, model_id, inventory_type)
+        if available <= LOW_STOCK_THRESHOLD:
+            model = db.session.get(Model, int(model_id))
+            low.append(f'{model.name if model else model_id} ({inventory_type}): {available} left')
+    return f' Low stock - {", ".join(low)}' if low else ''
+
+# In-process IMEI index: {user_id: {'version': int, 'checked_at': float, 'entries': {imei: (purchase_id, position, sold)}}}
+_imei_indexes = {}
+_imei_index_lock = threading.Lock()
+
+def imei_index_key(user_id):
+    return f'imei_index:{user_id}'
+
+def load_imei_index(user_id):
+    """Return the user's IMEI index, rebuilding it when another worker changed stock.
+
+    The shared version is read at most once per IMEI_INDEX_MAX_AGE seconds, so most
+    lookups need no database round trip; lookups are for display only, sales claim
+    their units with a compare-and-set in the database.
+    """
+    index = _imei_indexes.get(user_id)
+    now = time.monotonic()
+    if index is not None and now - index['checked_at'] < app.config['IMEI_INDEX_MAX_AGE']:
+        return index['entries']
+    version = get_cache_version(imei_index_key(user_id))
+    if index is not None and index['version'] == version:
+        index['checked_at'] = now
+    else:
+        entries = {}
+        rows = db.session.query(
+            DeviceUnit.imei, DeviceUnit.purchase_id, DeviceUnit.position, DeviceUnit.status
+        ).filter(
+            DeviceUnit.user_id == user_id
+        ).order_by(DeviceUnit.id).yield_per(5000)
+        # Ordered by id, so the newest unit for a re-purchased IMEI wins
+        for imei, purchase_id, position, status in rows:
+            entries[imei] = (purchase_id, position, status == 'sold')
+        index = {'version': version, 'checked_at': now, 'entries': entries}
+        with _imei_index_lock:
+            _imei_indexes[user_id] = index
+    return index['entries']
+
+def update_imei_index(user_id, version, changes):
+    """Write-through after commit: apply changes if this copy was current, else drop it"""
+    with _imei_index_lock:
+        index = _imei_indexes.get(user_id)
+        if index is None:
+            return
+        if index['version'] == version - 1:
+            index['entries'].update(changes)
+            index['version'] = version
+        else:
+            del _imei_indexes[user_id]
+
+def lookup_imei(user_id, imei):
+    """Return (purchase_id, position, sold) for an IMEI, or None if never purchased"""
+    if app.config['IMEI_MEMORY_INDEX']:
+        return load_imei_index(user_id).get(imei)
+    unit = find_device_unit(user_id, imei)
+    if unit is None:
+        return None
+    return (unit.purchase_id, unit.position, unit.status == 'sold')
+
+# Similar IMEI suggestions
+SIMILAR_IMEI_NEIGHBOURS = 25  # Rows read on each side of the search key, per index
+SIMILAR_IMEI_MAX_DISTANCE = 2  # Typos further away than this are not suggested
+SIMILAR_IMEI_MIN_SHARED = 5  # Leading or trailing digits a suggestion must share with the search
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        previous = current
+    return previous[-1]
+
+def similar_imeis(user_id, imei, limit=5):
+    """Return up to `limit` purchased IMEIs closest to `imei`.
+
+    Reads the sorted neighbours of `imei` from the (user_id, imei) index and of
+    its reverse from the (user_id, imei_reversed) index, so candidates share the
+    longest possible prefix or suffix. Candidates starting with `imei` rank first
+    (autocomplete), then by edit distance. Other candidates are only kept within
+    SIMILAR_IMEI_MAX_DISTANCE edits that share SIMILAR_IMEI_MIN_SHARED leading or
+    trailing digits, so unrelated IMEIs are never suggested.
+    """
+    reversed_imei = imei[::-1]
+    base = DeviceUnit.query.with_entities(DeviceUnit.imei, DeviceUnit.status).filter(
+        DeviceUnit.user_id == user_id
+    )
+    queries = [
+        base.filter(DeviceUnit.imei >= imei).order_by(DeviceUnit.imei),
+        base.filter(DeviceUnit.imei < imei).order_by(DeviceUnit.imei.desc()),
+        base.filter(DeviceUnit.imei_reversed >= reversed_imei).order_by(DeviceUnit.imei_reversed),
+        base.filter(DeviceUnit.imei_reversed < reversed_imei).order_by(DeviceUnit.imei_reversed.desc()),
+    ]
+
+    candidates = {}
+    for query in queries:
+        for candidate, status in query.limit(SIMILAR_IMEI_NEIGHBOURS).all():
+            candidates[candidate] = status
+
+    shared = min(SIMILAR_IMEI_MIN_SHARED, len(imei))
+    similar = []
+    for candidate, status in candidates.items():
+        distance = edit_distance(imei, candidate)
+        if candidate.startswith(imei) or (
+            distance <= SIMILAR_IMEI_MAX_DISTANCE
+            and (candidate[:shared] == imei[:shared] or candidate[-shared:] == imei[-shared:])
+        ):
+            similar.append((not candidate.startswith(imei), distance, candidate, status))
+
+    similar.sort(key=lambda item: item[:3])
+    return [{
+        'imei': candidate,
+        'status': status,
+        'distance': distance
+    } for _, distance, candidate, status in similar[:limit]]
+
+# Bloom filter fast path for IMEI validation
+IMEI_FILTER_ERROR_RATE = 0.01
+IMEI_FILTER_MIN_CAPACITY = 10000
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings (double hashing on a blake2b digest)"""
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=IMEI_FILTER_ERROR_RATE):
+        num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+# {user_id: (version, BloomFilter)}
+_imei_filters = {}
+
+def imei_filter_key(user_id):
+    return f'imei_filter:{user_id}'
+
+def build_imei_filter(user_id, capacity=0):
+    """Build a user's filter from their device units; returns (filter, capacity, item_count)"""
+    item_count = DeviceUnit.query.filter_by(user_id=user_id).count()
+    capacity = max(IMEI_FILTER_MIN_CAPACITY, capacity, item_count * 2)
+    bloom = BloomFilter.for_capacity(capacity)
+    for (imei,) in db.session.query(DeviceUnit.imei).filter_by(user_id=user_id).yield_per(5000):
+        bloom.add(imei)
+    return bloom, capacity, item_count
+
+def save_new_imei_filter(user_id, bloom, capacity, item_count):
+    """Insert a freshly built filter; returns False if another worker saved one first"""
+    try:
+        with db.session.begin_nested():
+            db.session.add(ImeiFilter(
+                user_id=user_id,
+                bits=bytes(bloom.bits),
+                num_bits=bloom.num_bits,
+                num_hashes=bloom.num_hashes,
+                capacity=capacity,
+                item_count=item_count
+            ))
+        return True
+    except IntegrityError:
+        return False
+
+def load_imei_filter(user_id):
+    """Return the user's Bloom filter, building and saving it on first use"""
+    version = get_cache_version(imei_filter_key(user_id))
+    cached = _imei_filters.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    row = db.session.get(ImeiFilter, user_id)
+    if row is not None:
+        bloom = BloomFilter(row.num_bits, row.num_hashes, row.bits)
+    else:
+        bloom, capacity, item_count = build_imei_filter(user_id)
+        if not save_new_imei_filter(user_id, bloom, capacity, item_count):
+            # Another worker saved one first - use ours for this request only
+            return bloom
+        version = bump_cache_version(imei_filter_key(user_id))
+        db.session.commit()
+
+    _imei_filters[user_id] = (version, bloom)
+    return bloom
+
+def drop_imei_filter(user_id):
+    """Delete a user's saved filter so the next lookup rebuilds it from device units (caller commits)"""
+    ImeiFilter.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    bump_cache_version(imei_filter_key(user_id))
+
+def add_to_imei_filter(user_id, imeis):
+    """Add newly purchased IMEIs to the saved filter, in its own transaction after the purchase commits.
+
+    Only this short transaction holds the filter row lock, so purchases don't queue behind
+    each other. If the update fails the filter is dropped and rebuilt on next use, because
+    a filter missing an IMEI would call it new.
+    """
+    try:
+        _add_to_imei_filter(user_id, imeis)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('Could not update the IMEI filter of user %s', user_id)
+        drop_imei_filter(user_id)
+        db.session.commit()
+
+def _add_to_imei_filter(user_id, imeis):
+    row = ImeiFilter.query.filter_by(user_id=user_id).with_for_update().first()
+    if row is None:
+        # Built from device units, so it already includes the committed purchase
+        bloom, capacity, item_count = build_imei_filter(user_id)
+        if save_new_imei_filter(user_id, bloom, capacity, item_count):
+            bump_cache_version(imei_filter_key(user_id))
+            return
+        row = ImeiFilter.query.filter_by(user_id=user_id).with_for_update().first()
+
+    if row.item_count + len(imeis) > row.capacity:
+        # Too full for the target error rate - rebuild at double the size
+        bloom, capacity, item_count = build_imei_filter(user_id, capacity=row.capacity * 2)
+        row.num_bits = bloom.num_bits
+        row.num_hashes = bloom.num_hashes
+        row.capacity = capacity
+        row.item_count = item_count
+    else:
+        bloom = BloomFilter(row.num_bits, row.num_hashes, row.bits)
+        for imei in imeis:
+            bloom.add(imei)
+        row.item_count += len(imeis)
+    row.bits = bytes(bloom.bits)
+    bump_cache_version(imei_filter_key(user_id))
+
+# Dashboard summary cache: {user_id: {'version': int, 'expires': datetime, 'data': dict}}
+DASHBOARD_CACHE_TTL = timedelta(minutes=10)  # Safety net in case a write path misses an invalidation
+DASHBOARD_RECENT_ROWS = 5
+_dashboard_cache = {}
+_dashboard_cache_lock = threading.Lock()
+
+def dashboard_cache_key(user_id):
+    return f'dashboard:{user_id}'
+
+def model_summary_row(model):
+    """Model and brand names as plain data, safe to keep between requests"""
+    if model is None:
+        return None
+    return {'name': model.name, 'brand': {'name': model.brand.name if model.brand else ''}}
+
+def sale_summary_row(sale):
+    return {
+        'date': sale.date,
+        'sale_price': sale.sale_price,
+        'profit': sale.profit,
+        'payment_status': sale.payment_status,
+        'model': model_summary_row(sale.model)
+    }
+
+def purchase_summary_row(purchase):
+    return {
+        'date': purchase.date,
+        'quantity': purchase.quantity,
+        'purchase_price': purchase.purchase_price,
+        'paid_amount': purchase.paid_amount,
+        'payment_status': purchase.payment_status,
+        'model': model_summary_row(purchase.model)
+    }
+
+def compute_dashboard_summary(user_id):
+    """Run the dashboard aggregates for one user"""
+    now = datetime.now()
+    
+    profits = profit_summary(user_id)
+    
+    # Get recent transactions (filtered by user)
+    recent_sales = Sale.query.filter_by(user_id=user_id).order_by(Sale.date.desc()).limit(DASHBOARD_RECENT_ROWS).all()
+    recent_purchases = Purchase.query.filter_by(user_id=user_id).order_by(Purchase.date.desc()).limit(DASHBOARD_RECENT_ROWS).all()
+    
+    # Get inventory stats (filtered by user)
+    total_devices_purchased, total_devices_sold = db.session.query(
+        db.func.coalesce(db.func.sum(StockLevel.purchased), 0),
+        db.func.coalesce(db.func.sum(StockLevel.sold), 0)
+    ).filter(StockLevel.user_id == user_id).one()
+    
+    return {
+        'period': (now.year, now.month),
+        **profits,
+        'recent_sales': [sale_summary_row(sale) for sale in recent_sales],
+        'recent_purchases': [purchase_summary_row(purchase) for purchase in recent_purchases],
+        'total_devices_purchased': total_devices_purchased,
+        'total_devices_sold': total_devices_sold
+    }
+
+def dashboard_summary(user_id):
+    """Cached dashboard figures; costs one version read when this worker's copy is current"""
+    version = get_cache_version(dashboard_cache_key(user_id))
+    now = datetime.now()
+    with _dashboard_cache_lock:
+        entry = _dashboard_cache.get(user_id)
+    if (entry and entry['version'] == version and entry['expires'] > now
+            and entry['data']['period'] == (now.year, now.month)):
+        return entry['data']
+    
+    data = compute_dashboard_summary(user_id)
+    with _dashboard_cache_lock:
+        _dashboard_cache[user_id] = {'version': version, 'expires': now + DASHBOARD_CACHE_TTL, 'data': data}
+    return data
+
+def update_dashboard_cache(user_id, version, sales=(), purchases=(), incentives=()):
+    """Write-through after commit: apply summary rows if this copy was current, else drop it"""
+    # Writes that only change payment figures pass no rows, which drops the copy
+    now = datetime.now()
+    with _dashboard_cache_lock:
+        entry = _dashboard_cache.get(user_id)
+        if entry is None:
+            return
+        data = entry['data']
+        period = data['period']
+        if (entry['version'] != version - 1 or entry['expires'] <= now or period != (now.year, now.month)
+                or not (sales or purchases or incentives)):
+            del _dashboard_cache[user_id]
+            return
+        
+        # Copy before changing so requests rendering the old figures are not affected
+        data = dict(data)
+        for sale in sales:
+            data['total_sales_profit'] += sale['profit']
+            if (sale['date'].year, sale['date'].month) == period:
+                data['monthly_sales_profit'] += sale['profit']
+        data['total_devices_sold'] += len(sales)
+        for purchase in purchases:
+            data['total_devices_purchased'] += purchase['quantity']
+        for incentive in incentives:
+            data['total_incentives'] += incentive['amount']
+            if (incentive['year'], incentive['month']) == period:
+                data['monthly_incentives'] += incentive['amount']
+        if sales:
+            data['recent_sales'] = (list(reversed(sales)) + data['recent_sales'])[:DASHBOARD_RECENT_ROWS]
+        if purchases:
+            data['recent_purchases'] = (list(reversed(purchases)) + data['recent_purchases'])[:DASHBOARD_RECENT_ROWS]
+        _dashboard_cache[user_id] = {'version': version, 'expires': entry['expires'], 'data': data}
+
 # Routes
 @app.route('/')
 def index():
@@ -172,45 +1355,20 @@ def index():
 def dashboard():
     """Main dashboard with profit tracking"""
     try:
-        # Calculate total profit including incentives
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-        
-        # Get all sales profit (filtered by user)
-        total_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-            Sale.user_id == current_user.id
-        ).scalar() or 0
-        
-        # Get monthly sales profit (filtered by user)
-        monthly_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-            Sale.user_id == current_user.id,
-            db.extract('month', Sale.date) == current_month,
-            db.extract('year', Sale.date) == current_year
-        ).scalar() or 0
-        
-        # Get incentives (filtered by user)
-        total_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-            Incentive.user_id == current_user.id
-        ).scalar() or 0
-        monthly_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-            Incentive.user_id == current_user.id,
-            Incentive.month == current_month,
-            Incentive.year == current_year
-        ).scalar() or 0
+        summary = dashboard_summary(current_user.id)
+        total_sales_profit = summary['total_sales_profit']
+        monthly_sales_profit = summary['monthly_sales_profit']
+        total_incentives = summary['total_incentives']
+        monthly_incentives = summary['monthly_incentives']
         
         # Calculate total profits
         total_profit_with_incentives = total_sales_profit + total_incentives
         monthly_profit_with_incentives = monthly_sales_profit + monthly_incentives
         
-        # Get recent transactions (filtered by user)
-        recent_sales = Sale.query.filter_by(user_id=current_user.id).order_by(Sale.date.desc()).limit(5).all()
-        recent_purchases = Purchase.query.filter_by(user_id=current_user.id).order_by(Purchase.date.desc()).limit(5).all()
-        
-        # Get inventory stats (filtered by user)
-        total_devices_purchased = db.session.query(db.func.sum(Purchase.quantity)).filter(
-            Purchase.user_id == current_user.id
-        ).scalar() or 0
-        total_devices_sold = Sale.query.filter_by(user_id=current_user.id).count() or 0
+        recent_sales = summary['recent_sales']
+        recent_purchases = summary['recent_purchases']
+        total_devices_purchased = summary['total_devices_purchased']
+        total_devices_sold = summary['total_devices_sold']
         available_devices = total_devices_purchased - total_devices_sold
         
         return render_template('dashboard.html',
@@ -252,30 +1410,41 @@ def brands():
     """Brand management and selection"""
     brands = Brand.query.all()
     
+    # Stock counters per (model, inventory type) for this user, in one query
+    stock_rows = db.session.query(
+        Model.id, Model.name, Model.brand_id, StockLevel.inventory_type,
+        StockLevel.purchased, StockLevel.sold, StockLevel.available
+    ).join(
+        Brand, Brand.id == Model.brand_id
+    ).outerjoin(
+        StockLevel, db.and_(StockLevel.model_id == Model.id, StockLevel.user_id == current_user.id)
+    ).order_by(Model.id).all()
+    
     # Prepare models data with stock information (filtered by user)
-    models_data = {}
-    for brand in brands:
-        models_data[brand.id] = []
-        for model in brand.models:
-            # Calculate stock for this model (filtered by user)
-            total_stock = db.session.query(db.func.sum(Purchase.quantity)).filter(
-                Purchase.model_id == model.id,
-                Purchase.user_id == current_user.id
-            ).scalar() or 0
-            
-            sold_stock = Sale.query.filter_by(
-                model_id=model.id,
-                user_id=current_user.id
-            ).count()
-            available_stock = total_stock - sold_stock
-            
-            models_data[brand.id].append({
-                'id': model.id,
-                'name': model.name,
-                'total_stock': total_stock,
-                'available_stock': available_stock,
-                'sold_stock': sold_stock
-            })
+    models_data = {brand.id: [] for brand in brands}
+    models_by_id = {}
+    for model_id, model_name, brand_id, inventory_type, bought, sold, available in stock_rows:
+        model_data = models_by_id.get(model_id)
+        if model_data is None:
+            model_data = models_by_id[model_id] = {
+                'id': model_id,
+                'name': model_name,
+                'total_stock': 0,
+                'available_stock': 0,
+                'sold_stock': 0,
+                'by_type': {}
+            }
+            models_data.setdefault(brand_id, []).append(model_data)
+        if inventory_type is None:
+            continue  # Model without any purchases or sales
+        model_data['total_stock'] += bought
+        model_data['sold_stock'] += sold
+        model_data['available_stock'] += available
+        model_data['by_type'][inventory_type] = {
+            'total_stock': bought,
+            'sold_stock': sold,
+            'available_stock': available
+        }
     
     return render_template('brands.html', brands=brands, models_data=models_data)
 
@@ -323,6 +1492,9 @@ def new_purchase(model_id):
 @login_required
 def add_purchase():
     """Add new purchase with payment tracking"""
+    idempotency, replay = claim_idempotency_key('add_purchase')
+    if replay:
+        return replay
     model_id = request.form.get('model_id')
     inventory_type = request.form.get('inventory_type')
     quantity = int(request.form.get('quantity'))
@@ -330,13 +1502,23 @@ def add_purchase():
     imei_numbers = request.form.get('imei_numbers')  # Textarea with IMEIs
     supplier_id = request.form.get('supplier_id')
     bill_number = request.form.get('bill_number')
+    scan_session_id = request.form.get('scan_session_id')
     
     # Payment tracking fields
     paid_amount = float(request.form.get('paid_amount') or 0)
     due_date_str = request.form.get('due_date')
     
-    # Process IMEI numbers (split by newlines and clean)
-    imei_list = [imei.strip() for imei in imei_numbers.split('\n') if imei.strip()]
+    scan_session = None
+    if scan_session_id:
+        # Scan mode: the IMEIs come from the server-side scan buffer
+        scan_session = get_open_scan_session(current_user.id, scan_session_id, 'purchase')
+        if not scan_session:
+            flash('Scan session not found or already used', 'error')
+            return redirect(url_for('new_purchase', model_id=model_id))
+        imei_list = scan_session_imeis(scan_session)
+    else:
+        # Process IMEI numbers (split by newlines and clean)
+        imei_list = [imei.strip() for imei in imei_numbers.split('\n') if imei.strip()]
     
     if len(imei_list) != quantity:
         flash(f'Number of IMEIs ({len(imei_list)}) must match quantity ({quantity})', 'error')
@@ -346,7 +1528,25 @@ def add_purchase():
     if not imei_list:
         flash('Please provide at least one IMEI number', 'error')
         return redirect(url_for('new_purchase', model_id=model_id))
-    
+
+    too_long = [imei for imei in imei_list if len(imei) > IMEI_MAX_LENGTH]
+    if too_long:
+        flash(f'IMEIs longer than {IMEI_MAX_LENGTH} characters: {", ".join(too_long)}', 'error')
+        return redirect(url_for('new_purchase', model_id=model_id))
+
+    if len(set(imei_list)) != len(imei_list):
+        flash('The same IMEI is entered more than once', 'error')
+        return redirect(url_for('new_purchase', model_id=model_id))
+
+    # Reject IMEIs that are already in stock (unsold)
+    in_stock = [unit.imei for unit in DeviceUnit.query.filter(
+        DeviceUnit.user_id == current_user.id,
+        DeviceUnit.stock_imei.in_(imei_list)
+    ).all()]
+    if in_stock:
+        flash(f'IMEIs already in inventory and not sold: {", ".join(in_stock)}', 'error')
+        return redirect(url_for('new_purchase', model_id=model_id))
+
     # Calculate total purchase amount and due amount
     total_amount = purchase_price * quantity
     due_amount = total_amount - paid_amount
@@ -370,7 +1570,7 @@ def add_purchase():
     
     # Generate bill number if not provided
     if not bill_number:
-        bill_number = f"PURCHASE-{datetime.now().strftime('%Y%m%d')}-{Purchase.query.count() + 1:04d}"
+        bill_number = next_bill_number(current_user.id, 'purchase')
     
     # Save purchase with payment tracking
     purchase = Purchase(
@@ -388,9 +1588,12 @@ def add_purchase():
         user_id=current_user.id
     )
     db.session.add(purchase)
-    db.session.commit()
-    
-    # Create supplier payment record if any amount was paid
+    add_device_units(purchase, imei_list)
+    adjust_stock(current_user.id, model_id, inventory_type, purchased=quantity)
+    if scan_session:
+        scan_session.status = 'committed'
+
+    # Create supplier payment record if any amount was paid, in the same transaction
     if paid_amount > 0 and supplier_id:
         supplier_payment = SupplierPayment(
             supplier_id=supplier_id,
@@ -400,11 +1603,237 @@ def add_purchase():
             user_id=current_user.id
         )
         db.session.add(supplier_payment)
-        db.session.commit()
     
-    flash(f'Purchase added successfully! Quantity: {quantity}, Bill: {bill_number}, Payment: {payment_status}', 'success')
+    index_version = bump_cache_version(imei_index_key(current_user.id))
+    dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+    purchase_row = purchase_summary_row(purchase)
+    message = f'Purchase added successfully! Quantity: {quantity}, Bill: {bill_number}, Payment: {payment_status}'
+    save_idempotent_result(idempotency, url_for('dashboard'), message, [purchase.id])
+    db.session.commit()
+    add_to_imei_filter(current_user.id, imei_list)
+    update_imei_index(current_user.id, index_version, {
+        imei: (purchase.id, position, False) for position, imei in enumerate(imei_list)
+    })
+    update_dashboard_cache(current_user.id, dashboard_version, purchases=[purchase_row])
+    
+    flash(message, 'success')
     return redirect(url_for('dashboard'))
 
+# Bulk purchase import
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 1000  # Errors listed in the report; any beyond this are only counted
+
+def cell_text(value):
+    """Spreadsheet cell as stripped text (whole-number floats lose their '.0')"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def read_import_rows(upload):
+    """Yield (row_number, {column: text}) from an uploaded .xlsx or .csv, one row at a time"""
+    if upload.filename.lower().endswith('.xlsx'):
+        workbook = load_workbook(upload.stream, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+    else:
+        workbook = None
+        rows = csv.reader(TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+
+    try:
+        header = None
+        for row_number, row in enumerate(rows, 1):
+            values = [cell_text(value) for value in row]
+            if not any(values):
+                continue
+            if header is None:
+                header = [value.lower().replace(' ', '_') for value in values]
+                continue
+            yield row_number, dict(zip(header, values))
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+def import_purchase_rows(user_id, rows, defaults):
+    """Validate and save imported rows in batches of IMPORT_BATCH_SIZE.
+
+    Each batch is checked against the inventory with one query, grouped into one
+    Purchase per (model, type, price, bill) and committed on its own. Returns a
+    dict with imported/purchase counts and the per-row error report.
+    """
+    models_by_name = {
+        (brand_name.lower(), model_name.lower()): model_id
+        for model_id, model_name, brand_name in db.session.query(Model.id, Model.name, Brand.name).join(Brand)
+    }
+    model_ids = set(models_by_name.values())
+    result = {'imported': 0, 'purchases': 0, 'errors': [], 'error_count': 0}
+
+    def add_error(row_number, imei, message):
+        result['error_count'] += 1
+        if len(result['errors']) < IMPORT_MAX_ERRORS:
+            result['errors'].append({'row': row_number, 'imei': imei, 'message': message})
+
+    def parse_row(row_number, row):
+        imei = row.get('imei', '')
+        if not imei:
+            return add_error(row_number, imei, 'Missing IMEI')
+        if len(imei) > IMEI_MAX_LENGTH:
+            return add_error(row_number, imei, f'IMEI longer than {IMEI_MAX_LENGTH} characters')
+
+        if row.get('model_id'):
+            model_id = int(row['model_id']) if row['model_id'].isdigit() else None
+        else:
+            model_id = models_by_name.get((row.get('brand', '').lower(), row.get('model', '').lower()))
+        if model_id not in model_ids:
+            return add_error(row_number, imei, 'Unknown model (use model_id or brand + model columns)')
+
+        try:
+            purchase_price = float(row.get('purchase_price') or defaults['purchase_price'])
+        except (TypeError, ValueError):
+            return add_error(row_number, imei, 'Missing or invalid purchase price')
+        if purchase_price < 0:
+            return add_error(row_number, imei, 'Purchase price cannot be negative')
+
+        inventory_type = (row.get('inventory_type') or defaults['inventory_type']).lower()
+        if inventory_type not in ('new', 'used'):
+            return add_error(row_number, imei, "Inventory type must be 'new' or 'used'")
+
+        return {
+            'row': row_number,
+            'imei': imei,
+            'model_id': model_id,
+            'purchase_price': purchase_price,
+            'inventory_type': inventory_type,
+            'bill_number': row.get('bill_number') or defaults['bill_number']
+        }
+
+    def save_batch(batch):
+        # Drop repeats within the batch and IMEIs already in stock (earlier batches included)
+        unique = {}
+        for item in batch:
+            if item['imei'] in unique:
+                add_error(item['row'], item['imei'], 'IMEI repeated in file')
+            else:
+                unique[item['imei']] = item
+        in_stock = {imei for (imei,) in db.session.query(DeviceUnit.stock_imei).filter(
+            DeviceUnit.user_id == user_id,
+            DeviceUnit.stock_imei.in_(list(unique))
+        )}
+        groups = {}
+        for imei, item in unique.items():
+            if imei in in_stock:
+                add_error(item['row'], imei, 'IMEI already in inventory and not sold')
+                continue
+            key = (item['model_id'], item['inventory_type'], item['purchase_price'], item['bill_number'])
+            groups.setdefault(key, []).append(imei)
+        if not groups:
+            return
+
+        paid = defaults['payment_status'] == 'paid'
+        purchases = []
+        for (model_id, inventory_type, purchase_price, bill_number), imeis in groups.items():
+            total_amount = purchase_price * len(imeis)
+            purchase = Purchase(
+                model_id=model_id,
+                inventory_type=inventory_type,
+                quantity=len(imeis),
+                purchase_price=purchase_price,
+                imei_numbers=json.dumps(imeis),
+                supplier_id=defaults['supplier_id'],
+                bill_number=bill_number,
+                payment_status='paid' if paid else 'pending',
+                paid_amount=total_amount if paid else 0,
+                due_amount=0 if paid else total_amount,
+                user_id=user_id
+            )
+            purchases.append((purchase, imeis))
+            db.session.add(purchase)
+            if paid and defaults['supplier_id']:
+                db.session.add(SupplierPayment(
+                    supplier_id=defaults['supplier_id'],
+                    amount=total_amount,
+                    payment_method='cash',
+                    notes=f'Payment for purchase bill: {bill_number}',
+                    user_id=user_id
+                ))
+        db.session.flush()
+
+        unit_rows = [{
+            'imei': imei,
+            'imei_reversed': imei[::-1],
+            'stock_imei': imei,
+            'position': position,
+            'purchase_id': purchase.id,
+            'model_id': purchase.model_id,
+            'status': 'in_stock',
+            'user_id': user_id
+        } for purchase, imeis in purchases for position, imei in enumerate(imeis)]
+        db.session.execute(db.insert(DeviceUnit), unit_rows)
+        for purchase, imeis in purchases:
+            adjust_stock(user_id, purchase.model_id, purchase.inventory_type, purchased=len(imeis))
+        index_version = bump_cache_version(imei_index_key(user_id))
+        dashboard_version = bump_cache_version(dashboard_cache_key(user_id))
+        purchase_rows = [purchase_summary_row(purchase) for purchase, imeis in purchases]
+        db.session.commit()
+        add_to_imei_filter(user_id, [row['imei'] for row in unit_rows])
+        update_imei_index(user_id, index_version, {
+            row['imei']: (row['purchase_id'], row['position'], False) for row in unit_rows
+        })
+        update_dashboard_cache(user_id, dashboard_version, purchases=purchase_rows)
+
+        result['imported'] += len(unit_rows)
+        result['purchases'] += len(purchases)
+
+    batch = []
+    for row_number, row in rows:
+        item = parse_row(row_number, row)
+        if item:
+            batch.append(item)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            save_batch(batch)
+            batch = []
+    if batch:
+        save_batch(batch)
+    return result
+
+@app.route('/import_purchases', methods=['GET', 'POST'])
+@login_required
+def import_purchases():
+    """Bulk purchase import from an Excel (.xlsx) or CSV file"""
+    suppliers = Supplier.query.all()
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a file to import', 'error')
+            return redirect(url_for('import_purchases'))
+        if not upload.filename.lower().endswith(('.xlsx', '.csv')):
+            flash('Please upload an .xlsx or .csv file', 'error')
+            return redirect(url_for('import_purchases'))
+
+        supplier_id = request.form.get('supplier_id')
+        defaults = {
+            'inventory_type': request.form.get('inventory_type') or 'new',
+            'purchase_price': request.form.get('purchase_price'),
+            'supplier_id': int(supplier_id) if supplier_id else None,
+            'payment_status': request.form.get('payment_status') or 'pending',
+            'bill_number': request.form.get('bill_number') or next_bill_number(current_user.id, 'purchase')
+        }
+
+        try:
+            result = import_purchase_rows(current_user.id, read_import_rows(upload), defaults)
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error importing file: {str(e)}. Batches saved before the error are kept.', 'error')
+            return redirect(url_for('import_purchases'))
+
+        category = 'success' if result['imported'] and not result['error_count'] else 'error'
+        flash(f"Imported {result['imported']} devices in {result['purchases']} purchases. "
+              f"{result['error_count']} rows skipped.", category)
+        return render_template('import_purchases.html', suppliers=suppliers, result=result)
+
+    return render_template('import_purchases.html', suppliers=suppliers, result=None)
+
 @app.route('/add_supplier_payment/<int:purchase_id>', methods=['GET', 'POST'])
 @login_required
 def add_supplier_payment(purchase_id):
@@ -417,6 +1846,9 @@ def add_supplier_payment(purchase_id):
         return redirect(url_for('dashboard'))
     
     if request.method == 'POST':
+        idempotency, replay = claim_idempotency_key('add_supplier_payment')
+        if replay:
+            return replay
         amount = float(request.form.get('amount'))
         payment_method = request.form.get('payment_method')
         reference_number = request.form.get('reference_number')
@@ -447,14 +1879,145 @@ def add_supplier_payment(purchase_id):
         else:
             purchase.payment_status = 'partial'
         
+        dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+        message = f'Payment of PKR {amount:,.2f} added successfully!'
+        db.session.flush()
+        save_idempotent_result(idempotency, url_for('dashboard'), message, [supplier_payment.id])
         db.session.commit()
+        update_dashboard_cache(current_user.id, dashboard_version)
         
-        flash(f'Payment of PKR {amount:,.2f} added successfully!', 'success')
+        flash(message, 'success')
         return redirect(url_for('dashboard'))
     
     # GET request - show payment form
     return render_template('add_supplier_payment.html', purchase=purchase)
 
+# Scan sessions: the client sends scanned IMEIs in micro-batches, the server buffers them
+SCAN_SESSION_MAX_AGE = timedelta(hours=12)
+
+def get_open_scan_session(user_id, session_id, mode=None):
+    """Return the user's open scan session, or None"""
+    query = ScanSession.query.filter_by(id=session_id, user_id=user_id, status='open')
+    if mode:
+        query = query.filter_by(mode=mode)
+    return query.first()
+
+def scan_session_imeis(scan_session):
+    """Buffered IMEIs of a session in scan order"""
+    return [item.imei for item in scan_session.items]
+
+def scan_imei_batch(scan_session, imeis):
+    """Validate one micro-batch with a fixed number of queries and buffer the valid IMEIs"""
+    results = {}
+    buffered = {imei for (imei,) in db.session.query(ScanSessionItem.imei).filter(
+        ScanSessionItem.session_id == scan_session.id,
+        ScanSessionItem.imei.in_(imeis)
+    )}
+    fresh = []
+    for imei in imeis:
+        if imei in buffered:
+            results[imei] = (False, 'Already scanned in this session')
+        elif len(imei) > IMEI_MAX_LENGTH:
+            results[imei] = (False, f'IMEI longer than {IMEI_MAX_LENGTH} characters')
+        else:
+            fresh.append(imei)
+
+    if scan_session.mode == 'purchase':
+        in_stock = {imei for (imei,) in db.session.query(DeviceUnit.stock_imei).filter(
+            DeviceUnit.user_id == scan_session.user_id,
+            DeviceUnit.stock_imei.in_(fresh)
+        )} if fresh else set()
+        for imei in fresh:
+            if imei in in_stock:
+                results[imei] = (False, 'Already in inventory and not sold')
+            else:
+                results[imei] = (True, 'Ready to purchase')
+    else:
+        found, not_found, already_sold = resolve_imeis(scan_session.user_id, fresh) if fresh else ([], [], [])
+        for device in found:
+            name = f"{device['brand'].name if device['brand'] else ''} {device['model'].name if device['model'] else ''}"
+            results[device['imei']] = (True, name.strip() or 'Available')
+        for imei in not_found:
+            results[imei] = (False, 'Not found in inventory')
+        for imei in already_sold:
+            results[imei] = (False, 'Already sold')
+
+    valid = [imei for imei in imeis if results[imei][0]]
+    if valid:
+        db.session.execute(db.insert(ScanSessionItem), [
+            {'session_id': scan_session.id, 'imei': imei, 'scanned_at': datetime.utcnow()} for imei in valid
+        ])
+    db.session.commit()
+    return [{'imei': imei, 'valid': results[imei][0], 'message': results[imei][1]} for imei in imeis]
+
+@app.route('/scan_session', methods=['POST'])
+@login_required
+def start_scan_session():
+    """Open a scan session for a purchase or a multi-device sale"""
+    data = request.get_json(silent=True) or request.form
+    mode = data.get('mode')
+    if mode not in ('purchase', 'sale'):
+        return jsonify({'error': "mode must be 'purchase' or 'sale'"}), 400
+
+    # Drop this user's abandoned sessions
+    stale = ScanSession.query.filter(
+        ScanSession.user_id == current_user.id,
+        ScanSession.created_at < datetime.utcnow() - SCAN_SESSION_MAX_AGE
+    ).all()
+    for old_session in stale:
+        db.session.delete(old_session)
+
+    scan_session = ScanSession(id=uuid.uuid4().hex, mode=mode, user_id=current_user.id)
+    db.session.add(scan_session)
+    db.session.commit()
+    return jsonify({'session_id': scan_session.id, 'mode': mode})
+
+@app.route('/scan_session/<session_id>', methods=['GET'])
+@login_required
+def get_scan_session(session_id):
+    """Buffered IMEIs of an open scan session (for restoring the page)"""
+    scan_session = get_open_scan_session(current_user.id, session_id)
+    if not scan_session:
+        return jsonify({'error': 'Scan session not found or already used'}), 404
+    return jsonify({'session_id': scan_session.id, 'mode': scan_session.mode,
+                    'imeis': scan_session_imeis(scan_session)})
+
+@app.route('/scan_session/<session_id>/scan', methods=['POST'])
+@login_required
+def scan_session_scan(session_id):
+    """Validate and buffer a micro-batch of scanned IMEIs"""
+    scan_session = get_open_scan_session(current_user.id, session_id)
+    if not scan_session:
+        return jsonify({'error': 'Scan session not found or already used'}), 404
+
+    data = request.get_json(silent=True) or {}
+    imeis = list(dict.fromkeys(str(code).strip() for code in data.get('imeis', []) if str(code).strip()))
+    if not imeis:
+        return jsonify({'results': [], 'count': len(scan_session.items)})
+
+    try:
+        results = scan_imei_batch(scan_session, imeis)
+    except IntegrityError:
+        # The same IMEI arrived in two overlapping batches - let the client resend
+        db.session.rollback()
+        return jsonify({'error': 'Conflicting scan, please resend'}), 409
+
+    count = ScanSessionItem.query.filter_by(session_id=session_id).count()
+    return jsonify({'results': results, 'count': count})
+
+@app.route('/scan_session/<session_id>/remove', methods=['POST'])
+@login_required
+def scan_session_remove(session_id):
+    """Remove a mis-scanned IMEI from the buffer"""
+    scan_session = get_open_scan_session(current_user.id, session_id)
+    if not scan_session:
+        return jsonify({'error': 'Scan session not found or already used'}), 404
+
+    data = request.get_json(silent=True) or request.form
+    ScanSessionItem.query.filter_by(session_id=session_id, imei=data.get('imei')).delete()
+    db.session.commit()
+    return jsonify({'count': ScanSessionItem.query.filter_by(session_id=session_id).count()})
+
 @app.route('/sale')
 @login_required
 def sale_module():
@@ -474,25 +2037,18 @@ def search_imei():
     # Allow any IMEI format - no validation constraints
     
     # Find the purchase containing this IMEI
-    purchases = Purchase.query.all()
-    found_purchase = None
-    
-    for purchase in purchases:
-        imei_list = json.loads(purchase.imei_numbers)
-        if imei in imei_list:
-            # Check if already sold
-            existing_sale = Sale.query.filter_by(imei_number=imei).first()
-            if existing_sale:
-                flash('This IMEI has already been sold!', 'error')
-                return redirect(url_for('sale_module'))
-            
-            found_purchase = purchase
-            break
-    
-    if not found_purchase:
+    entry = lookup_imei(current_user.id, imei)
+
+    if not entry:
         flash('IMEI not found in inventory!', 'error')
         return redirect(url_for('sale_module'))
-    
+
+    purchase_id, position, sold = entry
+    if sold:
+        flash('This IMEI has already been sold!', 'error')
+        return redirect(url_for('sale_module'))
+
+    found_purchase = db.session.get(Purchase, purchase_id)
     shops = Shop.query.all()
     return render_template('sale_form.html', purchase=found_purchase, imei=imei, shops=shops)
 
@@ -501,52 +2057,31 @@ def search_imei():
 def search_multiple_imei():
     """Search for multiple devices by IMEI"""
     imei_numbers = request.form.get('imei_numbers')
+    scan_session_id = request.form.get('scan_session_id')
     
-    if not imei_numbers:
+    if scan_session_id:
+        # Scan mode: the IMEIs were already buffered and validated on the server
+        scan_session = get_open_scan_session(current_user.id, scan_session_id, 'sale')
+        if not scan_session:
+            flash('Scan session not found or already used', 'error')
+            return redirect(url_for('sale_module'))
+        imei_list = scan_session_imeis(scan_session)
+    elif not imei_numbers:
         flash('Please enter IMEI numbers', 'error')
         return redirect(url_for('sale_module'))
-    
-    # Process IMEI numbers (split by newlines and clean)
-    imei_list = [imei.strip() for imei in imei_numbers.split('\n') if imei.strip()]
+    else:
+        # Process IMEI numbers (split by newlines and clean)
+        imei_list = [imei.strip() for imei in imei_numbers.split('\n') if imei.strip()]
     
     if not imei_list:
         flash('Please enter valid IMEI numbers', 'error')
         return redirect(url_for('sale_module'))
     
-    # Find devices for each IMEI
-    found_devices = []
-    not_found_imeis = []
-    already_sold_imeis = []
-    
-    for imei in imei_list:
-        # Find the purchase containing this IMEI
-        purchases = Purchase.query.filter_by(user_id=current_user.id).all()
-        found_purchase = None
-        
-        for purchase in purchases:
-            try:
-                purchase_imei_list = json.loads(purchase.imei_numbers)
-                if imei in purchase_imei_list:
-                    # Check if already sold
-                    existing_sale = Sale.query.filter_by(imei_number=imei, user_id=current_user.id).first()
-                    if existing_sale:
-                        already_sold_imeis.append(imei)
-                        break
-                    
-                    found_purchase = purchase
-                    break
-            except (json.JSONDecodeError, TypeError):
-                continue
-        
-        if found_purchase and imei not in already_sold_imeis:
-            found_devices.append({
-                'imei': imei,
-                'purchase': found_purchase,
-                'model': found_purchase.model,
-                'brand': found_purchase.model.brand if found_purchase.model else None
-            })
-        elif imei not in already_sold_imeis:
-            not_found_imeis.append(imei)
+    # Drop repeated scans of the same IMEI, keeping input order
+    imei_list = list(dict.fromkeys(imei_list))
+
+    # Resolve all IMEIs in bulk
+    found_devices, not_found_imeis, already_sold_imeis = resolve_imeis(current_user.id, imei_list)
     
     # Check for errors
     error_messages = []
@@ -565,13 +2100,70 @@ def search_multiple_imei():
         return redirect(url_for('sale_module'))
     
     shops = Shop.query.all()
-    return render_template('multiple_sale_form.html', devices=found_devices, shops=shops)
+    return render_template('multiple_sale_form.html', devices=found_devices, shops=shops,
+                           scan_session_id=scan_session_id)
+
+SALE_DEVICE_FIELD = re.compile(r'devices\[(\d+)\]\[(\w+)\]')
+
+def parse_sale_devices(form):
+    """Device dicts from the devices[i][field] keys of the multiple-sale form, in index order"""
+    devices = {}
+    for key, value in form.items():
+        match = SALE_DEVICE_FIELD.fullmatch(key)
+        if match:
+            devices.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    return [devices[index] for index in sorted(devices)]
+
+def split_payment(prices, paid_amount):
+    """Share paid_amount between prices in proportion, rounded to 2 places and adding up exactly"""
+    total = sum(prices)
+    if paid_amount >= total:
+        return list(prices)
+    if paid_amount <= 0 or total <= 0:
+        return [0.0] * len(prices)
+    shares = [round(paid_amount * price / total, 2) for price in prices]
+    shares[-1] = round(paid_amount - sum(shares[:-1]), 2)  # Rounding remainder goes on the last device
+    return shares
+
+def in_stock_units(user_id, imeis):
+    """{imei: (unit id, purchase_id, position)} for the IMEIs that are in stock"""
+    units = {}
+    imeis = list(imeis)
+    for start in range(0, len(imeis), IMEI_LOOKUP_CHUNK):
+        units.update(
+            (imei, (unit_id, purchase_id, position))
+            for unit_id, imei, purchase_id, position in db.session.query(
+                DeviceUnit.id, DeviceUnit.stock_imei, DeviceUnit.purchase_id, DeviceUnit.position
+            ).filter(
+                DeviceUnit.user_id == user_id,
+                DeviceUnit.stock_imei.in_(imeis[start:start + IMEI_LOOKUP_CHUNK])
+            )
+        )
+    return units
+
+def add_sale_rows_to_rollup(user_id, rows, brand_ids):
+    """Add inserted sale rows to the monthly profit rollup, one update per rollup key (caller commits)"""
+    totals = {}
+    for row in rows:
+        key = dict(user_id=user_id, year=row['date'].year, month=row['date'].month,
+                   brand_id=brand_ids[row['model_id']], model_id=row['model_id'],
+                   inventory_type=row['inventory_type'], customer_type=row['customer_type'] or '')
+        amounts = totals.setdefault(tuple(key.items()), dict(revenue=0, cost=0, profit=0, units=0))
+        amounts['revenue'] += row['sale_price']
+        amounts['cost'] += row['purchase_price']
+        amounts['profit'] += row['profit']
+        amounts['units'] += 1
+    for key, amounts in totals.items():
+        increment_counters(ProfitRollup, dict(key), amounts)
 
 @app.route('/add_multiple_sale', methods=['POST'])
 @login_required
 def add_multiple_sale():
-    """Process multiple device sale"""
+    """Process multiple device sale as one bill, written in a single transaction"""
     try:
+        idempotency, replay = claim_idempotency_key('add_multiple_sale')
+        if replay:
+            return replay
         customer_type = request.form.get('customer_type')
         pricing_method = request.form.get('pricing_method')
         
@@ -589,132 +2181,157 @@ def add_multiple_sale():
             customer_name = request.form.get('customer_name')
             total_paid_amount = float(request.form.get('total_paid_amount') or 0)
         elif customer_type == 'shop':
-            shop_id = request.form.get('shop_id')
+            shop_id = int(request.form.get('shop_id'))
             due_date_str = request.form.get('due_date')
             if due_date_str:
                 due_date = datetime.strptime(due_date_str, '%Y-%m-%d')
             total_paid_amount = float(request.form.get('paid_amount') or 0)
         
-        # Process devices
-        devices_data = []
-        total_sale_amount = 0
-        device_index = 0
-        
-        while True:
-            model_id_key = f'devices[{device_index}][model_id]'
-            if model_id_key not in request.form:
-                break
-                
-            model_id = request.form.get(model_id_key)
-            imei = request.form.get(f'devices[{device_index}][imei]')
-            purchase_price = float(request.form.get(f'devices[{device_index}][purchase_price]'))
-            inventory_type = request.form.get(f'devices[{device_index}][inventory_type]')
-            
-            # Get sale price based on pricing method
-            if pricing_method == 'common':
-                sale_price = float(request.form.get('common_sale_price'))
-            else:
-                sale_price = float(request.form.get(f'devices[{device_index}][sale_price]'))
-            
-            devices_data.append({
-                'model_id': model_id,
-                'imei': imei,
-                'purchase_price': purchase_price,
-                'sale_price': sale_price,
-                'inventory_type': inventory_type,
-                'profit': sale_price - purchase_price
-            })
-            
-            total_sale_amount += sale_price
-            device_index += 1
-        
-        if not devices_data:
+        # Validate the whole basket before writing anything
+        devices = parse_sale_devices(request.form)
+        if not devices:
             flash('No devices found to process', 'error')
             return redirect(url_for('sale_module'))
         
-        # Generate bill number for the batch
-        bill_number = f"BILL-{datetime.now().strftime('%Y%m%d')}-{Sale.query.count() + 1:04d}"
+        common_sale_price = float(request.form.get('common_sale_price') or 0) if pricing_method == 'common' else None
+        for device in devices:
+            device['model_id'] = int(device['model_id'])
+            device['purchase_price'] = float(device['purchase_price'])
+            device['sale_price'] = common_sale_price if common_sale_price is not None else float(device['sale_price'])
         
-        # Create sales records
-        created_sales = []
-        for device in devices_data:
-            # Calculate payment details for this device
-            device_paid_amount = 0
-            device_due_amount = device['sale_price']
-            payment_status = 'paid'
-            
-            if customer_type == 'shop':
-                # Distribute paid amount proportionally
-                if total_paid_amount > 0:
-                    proportion = device['sale_price'] / total_sale_amount
-                    device_paid_amount = total_paid_amount * proportion
-                    device_due_amount = device['sale_price'] - device_paid_amount
-                
-                if device_paid_amount >= device['sale_price']:
-                    payment_status = 'paid'
-                    device_due_amount = 0
-                elif device_paid_amount > 0:
-                    payment_status = 'partial'
-                else:
-                    payment_status = 'pending'
-            else:
-                # Individual customers - distribute paid amount proportionally
-                if total_paid_amount > 0:
-                    proportion = device['sale_price'] / total_sale_amount
-                    device_paid_amount = total_paid_amount * proportion
-                    device_due_amount = device['sale_price'] - device_paid_amount
-                else:
-                    device_paid_amount = 0
-                    device_due_amount = device['sale_price']
-                
-                # Set payment status based on amount paid
-                if device_paid_amount >= device['sale_price']:
-                    payment_status = 'paid'
-                    device_due_amount = 0
-                elif device_paid_amount > 0:
-                    payment_status = 'partial'
-                else:
-                    payment_status = 'pending'
-            
-            sale = Sale(
-                model_id=device['model_id'],
-                imei_number=device['imei'],
-                sale_price=device['sale_price'],
-                purchase_price=device['purchase_price'],
-                profit=device['profit'],
-                inventory_type=device['inventory_type'],
-                customer_type=customer_type,
-                shop_id=shop_id,
-                customer_name=customer_name,
-                payment_status=payment_status,
-                paid_amount=device_paid_amount,
-                due_amount=device_due_amount,
-                due_date=due_date,
-                bill_number=bill_number,
-                user_id=current_user.id
-            )
-            
-            db.session.add(sale)
-            created_sales.append(sale)
+        imeis = [device['imei'] for device in devices]
+        duplicates = sorted(imei for imei, count in Counter(imeis).items() if count > 1)
+        if duplicates:
+            flash(f'IMEIs listed more than once: {", ".join(duplicates)}', 'error')
+            return redirect(url_for('sale_module'))
+        units = in_stock_units(current_user.id, imeis)
+        missing = [imei for imei in imeis if imei not in units]
+        if missing:
+            flash(f'IMEIs not in stock: {", ".join(missing)}', 'error')
+            return redirect(url_for('sale_module'))
         
-        db.session.commit()
+        prices = [device['sale_price'] for device in devices]
+        total_sale_amount = sum(prices)
+        paid_shares = split_payment(prices, total_paid_amount)
+        total_applied = round(sum(paid_shares), 2)
+        total_due_amount = round(total_sale_amount - total_applied, 2)
+        
+        # Take the devices out of stock first, so a concurrent checkout selling any of them fails here
+        if not claim_device_units(units[imei][0] for imei in imeis):
+            raise SaleConflictError(imeis)
+        bill_number = next_bill_number(current_user.id)
+        
+        if customer_type == 'shop':
+            credit_error = shop_credit_error(current_user.id, shop_id, total_due_amount)
+            if credit_error:
+                db.session.rollback()
+                flash(credit_error, 'error')
+                return redirect(url_for('sale_module'))
         
-        # Create payment record for shop sales
+        # Bill header, then every sale row in one multi-row insert
+        sale_date = datetime.utcnow()
+        invoice = Invoice(
+            bill_number=bill_number,
+            customer_type=customer_type,
+            customer_name=customer_name,
+            shop_id=shop_id,
+            item_count=len(devices),
+            total_amount=total_sale_amount,
+            paid_amount=total_applied,
+            due_amount=total_due_amount,
+            payment_status=invoice_payment_status(total_applied, total_due_amount),
+            due_date=due_date,
+            date=sale_date,
+            user_id=current_user.id
+        )
+        db.session.add(invoice)
+        db.session.flush()
+        
+        sale_rows = []
+        for device, paid_amount in zip(devices, paid_shares):
+            due_amount = round(device['sale_price'] - paid_amount, 2)
+            sale_rows.append({
+                'model_id': device['model_id'],
+                'imei_number': device['imei'],
+                'sale_price': device['sale_price'],
+                'purchase_price': device['purchase_price'],
+                'profit': device['sale_price'] - device['purchase_price'],
+                'inventory_type': device['inventory_type'],
+                'customer_type': customer_type,
+                'shop_id': shop_id,
+                'customer_name': customer_name,
+                'payment_status': 'paid' if due_amount <= 0 else 'partial' if paid_amount > 0 else 'pending',
+                'paid_amount': paid_amount,
+                'due_amount': max(due_amount, 0),
+                'due_date': due_date,
+                'bill_number': bill_number,
+                'invoice_id': invoice.id,
+                'date': sale_date,
+                'user_id': current_user.id
+            })
+        db.session.execute(db.insert(Sale), sale_rows)
+        sale_ids = dict(db.session.query(Sale.imei_number, Sale.id).filter(Sale.invoice_id == invoice.id))
+        db.session.execute(db.update(DeviceUnit), [
+            {'id': units[imei][0], 'sale_id': sale_ids[imei]} for imei in imeis
+        ])
+        
+        # Summary tables: one update per counter row rather than per device
+        models = {model.id: model for model in Model.query.options(db.joinedload(Model.brand)).filter(
+            Model.id.in_({row['model_id'] for row in sale_rows})
+        )}
+        sold_counts = Counter((row['model_id'], row['inventory_type']) for row in sale_rows)
+        for (model_id, inventory_type), sold in sold_counts.items():
+            adjust_stock(current_user.id, model_id, inventory_type, sold=sold)
+        add_sale_rows_to_rollup(current_user.id, sale_rows, {model_id: model.brand_id for model_id, model in models.items()})
+        adjust_shop_balance(current_user.id, shop_id, billed=total_sale_amount,
+                            paid=total_applied, outstanding=total_due_amount)
+        
+        # Shop payment record in the same transaction as the sales
         if customer_type == 'shop' and total_paid_amount > 0:
-            payment = Payment(
+            db.session.add(Payment(
                 shop_id=shop_id,
                 amount=total_paid_amount,
-                payment_date=datetime.utcnow(),
+                payment_date=sale_date,
                 user_id=current_user.id
-            )
-            db.session.add(payment)
-            db.session.commit()
-        
-        flash(f'Multiple sale completed successfully! {len(devices_data)} devices sold. Bill: {bill_number}', 'success')
+            ))
+        scan_session_id = request.form.get('scan_session_id')
+        if scan_session_id:
+            scan_session = get_open_scan_session(current_user.id, scan_session_id, 'sale')
+            if scan_session:
+                scan_session.status = 'committed'
+        index_version = bump_cache_version(imei_index_key(current_user.id))
+        dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+        summary_rows = [{
+            'date': row['date'],
+            'sale_price': row['sale_price'],
+            'profit': row['profit'],
+            'payment_status': row['payment_status'],
+            'model': model_summary_row(models.get(row['model_id']))
+        } for row in sale_rows]
+        low_stock = low_stock_message(current_user.id, list(sold_counts))
+        message = f'Multiple sale completed successfully! {len(devices)} devices sold. Bill: {bill_number}{low_stock}'
+        # Redirect to the bill (every sale on it shows the same invoice)
+        bill_url = url_for('bill', sale_id=sale_ids[imeis[0]])
+        save_idempotent_result(idempotency, bill_url, message, [sale_ids[imei] for imei in imeis])
+        db.session.commit()
+        update_imei_index(current_user.id, index_version, {
+            imei: (units[imei][1], units[imei][2], True) for imei in imeis
+        })
+        update_dashboard_cache(current_user.id, dashboard_version, sales=summary_rows)
         
-        # Redirect to the first sale's bill (they all have the same bill number)
-        return redirect(url_for('bill', sale_id=created_sales[0].id))
+        flash(message, 'success')
+        return redirect(bill_url)
         
+    except SaleConflictError as e:
+        db.session.rollback()
+        # Name only the devices another checkout took
+        still_in_stock = in_stock_units(current_user.id, e.imeis)
+        flash(str(SaleConflictError([imei for imei in e.imeis if imei not in still_in_stock] or e.imeis)), 'error')
+        return redirect(url_for('sale_module'))
+    except OperationalError as e:
+        db.session.rollback()
+        flash(SALE_RETRY_MESSAGE if is_lock_conflict(e) else f'Error processing multiple sale: {str(e)}', 'error')
+        return redirect(url_for('sale_module'))
     except Exception as e:
         db.session.rollback()
         flash(f'Error processing multiple sale: {str(e)}', 'error')
@@ -779,32 +2396,70 @@ def add_sale():
         else:
             payment_status = 'pending'
     
-    # Generate bill number
-    bill_number = f"BILL-{datetime.now().strftime('%Y%m%d')}-{Sale.query.count() + 1:04d}"
-    
-    # Create sale record
-    sale = Sale(
-        model_id=model_id,
-        imei_number=imei_number,
-        sale_price=sale_price,
-        purchase_price=purchase_price,
-        profit=profit,
-        inventory_type=inventory_type,
-        customer_type=customer_type,
-        shop_id=shop_id,
-        customer_name=customer_name,
-        payment_status=payment_status,
-        paid_amount=paid_amount,
-        due_amount=due_amount,
-        due_date=due_date,
-        bill_number=bill_number,
-        user_id=current_user.id
-    )
-    
-    db.session.add(sale)
-    db.session.commit()
-    
-    flash('Sale completed successfully!', 'success')
+    try:
+        idempotency, replay = claim_idempotency_key('add_sale')
+        if replay:
+            return replay
+        
+        # Take the device out of stock first, then the bill number, then the shop balance
+        unit = claim_device_unit(current_user.id, imei_number)
+        bill_number = next_bill_number(current_user.id)
+        
+        if customer_type == 'shop':
+            credit_error = shop_credit_error(current_user.id, shop_id, due_amount)
+            if credit_error:
+                db.session.rollback()
+                flash(credit_error, 'error')
+                return redirect(url_for('sale_module'))
+        
+        # Create sale record
+        sale = Sale(
+            model_id=model_id,
+            imei_number=imei_number,
+            sale_price=sale_price,
+            purchase_price=purchase_price,
+            profit=profit,
+            inventory_type=inventory_type,
+            customer_type=customer_type,
+            shop_id=shop_id,
+            customer_name=customer_name,
+            payment_status=payment_status,
+            paid_amount=paid_amount,
+            due_amount=due_amount,
+            due_date=due_date,
+            bill_number=bill_number,
+            user_id=current_user.id
+        )
+        
+        db.session.add(sale)
+        create_invoice(current_user.id, bill_number, [sale])
+        db.session.flush()
+        DeviceUnit.query.filter_by(id=unit.id).update({DeviceUnit.sale_id: sale.id}, synchronize_session=False)
+        adjust_stock(current_user.id, model_id, inventory_type, sold=1)
+        add_sale_to_rollup(sale)
+        adjust_shop_balance(current_user.id, shop_id, billed=sale_price, paid=paid_amount, outstanding=due_amount)
+        index_version = bump_cache_version(imei_index_key(current_user.id))
+        dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+        sale_row = sale_summary_row(sale)
+        message = 'Sale completed successfully!' + low_stock_message(current_user.id, [(model_id, inventory_type)])
+        save_idempotent_result(idempotency, url_for('dashboard'), message, [sale.id])
+        db.session.commit()
+    except SaleConflictError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+        return redirect(url_for('sale_module'))
+    except OperationalError as e:
+        db.session.rollback()
+        if not is_lock_conflict(e):
+            raise
+        flash(SALE_RETRY_MESSAGE, 'error')
+        return redirect(url_for('sale_module'))
+    update_imei_index(current_user.id, index_version, {
+        unit.imei: (unit.purchase_id, unit.position, True)
+    })
+    update_dashboard_cache(current_user.id, dashboard_version, sales=[sale_row])
+
+    flash(message, 'success')
     return redirect(url_for('dashboard'))
 
 @app.route('/add_payment/<int:sale_id>', methods=['GET', 'POST'])
@@ -818,6 +2473,9 @@ def add_payment(sale_id):
         return redirect(url_for('transactions'))
     
     if request.method == 'POST':
+        idempotency, replay = claim_idempotency_key('add_payment')
+        if replay:
+            return replay
         additional_payment = float(request.form.get('additional_payment') or 0)
         
         if additional_payment <= 0:
@@ -825,6 +2483,7 @@ def add_payment(sale_id):
             return redirect(url_for('add_payment', sale_id=sale_id))
         
         # Update payment details
+        previous_due = sale.due_amount
         sale.paid_amount += additional_payment
         sale.due_amount = max(0, sale.sale_price - sale.paid_amount)
         
@@ -835,9 +2494,16 @@ def add_payment(sale_id):
         else:
             sale.payment_status = 'partial'
         
+        adjust_shop_balance(current_user.id, sale.shop_id, paid=additional_payment,
+                            outstanding=sale.due_amount - previous_due)
+        adjust_invoice(sale.invoice_id, paid=additional_payment, due=sale.due_amount - previous_due)
+        dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+        message = f'Payment of PKR {additional_payment:,.2f} added successfully!'
+        save_idempotent_result(idempotency, url_for('transactions'), message, [sale.id])
         db.session.commit()
+        update_dashboard_cache(current_user.id, dashboard_version)
         
-        flash(f'Payment of PKR {additional_payment:,.2f} added successfully!', 'success')
+        flash(message, 'success')
         return redirect(url_for('transactions'))
     
     return render_template('add_payment.html', sale=sale)
@@ -870,59 +2536,39 @@ def profits_detailed():
         return redirect(url_for('profits'))
     
     try:
-        # Calculate detailed profit information
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-        
-        # Get all sales profit (filtered by user)
-        total_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-            Sale.user_id == current_user.id
-        ).scalar() or 0
-        
-        # Get monthly sales profit (filtered by user)
-        monthly_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-            Sale.user_id == current_user.id,
-            db.extract('month', Sale.date) == current_month,
-            db.extract('year', Sale.date) == current_year
-        ).scalar() or 0
-        
-        # Get incentives (filtered by user)
-        total_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-            Incentive.user_id == current_user.id
-        ).scalar() or 0
-        monthly_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-            Incentive.user_id == current_user.id,
-            Incentive.month == current_month,
-            Incentive.year == current_year
-        ).scalar() or 0
+        period = period_from_request()
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('profits_detailed'))
+    
+    try:
+        # Calculate detailed profit information from the monthly rollup
+        profits = profit_summary(current_user.id, period)
+        total_sales_profit = profits['total_sales_profit']
+        monthly_sales_profit = profits['monthly_sales_profit']
+        total_incentives = profits['total_incentives']
+        monthly_incentives = profits['monthly_incentives']
         
         # Calculate total profits
         total_profit_with_incentives = total_sales_profit + total_incentives
         monthly_profit_with_incentives = monthly_sales_profit + monthly_incentives
         
-        # Get profit breakdown by brand
-        brand_profits = db.session.query(
-            Brand.name,
-            db.func.sum(Sale.profit).label('total_profit'),
-            db.func.count(Sale.id).label('total_sales')
-        ).select_from(Brand).join(Sale, Brand.id == Sale.model_id).filter(
-            Sale.user_id == current_user.id
-        ).group_by(Brand.name).all()
-        
-        # Get profit breakdown by month
-        monthly_breakdown = db.session.query(
-            db.extract('month', Sale.date).label('month'),
-            db.extract('year', Sale.date).label('year'),
-            db.func.sum(Sale.profit).label('profit')
-        ).filter(
-            Sale.user_id == current_user.id
-        ).group_by(
-            db.extract('month', Sale.date),
-            db.extract('year', Sale.date)
-        ).order_by(
-            db.extract('year', Sale.date).desc(),
-            db.extract('month', Sale.date).desc()
-        ).limit(12).all()
+        # Get profit breakdown by brand, best first
+        brand_profits = [
+            row for row in profit_cube(current_user.id, ['brand'], order_by_profit=True) if row['units']
+        ]
+        
+        # Get profit breakdown by month (last 12 months, latest first)
+        monthly_breakdown = [
+            row for row in profit_cube(current_user.id, ['year', 'month'], period=report_period('last_12_months'))
+            if row['units']
+        ][::-1]
+        
+        # Brand x inventory type x customer type for the selected period
+        brand_slices = profit_cube(
+            current_user.id, ['brand', 'inventory_type', 'customer_type'],
+            order_by_profit=True, period=period
+        )
         
         return render_template('profits_detailed.html',
                              total_profit=total_profit_with_incentives,
@@ -932,67 +2578,151 @@ def profits_detailed():
                              total_incentives=total_incentives,
                              monthly_incentives=monthly_incentives,
                              brand_profits=brand_profits,
-                             monthly_breakdown=monthly_breakdown)
+                             monthly_breakdown=monthly_breakdown,
+                             brand_slices=brand_slices,
+                             period=period,
+                             report_periods=REPORT_PERIODS,
+                             current_year=datetime.now().year)
     except Exception as e:
         flash(f'Error loading profits: {str(e)}', 'error')
         return redirect(url_for('profits'))
 
+@app.route('/profits/cube')
+@login_required
+def profits_cube():
+    """Profit cube as JSON for charts, e.g. ?dims=brand,month&period=fiscal_year&inventory_type=new"""
+    if not session.get('profit_verified'):
+        return jsonify({'error': 'Profit password required'}), 403
+    
+    dimensions = [name.strip() for name in request.args.get('dims', 'brand').split(',') if name.strip()]
+    filters = {name: request.args.get(name) for name in PROFIT_CUBE_FILTERS}
+    for name in ('brand_id', 'model_id', 'year', 'month'):
+        filters[name] = request.args.get(name, type=int)
+    
+    try:
+        period = period_from_request(default='all')
+        rows = profit_cube(current_user.id, dimensions, filters,
+                           order_by_profit=request.args.get('order') == 'profit',
+                           limit=request.args.get('limit', type=int), period=period)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'dimensions': dimensions, 'period': period['label'], 'rows': rows})
+
+# Transactions are paged with keyset cursors on (date, key), newest first
+TRANSACTIONS_PAGE_SIZE = 20
+PURCHASES_PAGE_SIZE = 25
+def encode_cursor(date, key):
+    return f'{date.isoformat()}|{key}'
+
+def decode_cursor(value, key_type=str):
+    """(datetime, key) from a page cursor, or None when it is missing or malformed"""
+    if not value or '|' not in value:
+        return None
+    date, key = value.split('|', 1)
+    try:
+        return datetime.fromisoformat(date), key_type(key)
+    except ValueError:
+        return None
+
+def keyset_page(query, date_column, key_column, page_size, before=None, after=None):
+    """One page of rows older than `before` or newer than `after`, newest first"""
+    if after:
+        date, key = after
+        query = query.filter(db.or_(date_column > date, db.and_(date_column == date, key_column > key)))
+        rows = query.order_by(date_column, key_column).limit(page_size + 1).all()
+        has_newer = len(rows) > page_size
+        return {'rows': rows[:page_size][::-1], 'has_newer': has_newer, 'has_older': True}
+    
+    if before:
+        date, key = before
+        query = query.filter(db.or_(date_column < date, db.and_(date_column == date, key_column < key)))
+    rows = query.order_by(date_column.desc(), key_column.desc()).limit(page_size + 1).all()
+    return {'rows': rows[:page_size], 'has_newer': before is not None, 'has_older': len(rows) > page_size}
+
 @app.route('/transactions')
 @login_required
 def transactions():
-    """Transactions history - sales and purchases grouped by bill number with optional model filtering"""
+    """Transactions history - bills with their sales and purchases, one page each, with optional model filtering"""
     try:
         # Get model filter if provided
         model_id = request.args.get('model_id', type=int)
-        
-        # Get all sales (filtered by user, no profit info)
-        query = Sale.query.filter_by(user_id=current_user.id)
-        
-        # Apply model filter if specified
         if model_id:
-            query = query.filter_by(model_id=model_id)
             flash(f'Showing transactions for selected model only. <a href="{url_for("transactions")}" class="alert-link">View all transactions</a>', 'info')
         
-        all_sales = query.order_by(Sale.date.desc()).all()
-        
-        # Group sales by bill number
-        sales_groups = {}
-        for sale in all_sales:
-            bill_key = sale.bill_number or f"single_{sale.id}"
-            if bill_key not in sales_groups:
-                sales_groups[bill_key] = {
-                    'bill_number': sale.bill_number,
-                    'date': sale.date,
-                    'customer_type': sale.customer_type,
-                    'customer_name': sale.customer_name,
-                    'shop': sale.shop,
-                    'payment_status': sale.payment_status,
-                    'items': [],
-                    'total_amount': 0,
-                    'total_paid': 0,
-                    'total_due': 0
-                }
-            
-            sales_groups[bill_key]['items'].append(sale)
-            sales_groups[bill_key]['total_amount'] += sale.sale_price
-            sales_groups[bill_key]['total_paid'] += sale.paid_amount
-            sales_groups[bill_key]['total_due'] += sale.due_amount
-            
-            # Update payment status for the group (use the most restrictive status)
-            current_status = sales_groups[bill_key]['payment_status']
-            if sale.payment_status == 'pending' or current_status == 'pending':
-                sales_groups[bill_key]['payment_status'] = 'pending'
-            elif sale.payment_status == 'partial' or current_status == 'partial':
-                sales_groups[bill_key]['payment_status'] = 'partial'
-        
-        # Convert to list and sort by date
-        sales_groups_list = list(sales_groups.values())
-        sales_groups_list.sort(key=lambda x: x['date'], reverse=True)
-        
-        # Get all purchases (filtered by user) - already grouped by nature
-        purchases = Purchase.query.filter_by(user_id=current_user.id).order_by(Purchase.date.desc()).all()
-        
-        return render_template('transactions.html', sales_groups=sales_groups_list, purchases=purchases, all_sales=all_sales, model_filter=model_id)
+        # One page of bill headers
+        invoice_query = Invoice.query.filter(Invoice.user_id == current_user.id)
+        if model_id:
+            invoice_query = invoice_query.filter(Invoice.id.in_(
+                db.select(Sale.invoice_id).where(Sale.user_id == current_user.id, Sale.model_id == model_id)
+            ))
+        sales_page = keyset_page(
+            invoice_query.options(db.joinedload(Invoice.shop)), Invoice.date, Invoice.id, TRANSACTIONS_PAGE_SIZE,
+            before=decode_cursor(request.args.get('sales_before'), int),
+            after=decode_cursor(request.args.get('sales_after'), int)
+        )
+        bill_count = invoice_query.count()
+        if model_id:
+            sale_count = Sale.query.filter_by(user_id=current_user.id, model_id=model_id).count()
+        else:
+            sale_count = db.session.query(db.func.coalesce(db.func.sum(Invoice.item_count), 0)).filter(
+                Invoice.user_id == current_user.id
+            ).scalar()
+        
+        # Line items for the visible bills only
+        items_by_invoice = {}
+        if sales_page['rows']:
+            items = Sale.query.options(db.joinedload(Sale.model).joinedload(Model.brand)).filter(
+                Sale.invoice_id.in_([invoice.id for invoice in sales_page['rows']])
+            )
+            if model_id:
+                items = items.filter(Sale.model_id == model_id)
+            for sale in items.order_by(Sale.id):
+                items_by_invoice.setdefault(sale.invoice_id, []).append(sale)
+        
+        sales_groups = [{
+            'bill_number': invoice.bill_number,
+            'date': invoice.date,
+            'customer_type': invoice.customer_type,
+            'customer_name': invoice.customer_name,
+            'shop': invoice.shop,
+            'payment_status': invoice.payment_status,
+            'sales': items_by_invoice.get(invoice.id, []),
+            'item_count': invoice.item_count,
+            'total_amount': invoice.total_amount,
+            'total_paid': invoice.paid_amount,
+            'total_due': invoice.due_amount
+        } for invoice in sales_page['rows']]
+        
+        # Purchases are paged on their own
+        purchase_query = Purchase.query.options(
+            db.joinedload(Purchase.model).joinedload(Model.brand), db.joinedload(Purchase.supplier)
+        ).filter(Purchase.user_id == current_user.id)
+        purchases_page = keyset_page(
+            purchase_query, Purchase.date, Purchase.id, PURCHASES_PAGE_SIZE,
+            before=decode_cursor(request.args.get('purchases_before'), int),
+            after=decode_cursor(request.args.get('purchases_after'), int)
+        )
+        purchase_count = db.session.query(db.func.count(Purchase.id)).filter(
+            Purchase.user_id == current_user.id
+        ).scalar()
+        
+        def page_links(page, cursor_key):
+            rows = page['rows']
+            return {
+                'newer': encode_cursor(rows[0].date, cursor_key(rows[0])) if rows and page['has_newer'] else None,
+                'older': encode_cursor(rows[-1].date, cursor_key(rows[-1])) if rows and page['has_older'] else None
+            }
+        
+        return render_template('transactions.html',
+                             sales_groups=sales_groups,
+                             bill_count=bill_count,
+                             sale_count=sale_count,
+                             sales_pages=page_links(sales_page, lambda row: row.id),
+                             purchases=purchases_page['rows'],
+                             purchase_count=purchase_count,
+                             purchases_pages=page_links(purchases_page, lambda row: row.id),
+                             active_tab='purchases' if request.args.get('tab') == 'purchases' else 'sales',
+                             model_filter=model_id)
     except Exception as e:
         flash(f'Error loading transactions: {str(e)}', 'error')
         return redirect(url_for('dashboard'))
@@ -1026,55 +2756,24 @@ def search_device_result():
             flash('IMEI must be 9-15 digits', 'error')
             return redirect(url_for('search_device'))
         
-        print(f"Searching for IMEI: {imei}")  # Debug log
-        
         # Find the purchase containing this IMEI
-        purchases = Purchase.query.filter_by(user_id=current_user.id).all()
-        print(f"Found {len(purchases)} purchases for user {current_user.id}")  # Debug log
-        
-        found_purchase = None
-        found_imei_index = -1
-        
-        for purchase in purchases:
-            try:
-                imei_list = json.loads(purchase.imei_numbers)
-                print(f"Purchase {purchase.id} has {len(imei_list)} IMEIs: {imei_list[:3]}...")  # Debug log
-                
-                if imei in imei_list:
-                    found_purchase = purchase
-                    found_imei_index = imei_list.index(imei)
-                    print(f"Found IMEI {imei} in purchase {purchase.id} at index {found_imei_index}")  # Debug log
-                    break
-            except (json.JSONDecodeError, TypeError) as e:
-                # Handle corrupted IMEI data
-                print(f"Error parsing IMEI data for purchase {purchase.id}: {e}")
-                continue
-        
-        if not found_purchase:
+        entry = lookup_imei(current_user.id, imei)
+
+        if not entry:
             # Try to find similar IMEIs for better user feedback
-            similar_imeis = []
-            for purchase in purchases:
-                try:
-                    imei_list = json.loads(purchase.imei_numbers)
-                    for stored_imei in imei_list:
-                        if stored_imei.startswith(imei[:5]) or stored_imei.endswith(imei[-5:]):
-                            similar_imeis.append(stored_imei)
-                except:
-                    continue
-            
-            if similar_imeis:
-                flash(f'IMEI {imei} not found! Similar IMEIs in your inventory: {", ".join(similar_imeis[:3])}', 'error')
+            suggestions = [item['imei'] for item in similar_imeis(current_user.id, imei, limit=3)]
+
+            if suggestions:
+                flash(f'IMEI {imei} not found! Similar IMEIs in your inventory: {", ".join(suggestions)}', 'error')
             else:
                 flash(f'IMEI {imei} not found in your inventory!', 'error')
             return redirect(url_for('search_device'))
         
+        purchase_id, found_imei_index, sold = entry
+        found_purchase = db.session.get(Purchase, purchase_id)
+
         # Check if sold
-        existing_sale = Sale.query.filter_by(
-            imei_number=imei,
-            user_id=current_user.id
-        ).first()
-        
-        print(f"Sale found for IMEI {imei}: {existing_sale.id if existing_sale else 'None'}")  # Debug log
+        existing_sale = find_device_unit(current_user.id, imei).sale if sold else None
         
         # Get supplier info if available
         supplier = None
@@ -1089,8 +2788,6 @@ def search_device_result():
             if model and model.brand_id:
                 brand = Brand.query.get(model.brand_id)
         
-        print(f"Rendering template with: purchase={found_purchase.id}, model={model.name if model else 'None'}, brand={brand.name if brand else 'None'}")  # Debug log
-        
         return render_template('search_device_result.html',
                              purchase=found_purchase,
                              imei=imei,
@@ -1101,9 +2798,7 @@ def search_device_result():
                              brand=brand)
                              
     except Exception as e:
-        print(f"Error in search_device_result: {e}")
-        import traceback
-        traceback.print_exc()  # Print full stack trace
+        app.logger.exception('Error in search_device_result')
         flash(f'Error searching for device: {str(e)}. Please try again.', 'error')
         return redirect(url_for('search_device'))
 
@@ -1134,6 +2829,18 @@ def get_suppliers():
     suppliers = Supplier.query.all()
     return jsonify([{'id': s.id, 'name': s.name} for s in suppliers])
 
+@app.route('/imei_suggestions')
+@login_required
+def imei_suggestions():
+    """Closest purchased IMEIs for the search box autocomplete"""
+    query = (request.args.get('q') or '').strip()
+    limit = min(request.args.get('limit', 5, type=int), 20)
+
+    if len(query) < 3:
+        return jsonify([])
+
+    return jsonify(similar_imeis(current_user.id, query, limit=limit))
+
 @app.route('/validate_imei', methods=['POST'])
 @login_required
 def validate_imei():
@@ -1146,40 +2853,41 @@ def validate_imei():
     
     # Allow any IMEI format - no validation constraints
     
+    # Bloom filter miss means the IMEI was never purchased - no lookup needed
+    if imei not in load_imei_filter(current_user.id):
+        return jsonify({'valid': True, 'message': 'IMEI is new and can be added'})
+
     # Check if IMEI already exists in purchases
-    purchases = Purchase.query.filter_by(user_id=current_user.id).all()
-    for purchase in purchases:
-        imei_list = json.loads(purchase.imei_numbers)
-        if imei in imei_list:
-            # Check if it was sold
-            existing_sale = Sale.query.filter_by(
-                imei_number=imei,
-                user_id=current_user.id
-            ).first()
-            
-            if existing_sale:
-                # IMEI was sold, can be bought again
-                return jsonify({
-                    'valid': True, 
-                    'message': 'IMEI was previously sold, can be purchased again',
-                    'was_sold': True
-                })
-            else:
-                # IMEI exists and not sold
-                return jsonify({
-                    'valid': False, 
-                    'message': 'IMEI already exists in inventory and has not been sold',
-                    'was_sold': False
-                })
-    
+    entry = lookup_imei(current_user.id, imei)
+    if entry:
+        purchase_id, position, sold = entry
+        if sold:
+            # IMEI was sold, can be bought again
+            return jsonify({
+                'valid': True,
+                'message': 'IMEI was previously sold, can be purchased again',
+                'was_sold': True
+            })
+        else:
+            # IMEI exists and not sold
+            return jsonify({
+                'valid': False,
+                'message': 'IMEI already exists in inventory and has not been sold',
+                'was_sold': False
+            })
+
     # IMEI is new
     return jsonify({'valid': True, 'message': 'IMEI is new and can be added'})
 
-@app.route('/generate_bill_number')
+@app.route('/generate_bill_number', methods=['POST'])
 @login_required
 def generate_bill_number():
-    """Generate unique bill number"""
-    bill_number = f"BILL-{datetime.now().strftime('%Y%m%d')}-{Sale.query.count() + 1:04d}"
+    """Reserve a unique bill number, e.g. ?type=purchase for a purchase bill"""
+    kind = request.args.get('type', 'sale')
+    if kind not in BILL_PREFIXES:
+        return jsonify({'error': f'Unknown bill type: {kind}'}), 400
+    bill_number = next_bill_number(current_user.id, kind)
+    db.session.commit()
     return jsonify({'bill_number': bill_number})
 
 @app.route('/bill/<int:sale_id>')
@@ -1188,16 +2896,11 @@ def bill(sale_id):
     """Generate bill for sale with grouped sales information"""
     sale = Sale.query.filter_by(id=sale_id, user_id=current_user.id).first_or_404()
     
-    # Get all sales for grouped transaction display
-    all_sales = []
-    if sale.bill_number:
-        # Find all sales with the same bill number
-        all_sales = Sale.query.filter_by(
-            bill_number=sale.bill_number, 
-            user_id=current_user.id
-        ).order_by(Sale.id).all()
+    # Header totals and every sale on the same bill
+    invoice = sale.invoice
+    all_sales = invoice.sales if invoice else [sale]
     
-    return render_template('bill.html', sale=sale, all_sales=all_sales)
+    return render_template('bill.html', sale=sale, invoice=invoice, all_sales=all_sales)
 
 @app.route('/business_report/<int:sale_id>')
 @login_required
@@ -1217,16 +2920,18 @@ def incentives():
     incentives = Incentive.query.filter_by(user_id=current_user.id).order_by(Incentive.date.desc()).all()
     
     # Calculate incentive totals (filtered by user)
-    current_month = datetime.now().month
-    current_year = datetime.now().year
+    try:
+        period = period_from_request()
+    except ValueError as e:
+        flash(str(e), 'error')
+        period = report_period('this_month')
     
     total_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
         Incentive.user_id == current_user.id
     ).scalar() or 0
     monthly_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
         Incentive.user_id == current_user.id,
-        Incentive.month == current_month,
-        Incentive.year == current_year
+        month_period_filter(Incentive.year, Incentive.month, period)
     ).scalar() or 0
     
     return render_template('incentives.html', 
@@ -1234,6 +2939,8 @@ def incentives():
                          incentives=incentives,
                          total_incentives=total_incentives,
                          monthly_incentives=monthly_incentives,
+                         period=period,
+                         report_periods=REPORT_PERIODS,
                          now=datetime.now())
 
 @app.route('/shops')
@@ -1241,24 +2948,18 @@ def incentives():
 def shops():
     """Shop management"""
     try:
-        shops = Shop.query.all()
-        
-        # Calculate financial data for each shop (filtered by user)
-        for shop in shops:
-            shop.total_sales = db.session.query(db.func.sum(Sale.sale_price)).filter(
-                Sale.shop_id == shop.id,
-                Sale.user_id == current_user.id
-            ).scalar() or 0
-            
-            shop.total_paid = db.session.query(db.func.sum(Sale.paid_amount)).filter(
-                Sale.shop_id == shop.id,
-                Sale.user_id == current_user.id
-            ).scalar() or 0
-            
-            shop.total_due = db.session.query(db.func.sum(Sale.due_amount)).filter(
-                Sale.shop_id == shop.id,
-                Sale.user_id == current_user.id
-            ).scalar() or 0
+        # Shops with this user's balances in one query
+        rows = db.session.query(Shop, ShopBalance).outerjoin(
+            ShopBalance, db.and_(ShopBalance.shop_id == Shop.id, ShopBalance.user_id == current_user.id)
+        ).order_by(Shop.id).all()
+        
+        shops = []
+        for shop, balance in rows:
+            shop.total_sales = balance.billed if balance else 0
+            shop.total_paid = balance.paid if balance else 0
+            shop.total_due = balance.outstanding if balance else 0
+            shop.last_activity = balance.updated_at if balance else None
+            shops.append(shop)
         
         return render_template('shops.html', shops=shops)
     except Exception as e:
@@ -1273,12 +2974,14 @@ def add_shop():
     owner_name = request.form.get('owner_name')
     contact_info = request.form.get('contact_info')
     address = request.form.get('address')
+    credit_limit = float(request.form.get('credit_limit') or 0)
     
     shop = Shop(
         name=name,
         owner_name=owner_name,
         contact_info=contact_info,
-        address=address
+        address=address,
+        credit_limit=credit_limit
     )
     db.session.add(shop)
     db.session.commit()
@@ -1292,26 +2995,15 @@ def shop_details(shop_id):
     """Shop details with payment history"""
     # Check if user has any sales with this shop
     shop = Shop.query.get_or_404(shop_id)
-    user_has_sales = Sale.query.filter_by(shop_id=shop_id, user_id=current_user.id).first() is not None
-    if not user_has_sales:
+    balance = db.session.get(ShopBalance, (current_user.id, shop_id))
+    if not balance:
         flash('Access denied. You can only view shops you have sales with.', 'error')
         return redirect(url_for('shops'))
     
-    # Calculate shop's financial summary (filtered by user)
-    total_sales = db.session.query(db.func.sum(Sale.sale_price)).filter(
-        Sale.shop_id == shop_id,
-        Sale.user_id == current_user.id
-    ).scalar() or 0
-    
-    total_paid = db.session.query(db.func.sum(Sale.paid_amount)).filter(
-        Sale.shop_id == shop_id,
-        Sale.user_id == current_user.id
-    ).scalar() or 0
-    
-    total_due = db.session.query(db.func.sum(Sale.due_amount)).filter(
-        Sale.shop_id == shop_id,
-        Sale.user_id == current_user.id
-    ).scalar() or 0
+    # Shop's financial summary (filtered by user)
+    total_sales = balance.billed
+    total_paid = balance.paid
+    total_due = balance.outstanding
     
     # Get recent sales and payments (filtered by user)
     recent_sales = Sale.query.filter_by(
@@ -1334,7 +3026,10 @@ def shop_details(shop_id):
 @app.route('/add_shop_payment', methods=['POST'])
 @login_required
 def add_shop_payment():
-    """Add payment for a shop"""
+    """Add payment for a shop and apply it to the shop's unpaid bills in one transaction"""
+    idempotency, replay = claim_idempotency_key('add_shop_payment')
+    if replay:
+        return replay
     shop_id = request.form.get('shop_id')
     amount = float(request.form.get('amount'))
     payment_method = request.form.get('payment_method')
@@ -1350,75 +3045,132 @@ def add_shop_payment():
         user_id=current_user.id
     )
     db.session.add(payment)
-    db.session.commit()
     
     # Update shop's due amounts
     shop = Shop.query.get(shop_id)
     if shop:
-        # Find pending sales and apply payment
-        pending_sales = Sale.query.filter_by(
-            shop_id=shop_id, 
-            payment_status='pending'
-        ).order_by(Sale.date.asc()).all()
+        # Apply the payment to unpaid bills, oldest first, reading bill headers until it runs out
+        unpaid_invoices = Invoice.query.filter(
+            Invoice.user_id == current_user.id,
+            Invoice.shop_id == shop.id,
+            Invoice.payment_status.in_(['pending', 'partial'])
+        ).order_by(Invoice.date, Invoice.id)
         
         remaining_amount = amount
-        for sale in pending_sales:
+        for invoice in unpaid_invoices:
             if remaining_amount <= 0:
                 break
-                
-            if sale.due_amount > 0:
-                payment_amount = min(remaining_amount, sale.due_amount)
+            invoice_amount = min(remaining_amount, invoice.due_amount)
+            remaining_amount -= invoice_amount
+            
+            # Spread it over the bill's unpaid sales so each sale keeps its own balance
+            left = invoice_amount
+            for sale in Sale.query.filter(Sale.invoice_id == invoice.id, Sale.due_amount > 0).order_by(Sale.id):
+                if left <= 0:
+                    break
+                payment_amount = min(left, sale.due_amount)
                 sale.paid_amount += payment_amount
                 sale.due_amount -= payment_amount
                 
-                if sale.due_amount == 0:
+                if sale.due_amount < 0.01:
                     sale.payment_status = 'paid'
+                    sale.due_amount = 0
                 else:
                     sale.payment_status = 'partial'
                 
-                remaining_amount -= payment_amount
-        
-        db.session.commit()
+                left -= payment_amount
+            adjust_invoice(invoice.id, paid=invoice_amount - left, due=left - invoice_amount)
+            remaining_amount += left
+        
+        applied_amount = amount - remaining_amount
+        adjust_shop_balance(current_user.id, shop_id, paid=applied_amount, outstanding=-applied_amount)
+    
+    dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
+    message = f'Payment of PKR {amount:,.2f} added successfully!'
+    result_url = url_for('shop_details', shop_id=shop_id)
+    db.session.flush()
+    save_idempotent_result(idempotency, result_url, message, [payment.id])
+    db.session.commit()
+    update_dashboard_cache(current_user.id, dashboard_version)
     
-    flash(f'Payment of PKR {amount:,.2f} added successfully!', 'success')
-    return redirect(url_for('shop_details', shop_id=shop_id))
+    flash(message, 'success')
+    return redirect(result_url)
+
+# Receivables aging: outstanding shop bills by age of the due date (or bill date when no due date was set)
+AGING_PAGE_SIZE = 24
+AGING_SORTS = {
+    'exposure': lambda aging: [aging.c.total_due.desc()],
+    'oldest': lambda aging: [aging.c.due_over_90.desc(), aging.c.due_61_90.desc(), aging.c.total_due.desc()],
+    'overdue': lambda aging: [aging.c.overdue_bills.desc(), aging.c.total_due.desc()],
+}
+
+def receivables_aging(user_id, now=None):
+    """Subquery with one row per shop: 0-30/31-60/61-90/90+ day buckets, total due and overdue bill count"""
+    now = now or datetime.now()
+    reference_date = db.func.coalesce(Invoice.due_date, Invoice.date)
+    
+    def bucket(condition):
+        return db.func.sum(db.case((condition, Invoice.due_amount), else_=0))
+    
+    return db.session.query(
+        Invoice.shop_id.label('shop_id'),
+        db.func.sum(Invoice.due_amount).label('total_due'),
+        bucket(reference_date >= now - timedelta(days=30)).label('due_0_30'),
+        bucket(db.and_(reference_date < now - timedelta(days=30), reference_date >= now - timedelta(days=60))).label('due_31_60'),
+        bucket(db.and_(reference_date < now - timedelta(days=60), reference_date >= now - timedelta(days=90))).label('due_61_90'),
+        bucket(reference_date < now - timedelta(days=90)).label('due_over_90'),
+        db.func.sum(db.case((db.and_(Invoice.due_amount > 0, Invoice.due_date < now), 1), else_=0)).label('overdue_bills')
+    ).filter(
+        Invoice.user_id == user_id,
+        Invoice.payment_status.in_(['pending', 'partial']),
+        Invoice.shop_id.isnot(None)
+    ).group_by(Invoice.shop_id).subquery()
 
 @app.route('/pending_payments')
 @login_required
 def pending_payments():
     """View all pending payments"""
     try:
-        # Get all shops with pending payments (filtered by user)
-        shops_with_pending = db.session.query(Shop).select_from(Shop).join(Sale, Shop.id == Sale.shop_id).filter(
-            Sale.payment_status.in_(['pending', 'partial']),
-            Sale.user_id == current_user.id
-        ).distinct().all()
-        
-        # Calculate pending amounts for each shop (filtered by user)
-        shop_pending_data = []
-        for shop in shops_with_pending:
-            total_due = db.session.query(db.func.sum(Sale.due_amount)).filter(
-                Sale.shop_id == shop.id,
-                Sale.user_id == current_user.id
-            ).scalar() or 0
-            
-            overdue_sales = Sale.query.filter(
-                Sale.shop_id == shop.id,
-                Sale.user_id == current_user.id,
-                Sale.due_amount > 0,
-                Sale.due_date < datetime.now()
-            ).count()
-            
-            shop_pending_data.append({
-                'shop': shop,
-                'total_due': total_due,
-                'overdue_sales': overdue_sales
-            })
-        
-        return render_template('pending_payments.html', shop_pending_data=shop_pending_data)
+        sort = request.args.get('sort', 'exposure')
+        if sort not in AGING_SORTS:
+            sort = 'exposure'
+        aging = receivables_aging(current_user.id)
+        summary = db.session.query(
+            db.func.count(aging.c.shop_id),
+            db.func.coalesce(db.func.sum(aging.c.total_due), 0),
+            db.func.coalesce(db.func.sum(db.case((aging.c.overdue_bills > 0, 1), else_=0)), 0),
+            db.func.coalesce(db.func.sum(aging.c.overdue_bills), 0)
+        ).one()
+        pages = max(math.ceil(summary[0] / AGING_PAGE_SIZE), 1)
+        page = min(max(request.args.get('page', 1, type=int), 1), pages)
+        
+        rows = db.session.query(Shop, aging).join(aging, aging.c.shop_id == Shop.id).order_by(
+            *AGING_SORTS[sort](aging), Shop.id
+        ).limit(AGING_PAGE_SIZE).offset((page - 1) * AGING_PAGE_SIZE).all()
+        
+        shop_pending_data = [{
+            'shop': row.Shop,
+            'total_due': row.total_due or 0,
+            'overdue_bills': row.overdue_bills or 0,
+            'buckets': [row.due_0_30 or 0, row.due_31_60 or 0, row.due_61_90 or 0, row.due_over_90 or 0]
+        } for row in rows]
+        
+        return render_template('pending_payments.html',
+                             shop_pending_data=shop_pending_data,
+                             summary={
+                                 'shops': summary[0],
+                                 'total_due': summary[1],
+                                 'overdue_shops': summary[2],
+                                 'overdue_bills': summary[3]
+                             },
+                             sort=sort,
+                             page=page,
+                             pages=pages)
     except Exception as e:
         # Return empty data if there's an error
-        return render_template('pending_payments.html', shop_pending_data=[])
+        return render_template('pending_payments.html', shop_pending_data=[],
+                             summary={'shops': 0, 'total_due': 0, 'overdue_shops': 0, 'overdue_bills': 0},
+                             sort='exposure', page=1, pages=1)
 
 @app.route('/add_incentive', methods=['POST'])
 @login_required
@@ -1439,54 +3191,176 @@ def add_incentive():
         user_id=current_user.id
     )
     db.session.add(incentive)
+    add_incentive_to_rollup(incentive)
+    dashboard_version = bump_cache_version(dashboard_cache_key(current_user.id))
     db.session.commit()
+    update_dashboard_cache(current_user.id, dashboard_version, incentives=[
+        {'amount': amount, 'month': month, 'year': year}
+    ])
     
     flash('Incentive added successfully!', 'success')
     return redirect(url_for('incentives'))
 
+# The ledger merges purchases and sales into one keyset-paged timeline with running totals
+LEDGER_PAGE_SIZE = 50
+LEDGER_RUNNING = ('stock', 'balance', 'profit')  # Carried in the page cursors
+
+def encode_ledger_cursor(row, running):
+    return '|'.join([row.date.isoformat(), row.kind, str(row.id)] + [repr(running[name]) for name in LEDGER_RUNNING])
+
+def decode_ledger_cursor(value):
+    """((date, kind, id), running totals at that entry) from a ledger cursor, or None when malformed"""
+    parts = (value or '').split('|')
+    if len(parts) != 3 + len(LEDGER_RUNNING) or parts[1] not in ('purchase', 'sale'):
+        return None
+    try:
+        key = (datetime.fromisoformat(parts[0]), parts[1], int(parts[2]))
+        return key, dict(zip(LEDGER_RUNNING, map(float, parts[3:])))
+    except ValueError:
+        return None
+
+def ledger_branches(user_id, model_ids, period):
+    """Purchase and sale selects with the ledger columns: purchases add stock and cost, sales remove stock and earn"""
+    purchases = db.select(
+        db.literal('purchase').label('kind'), Purchase.id.label('id'), Purchase.date.label('date'),
+        Purchase.model_id.label('model_id'), Purchase.inventory_type.label('inventory_type'),
+        db.cast(db.null(), db.String).label('imei'), Purchase.quantity.label('stock'),
+        (-Purchase.purchase_price * Purchase.quantity).label('balance'), db.literal(0.0).label('profit')
+    ).where(Purchase.user_id == user_id, period_filter(Purchase.date, period))
+    sales = db.select(
+        db.literal('sale').label('kind'), Sale.id.label('id'), Sale.date.label('date'),
+        Sale.model_id.label('model_id'), Sale.inventory_type.label('inventory_type'),
+        Sale.imei_number.label('imei'), db.literal(-1).label('stock'),
+        Sale.sale_price.label('balance'), Sale.profit.label('profit')
+    ).where(Sale.user_id == user_id, period_filter(Sale.date, period))
+    if model_ids is not None:
+        purchases = purchases.where(Purchase.model_id.in_(model_ids))
+        sales = sales.where(Sale.model_id.in_(model_ids))
+    return {'purchase': (purchases, Purchase), 'sale': (sales, Sale)}
+
+def ledger_page(branches, closing, before=None, after=None):
+    """One page of ledger entries, newest first, with running stock, balance and profit after each entry"""
+    cursor = after or before
+    parts = []
+    for kind, (select, model_class) in branches.items():
+        # Push the keyset predicate and limit into each branch so both use their (user_id, date) index
+        if cursor:
+            (date, cursor_kind, entry_id), _ = cursor
+            older = not after
+            same_date = model_class.date == date
+            newer_date = model_class.date > date if after else model_class.date < date
+            if kind == cursor_kind:
+                tie = model_class.id > entry_id if after else model_class.id < entry_id
+                select = select.where(db.or_(newer_date, db.and_(same_date, tie)))
+            elif (kind < cursor_kind) == older:
+                select = select.where(db.or_(newer_date, same_date))
+            else:
+                select = select.where(newer_date)
+        order = [model_class.date, model_class.id] if after else [model_class.date.desc(), model_class.id.desc()]
+        parts.append(db.select(select.order_by(*order).limit(LEDGER_PAGE_SIZE + 1).subquery()))
+    entries = db.union_all(*parts).subquery()
+    
+    # Running totals: window sums over the page, offset by the totals carried in from the neighbouring page
+    if after:
+        order = [entries.c.date, entries.c.kind, entries.c.id]
+        base = cursor[1]
+        running = [(db.literal(base[name]) + db.func.sum(entries.c[name]).over(order_by=order, rows=(None, 0)))
+                   .label(f'running_{name}') for name in LEDGER_RUNNING]
+    else:
+        order = [entries.c.date.desc(), entries.c.kind.desc(), entries.c.id.desc()]
+        top = before[1] if before else closing
+        running = [(db.literal(top[name]) - db.func.coalesce(
+                        db.func.sum(entries.c[name]).over(order_by=order, rows=(None, -1)), 0))
+                   .label(f'running_{name}') for name in LEDGER_RUNNING]
+    
+    rows = db.session.execute(
+        db.select(entries, Model.name.label('model'), Brand.name.label('brand'), *running)
+        .join(Model, Model.id == entries.c.model_id)
+        .join(Brand, Brand.id == Model.brand_id)
+        .order_by(*order).limit(LEDGER_PAGE_SIZE + 1)
+    ).all()
+    has_more = len(rows) > LEDGER_PAGE_SIZE
+    rows = rows[:LEDGER_PAGE_SIZE]
+    if after:
+        rows.reverse()
+    
+    newer = older = None
+    if rows and (before or (after and has_more)):
+        first = rows[0]
+        newer = encode_ledger_cursor(first, {name: getattr(first, f'running_{name}') for name in LEDGER_RUNNING})
+    if rows and (after or has_more):
+        last = rows[-1]
+        older = encode_ledger_cursor(last, {name: getattr(last, f'running_{name}') - getattr(last, name)
+                                            for name in LEDGER_RUNNING})
+    return {'rows': rows, 'newer': newer, 'older': older}
+
 @app.route('/ledger')
 @login_required
 def shop_ledger():
-    """Shop ledger with all transactions"""
+    """Shop ledger: purchases and sales on one paged timeline with running totals"""
     # Require profit verification since ledger shows profit totals
     if not session.get('profit_verified'):
         return redirect(url_for('profits'))
-    brand_filter = request.args.get('brand')
-    model_filter = request.args.get('model')
-    
-    # Get all transactions (filtered by user)
-    purchases = Purchase.query.filter_by(user_id=current_user.id)
-    sales = Sale.query.filter_by(user_id=current_user.id)
-    
-    if brand_filter:
-        purchases = purchases.join(Model).filter(Model.brand_id == brand_filter)
-        sales = sales.join(Model).filter(Model.brand_id == brand_filter)
+    brand_filter = request.args.get('brand', type=int)
+    model_filter = request.args.get('model', type=int)
+    try:
+        period = period_from_request(default='all')
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('shop_ledger'))
     
+    # Brand and model filters become model_id IN (...) so the (user_id, model_id, date) indexes apply
+    model_ids = None
     if model_filter:
-        purchases = purchases.filter(Purchase.model_id == model_filter)
-        sales = sales.filter(Sale.model_id == model_filter)
+        model_ids = [model_filter]
+    elif brand_filter:
+        model_ids = [model_id for model_id, in db.session.query(Model.id).filter(Model.brand_id == brand_filter)]
+    branches = ledger_branches(current_user.id, model_ids, period)
+    
+    # Period totals, which are also the running totals after the newest entry
+    purchases = branches['purchase'][0].subquery()
+    sales = branches['sale'][0].subquery()
+    purchase_count, units_bought, purchase_cost = db.session.execute(db.select(
+        db.func.count(), db.func.coalesce(db.func.sum(purchases.c.stock), 0),
+        db.func.coalesce(-db.func.sum(purchases.c.balance), 0)
+    ).select_from(purchases)).one()
+    sale_count, sales_revenue, total_sales_profit = db.session.execute(db.select(
+        db.func.count(), db.func.coalesce(db.func.sum(sales.c.balance), 0),
+        db.func.coalesce(db.func.sum(sales.c.profit), 0)
+    ).select_from(sales)).one()
+    incentives = db.session.query(db.func.coalesce(db.func.sum(Incentive.amount), 0)).filter(
+        Incentive.user_id == current_user.id,
+        month_period_filter(Incentive.year, Incentive.month, period)
+    )
+    if brand_filter:
+        incentives = incentives.filter(Incentive.brand_id == brand_filter)
+    total_incentives = incentives.scalar()
+    closing = {'stock': units_bought - sale_count, 'balance': sales_revenue - purchase_cost,
+               'profit': total_sales_profit}
     
-    purchases = purchases.order_by(Purchase.date.desc()).all()
-    sales = sales.order_by(Sale.date.desc()).all()
+    page = ledger_page(branches, closing,
+                       before=decode_ledger_cursor(request.args.get('before')),
+                       after=decode_ledger_cursor(request.args.get('after')))
     
-    brands = Brand.query.all()
-    models = Model.query.all()
-    
-    # Calculate profit totals (filtered by user)
-    total_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-        Sale.user_id == current_user.id
-    ).scalar() or 0
-    total_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-        Incentive.user_id == current_user.id
-    ).scalar() or 0
+    brands = Brand.query.order_by(Brand.name).all()
+    models = Model.query.options(db.joinedload(Model.brand)).order_by(Model.name)
+    if brand_filter:
+        models = models.filter(Model.brand_id == brand_filter)
     
     return render_template('ledger.html', 
-                         purchases=purchases, 
-                         sales=sales, 
+                         entries=page['rows'],
+                         newer_cursor=page['newer'],
+                         older_cursor=page['older'],
                          brands=brands, 
-                         models=models,
+                         models=models.all(),
                          selected_brand=brand_filter,
                          selected_model=model_filter,
+                         period=period,
+                         report_periods=REPORT_PERIODS,
+                         purchase_count=purchase_count,
+                         sale_count=sale_count,
+                         purchase_cost=purchase_cost,
+                         sales_revenue=sales_revenue,
                          total_sales_profit=total_sales_profit,
                          total_incentives=total_incentives)
 
@@ -1497,6 +3371,11 @@ def export_report():
     # Require profit verification
     if not session.get('profit_verified'):
         return redirect(url_for('profits'))
+    try:
+        period = period_from_request()
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('profits_detailed'))
     # Create PDF
     pdf = FPDF()
     pdf.add_page()
@@ -1507,43 +3386,31 @@ def export_report():
     pdf.ln(10)
     
     # Summary
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    
-    total_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-        Sale.user_id == current_user.id
-    ).scalar() or 0
-    monthly_sales_profit = db.session.query(db.func.sum(Sale.profit)).filter(
-        Sale.user_id == current_user.id,
-        db.extract('month', Sale.date) == current_month,
-        db.extract('year', Sale.date) == current_year
-    ).scalar() or 0
-    
-    total_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-        Incentive.user_id == current_user.id
-    ).scalar() or 0
-    monthly_incentives = db.session.query(db.func.sum(Incentive.amount)).filter(
-        Incentive.user_id == current_user.id,
-        Incentive.month == current_month,
-        Incentive.year == current_year
-    ).scalar() or 0
+    profits = profit_summary(current_user.id, period)
+    total_sales_profit = profits['total_sales_profit']
+    monthly_sales_profit = profits['monthly_sales_profit']
+    total_incentives = profits['total_incentives']
+    monthly_incentives = profits['monthly_incentives']
     
     pdf.set_font('Arial', 'B', 14)
     pdf.cell(0, 10, 'Profit Summary', ln=True)
     pdf.set_font('Arial', '', 12)
     pdf.cell(0, 8, f'Total Sales Profit: PKR {total_sales_profit:,.2f}', ln=True)
-    pdf.cell(0, 8, f'Monthly Sales Profit: PKR {monthly_sales_profit:,.2f}', ln=True)
+    pdf.cell(0, 8, f'Sales Profit ({period["label"]}): PKR {monthly_sales_profit:,.2f}', ln=True)
     pdf.cell(0, 8, f'Total Incentives: PKR {total_incentives:,.2f}', ln=True)
-    pdf.cell(0, 8, f'Monthly Incentives: PKR {monthly_incentives:,.2f}', ln=True)
+    pdf.cell(0, 8, f'Incentives ({period["label"]}): PKR {monthly_incentives:,.2f}', ln=True)
     pdf.cell(0, 8, f'Total Profit (including incentives): PKR {(total_sales_profit + total_incentives):,.2f}', ln=True)
     pdf.ln(10)
     
     # Recent Sales
     pdf.set_font('Arial', 'B', 14)
-    pdf.cell(0, 10, 'Recent Sales', ln=True)
+    pdf.cell(0, 10, f'Recent Sales ({period["label"]})', ln=True)
     pdf.set_font('Arial', '', 10)
     
-    recent_sales = Sale.query.order_by(Sale.date.desc()).limit(10).all()
+    recent_sales = Sale.query.filter(
+        Sale.user_id == current_user.id,
+        period_filter(Sale.date, period)
+    ).order_by(Sale.date.desc()).limit(10).all()
     for sale in recent_sales:
         pdf.cell(0, 6, f'{sale.date.strftime("%Y-%m-%d")} - {sale.model.brand.name} {sale.model.name} - IMEI: {sale.imei_number} - Profit: PKR {sale.profit:.2f}', ln=True)
     
@@ -1605,60 +3472,119 @@ def logout():
     logout_user()
     return redirect(url_for('login'))
 
+# Inventory is filtered, counted and paged in the database; the page fetches it as JSON
+INVENTORY_PAGE_SIZE = 24
+INVENTORY_STATUSES = {'all': None, 'available': 'in_stock', 'sold': 'sold'}
+
+def filtered_device_units(user_id, args, ignore=()):
+    """Device units joined to their purchase and model, narrowed by the filter arguments not in `ignore`"""
+    period = report_period(args.get('period') or 'all', args.get('start'), args.get('end'))
+    query = db.session.query(DeviceUnit).join(
+        Purchase, DeviceUnit.purchase_id == Purchase.id
+    ).join(
+        Model, DeviceUnit.model_id == Model.id
+    ).filter(
+        DeviceUnit.user_id == user_id,
+        DeviceUnit.status != 'superseded',
+        period_filter(Purchase.date, period)
+    )
+    for name, column in (('brand_id', Model.brand_id), ('model_id', DeviceUnit.model_id),
+                         ('supplier_id', Purchase.supplier_id)):
+        value = args.get(name, type=int)
+        if value and name not in ignore:
+            query = query.filter(column == value)
+    return query
+
 @app.route('/inventory')
 @login_required
 def inventory():
-    """Show all inventory items with complete details"""
+    """Inventory page; the items are loaded page by page from inventory_data"""
+    brands = Brand.query.order_by(Brand.name).all()
+    models = Model.query.order_by(Model.name).all()
+    models_by_brand = {}
+    for model in models:
+        models_by_brand.setdefault(model.brand_id, []).append({'id': model.id, 'name': model.name})
+    return render_template('inventory.html',
+                         brands=brands,
+                         models_by_brand=models_by_brand,
+                         suppliers=Supplier.query.order_by(Supplier.name).all(),
+                         report_periods=REPORT_PERIODS)
+
+@app.route('/inventory/data')
+@login_required
+def inventory_data():
+    """One page of inventory as JSON with counts, e.g. ?status=available&brand_id=1&period=this_month&page=2"""
+    status = request.args.get('status', 'all')
+    if status not in INVENTORY_STATUSES:
+        return jsonify({'error': f'Unknown status: {status}'}), 400
     try:
-        # Get all purchases for current user
-        purchases = Purchase.query.filter_by(user_id=current_user.id).order_by(Purchase.date.desc()).all()
-        
-        # Process each purchase to get detailed information
-        inventory_items = []
-        for purchase in purchases:
-            try:
-                imei_list = json.loads(purchase.imei_numbers)
-                
-                # Get model and brand info
-                model = Model.query.get(purchase.model_id) if purchase.model_id else None
-                brand = Brand.query.get(model.brand_id) if model and model.brand_id else None
-                
-                # Get supplier info
-                supplier = Supplier.query.get(purchase.supplier_id) if purchase.supplier_id else None
-                
-                # Check status for each IMEI
-                for imei in imei_list:
-                    # Check if sold
-                    sale = Sale.query.filter_by(
-                        imei_number=imei,
-                        user_id=current_user.id
-                    ).first()
-                    
-                    inventory_items.append({
-                        'imei': imei,
-                        'purchase': purchase,
-                        'model': model,
-                        'brand': brand,
-                        'supplier': supplier,
-                        'sale': sale,
-                        'status': 'Sold' if sale else 'Available',
-                        'purchase_date': purchase.date,
-                        'sale_date': sale.date if sale else None,
-                        'profit': sale.profit if sale else None
-                    })
-            except (json.JSONDecodeError, TypeError) as e:
-                print(f"Error processing purchase {purchase.id}: {e}")
-                continue
-        
-        # Sort by purchase date (newest first)
-        inventory_items.sort(key=lambda x: x['purchase_date'], reverse=True)
-        
-        return render_template('inventory.html', inventory_items=inventory_items)
-        
-    except Exception as e:
-        print(f"Error in inventory route: {e}")
-        flash('Error loading inventory. Please try again.', 'error')
-        return redirect(url_for('dashboard'))
+        units = filtered_device_units(current_user.id, request.args)
+        brand_units = filtered_device_units(current_user.id, request.args, ignore=('brand_id', 'model_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    show_profit = bool(session.get('profit_verified'))
+    in_stock = db.case((DeviceUnit.status == 'in_stock', 1), else_=0)
+    
+    # Counts for the current filters, before the status filter
+    total, available, profit = units.outerjoin(Sale, DeviceUnit.sale_id == Sale.id).with_entities(
+        db.func.count(DeviceUnit.id),
+        db.func.coalesce(db.func.sum(in_stock), 0),
+        db.func.coalesce(db.func.sum(Sale.profit), 0)
+    ).one()
+    matching = {'all': total, 'available': available, 'sold': total - available}[status]
+    pages = max(math.ceil(matching / INVENTORY_PAGE_SIZE), 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+    
+    # Brand breakdown ignores the brand and model filters so every brand stays selectable
+    brand_counts = brand_units.join(Brand, Model.brand_id == Brand.id).with_entities(
+        Brand.id, Brand.name, db.func.count(DeviceUnit.id), db.func.coalesce(db.func.sum(in_stock), 0)
+    ).group_by(Brand.id, Brand.name).order_by(Brand.name).all()
+    
+    if INVENTORY_STATUSES[status]:
+        units = units.filter(DeviceUnit.status == INVENTORY_STATUSES[status])
+    rows = units.join(
+        Brand, Model.brand_id == Brand.id
+    ).outerjoin(
+        Supplier, Purchase.supplier_id == Supplier.id
+    ).outerjoin(
+        Sale, DeviceUnit.sale_id == Sale.id
+    ).with_entities(
+        DeviceUnit.imei, DeviceUnit.status, Purchase.date.label('purchase_date'), Purchase.purchase_price,
+        Purchase.bill_number, Model.name.label('model'), Brand.name.label('brand'), Supplier.name.label('supplier'),
+        Sale.id.label('sale_id'), Sale.date.label('sale_date'), Sale.sale_price, Sale.profit
+    ).order_by(
+        DeviceUnit.purchase_id.desc(), DeviceUnit.position
+    ).limit(INVENTORY_PAGE_SIZE).offset((page - 1) * INVENTORY_PAGE_SIZE).all()
+    
+    return jsonify({
+        'items': [{
+            'imei': row.imei,
+            'status': 'Sold' if row.status == 'sold' else 'Available',
+            'brand': row.brand,
+            'model': row.model,
+            'purchase_date': row.purchase_date.strftime('%d/%m/%Y') if row.purchase_date else None,
+            'purchase_price': row.purchase_price,
+            'bill_number': row.bill_number,
+            'supplier': row.supplier,
+            'sale_id': row.sale_id,
+            'sale_date': row.sale_date.strftime('%d/%m/%Y') if row.sale_date else None,
+            'sale_price': row.sale_price,
+            'profit': row.profit if show_profit else None
+        } for row in rows],
+        'counts': {
+            'total': total,
+            'available': available,
+            'sold': total - available,
+            'profit': profit if show_profit else None
+        },
+        'brands': [
+            {'id': brand_id, 'name': name, 'total': count, 'available': brand_available,
+             'sold': count - brand_available}
+            for brand_id, name, count, brand_available in brand_counts
+        ],
+        'page': page,
+        'pages': pages
+    })
 
 if __name__ == '__main__':
     with app.app_context():
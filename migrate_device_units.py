@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Migration Script: Backfill device_unit table from Purchase.imei_numbers
+Creates one DeviceUnit row per IMEI stored in the purchase JSON column and links
+sold units to their Sale rows. Saved IMEI Bloom filters are dropped afterwards so
+they are rebuilt from the backfilled units. Safe to run more than once - already migrated
+purchases and sales are skipped. Work is done in batches to keep memory flat.
+"""
+
+import os
+import sys
+import json
+from collections import Counter, defaultdict, deque
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app import app, db, Purchase, Sale, DeviceUnit, ImeiFilter, StockLevel, IMEI_MAX_LENGTH, drop_imei_filter
+
+BATCH_SIZE = 500
+
+def create_device_unit_table():
+    """Create the device_unit table if it doesn't exist."""
+    from sqlalchemy import inspect
+    inspector = inspect(db.engine)
+    if 'device_unit' in inspector.get_table_names():
+        print("✅ device_unit table already exists")
+    else:
+        db.create_all()
+        print("✅ device_unit table created")
+
+def add_reversed_imei_column():
+    """Add and fill device_unit.imei_reversed on tables created before it existed."""
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    columns = [col['name'] for col in inspector.get_columns('device_unit')]
+
+    if 'imei_reversed' not in columns:
+        db.session.execute(text(f'ALTER TABLE device_unit ADD COLUMN imei_reversed VARCHAR({IMEI_MAX_LENGTH})'))
+        db.session.execute(text('CREATE INDEX ix_device_unit_user_imei_reversed ON device_unit (user_id, imei_reversed)'))
+        db.session.commit()
+        print("✅ Added imei_reversed column")
+
+    last_id = 0
+    filled = 0
+    while True:
+        units = DeviceUnit.query.filter(
+            DeviceUnit.id > last_id,
+            DeviceUnit.imei_reversed.is_(None)
+        ).order_by(DeviceUnit.id).limit(BATCH_SIZE).all()
+        if not units:
+            break
+        db.session.bulk_update_mappings(DeviceUnit, [
+            {'id': unit.id, 'imei_reversed': unit.imei[::-1]} for unit in units
+        ])
+        db.session.commit()
+        filled += len(units)
+        last_id = units[-1].id
+
+    if filled:
+        print(f"✅ Filled imei_reversed for {filled} units")
+
+def backfill_units():
+    """Pass 1: one in-stock unit per IMEI for every purchase without units."""
+    migrated_ids = db.session.query(DeviceUnit.purchase_id).distinct()
+    last_id = 0
+    created = 0
+    skipped = 0
+
+    while True:
+        purchases = Purchase.query.filter(
+            Purchase.id > last_id,
+            ~Purchase.id.in_(migrated_ids)
+        ).order_by(Purchase.id).limit(BATCH_SIZE).all()
+        if not purchases:
+            break
+
+        rows = []
+        for purchase in purchases:
+            try:
+                imei_list = json.loads(purchase.imei_numbers)
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"⚠️  Skipping purchase {purchase.id}: {e}")
+                skipped += 1
+                continue
+
+            for position, imei in enumerate(imei_list):
+                imei = str(imei).strip()
+                if not imei or len(imei) > IMEI_MAX_LENGTH:
+                    print(f"⚠️  Skipping IMEI '{imei}' in purchase {purchase.id}")
+                    skipped += 1
+                    continue
+                # stock_imei is filled in pass 3 once duplicates are known
+                rows.append({
+                    'imei': imei,
+                    'imei_reversed': imei[::-1],
+                    'stock_imei': None,
+                    'position': position,
+                    'purchase_id': purchase.id,
+                    'model_id': purchase.model_id,
+                    'status': 'in_stock',
+                    'user_id': purchase.user_id
+                })
+
+        if rows:
+            db.session.bulk_insert_mappings(DeviceUnit, rows)
+        db.session.commit()
+        created += len(rows)
+        last_id = purchases[-1].id
+        print(f"  ... purchases up to id {last_id}: {created} units")
+
+    print(f"✅ Created {created} device units ({skipped} skipped)")
+
+def link_sales():
+    """Pass 2: pair each sale with the oldest unsold unit of the same IMEI."""
+    linked_ids = db.session.query(DeviceUnit.sale_id).filter(DeviceUnit.sale_id.isnot(None))
+    last_id = 0
+    linked = 0
+    unmatched = 0
+
+    while True:
+        sales = Sale.query.filter(
+            Sale.id > last_id,
+            ~Sale.id.in_(linked_ids)
+        ).order_by(Sale.id).limit(BATCH_SIZE).all()
+        if not sales:
+            break
+
+        imeis = {sale.imei_number for sale in sales}
+        user_ids = {sale.user_id for sale in sales}
+        candidates = defaultdict(deque)
+        for unit in DeviceUnit.query.filter(
+            DeviceUnit.user_id.in_(user_ids),
+            DeviceUnit.imei.in_(imeis),
+            DeviceUnit.status == 'in_stock'
+        ).order_by(DeviceUnit.id).all():
+            candidates[(unit.user_id, unit.imei)].append(unit)
+
+        updates = []
+        for sale in sales:
+            queue = candidates.get((sale.user_id, sale.imei_number))
+            if not queue:
+                unmatched += 1
+                continue
+            unit = queue.popleft()
+            updates.append({'id': unit.id, 'status': 'sold', 'sale_id': sale.id, 'stock_imei': None})
+
+        if updates:
+            db.session.bulk_update_mappings(DeviceUnit, updates)
+        db.session.commit()
+        linked += len(updates)
+        last_id = sales[-1].id
+
+    print(f"✅ Linked {linked} sales to device units ({unmatched} sales without a purchase)")
+
+def fill_stock_imeis():
+    """Pass 3: set stock_imei on in-stock units; older duplicates of an in-stock IMEI are superseded."""
+    duplicates = db.session.query(
+        DeviceUnit.user_id, DeviceUnit.imei, db.func.max(DeviceUnit.id)
+    ).filter(
+        DeviceUnit.status == 'in_stock'
+    ).group_by(
+        DeviceUnit.user_id, DeviceUnit.imei
+    ).having(db.func.count(DeviceUnit.id) > 1).all()
+
+    older_duplicate_ids = set()
+    for user_id, imei, newest_id in duplicates:
+        print(f"⚠️  IMEI {imei} (user {user_id}) is in stock more than once - keeping unit {newest_id}, "
+              f"marking the older units superseded (check these purchases by hand)")
+        older_duplicate_ids.update(
+            unit_id for (unit_id,) in db.session.query(DeviceUnit.id).filter(
+                DeviceUnit.user_id == user_id,
+                DeviceUnit.imei == imei,
+                DeviceUnit.status == 'in_stock',
+                DeviceUnit.id != newest_id
+            )
+        )
+
+    # Out of stock, so the older copies are neither counted as available nor left unsellable in stock
+    superseded_ids = sorted(older_duplicate_ids)
+    superseded_counts = Counter()
+    for start in range(0, len(superseded_ids), BATCH_SIZE):
+        chunk = superseded_ids[start:start + BATCH_SIZE]
+        superseded_counts.update(db.session.query(
+            DeviceUnit.user_id, DeviceUnit.model_id, Purchase.inventory_type
+        ).join(Purchase, DeviceUnit.purchase_id == Purchase.id).filter(DeviceUnit.id.in_(chunk)).all())
+        DeviceUnit.query.filter(DeviceUnit.id.in_(chunk)).update(
+            {DeviceUnit.status: 'superseded', DeviceUnit.stock_imei: None}, synchronize_session=False
+        )
+    # Existing stock counters counted them as available (missing counters are built by reconcile_summaries.py)
+    for (user_id, model_id, inventory_type), count in superseded_counts.items():
+        StockLevel.query.filter_by(user_id=user_id, model_id=model_id, inventory_type=inventory_type).update(
+            {StockLevel.available: StockLevel.available - count}, synchronize_session=False
+        )
+    db.session.commit()
+
+    last_id = 0
+    filled = 0
+    while True:
+        units = DeviceUnit.query.filter(
+            DeviceUnit.id > last_id,
+            DeviceUnit.status == 'in_stock',
+            DeviceUnit.stock_imei.is_(None)
+        ).order_by(DeviceUnit.id).limit(BATCH_SIZE).all()
+        if not units:
+            break
+
+        updates = [{'id': unit.id, 'stock_imei': unit.imei} for unit in units]
+        db.session.bulk_update_mappings(DeviceUnit, updates)
+        db.session.commit()
+        filled += len(updates)
+        last_id = units[-1].id
+
+    print(f"✅ Marked {filled} units as in stock ({len(superseded_ids)} older duplicates superseded)")
+
+def reset_imei_filters():
+    """Drop saved IMEI filters built before the backfill, which would call backfilled IMEIs new."""
+    from sqlalchemy import inspect
+    if 'imei_filter' not in inspect(db.engine).get_table_names():
+        return
+    user_ids = [user_id for (user_id,) in db.session.query(ImeiFilter.user_id)]
+    for user_id in user_ids:
+        drop_imei_filter(user_id)
+    db.session.commit()
+    print(f"✅ Dropped {len(user_ids)} saved IMEI filters (rebuilt on next use)")
+
+def verify_migration():
+    """Compare IMEI counts between purchases and device units."""
+    total_imeis = 0
+    for (imei_numbers,) in db.session.query(Purchase.imei_numbers).yield_per(BATCH_SIZE):
+        try:
+            total_imeis += len(json.loads(imei_numbers))
+        except (json.JSONDecodeError, TypeError):
+            continue
+    total_units = DeviceUnit.query.count()
+    sold_units = DeviceUnit.query.filter_by(status='sold').count()
+
+    print(f"📊 IMEIs in purchases: {total_imeis}")
+    print(f"📊 Device units: {total_units} ({sold_units} sold)")
+    return total_imeis == total_units
+
+if __name__ == "__main__":
+    print("🚀 Device Unit Backfill Tool")
+    print("=" * 50)
+
+    try:
+        with app.app_context():
+            create_device_unit_table()
+            add_reversed_imei_column()
+            backfill_units()
+            link_sales()
+            fill_stock_imeis()
+            reset_imei_filters()
+
+            if verify_migration():
+                print("\n🎉 Migration completed successfully!")
+            else:
+                print("\n⚠️  Unit count differs from purchase IMEIs - see skipped entries above")
+    except Exception as e:
+        print(f"\n❌ Migration failed: {e}")
+        sys.exit(1)
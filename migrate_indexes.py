@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Migration Script: Create indexes declared on the models
+db.create_all() only adds indexes when it creates a table, so databases created
+before an index was added to app.py need this script. Indexes are grouped into
+numbered migrations; applied versions are recorded in the index_migration table
+and skipped on later runs. Any other declared index that is missing is created
+at the end, so it is safe to run after every update.
+
+Usage:
+    python migrate_indexes.py            # apply pending migrations
+    python migrate_indexes.py --explain  # also print query plans before and after
+
+Indexes later removed from app.py are listed in DROPPED_INDEXES with the
+migration that drops them; earlier migrations that listed them skip them.
+"""
+
+import os
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app import app, db, Sale, Purchase, Payment, Incentive, Model, DeviceUnit, Invoice
+
+# (version, description, index names declared in app.py)
+INDEX_MIGRATIONS = [
+    (1, 'IMEI lookups', [
+        'ix_device_unit_user_imei', 'ix_device_unit_user_imei_reversed', 'ix_sale_user_imei'
+    ]),
+    (2, 'Receivables aging', [
+        'ix_sale_user_status_due'
+    ]),
+    (3, 'Hot filter and join columns', [
+        'ix_sale_user_date', 'ix_sale_user_model_date', 'ix_sale_user_shop_date', 'ix_sale_user_bill',
+        'ix_purchase_user_date', 'ix_purchase_user_model_date',
+        'ix_payment_user_shop_date', 'ix_incentive_user_period', 'ix_model_brand_id'
+    ]),
+    (4, 'Inventory pages', [
+        'ix_device_unit_user_status', 'ix_device_unit_user_model'
+    ]),
+    (5, 'Drop sale aging index (aging reads invoice headers)', [
+        'ix_sale_user_status_due'
+    ]),
+]
+
+# {index name: (table name, version that drops it)} for indexes no longer declared in app.py
+DROPPED_INDEXES = {
+    'ix_sale_user_status_due': ('sale', 5),
+}
+
+migration_table = db.Table(
+    'index_migration', db.MetaData(),
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('description', db.String(200)),
+    db.Column('applied_at', db.DateTime)
+)
+
+def report_queries():
+    """Representative query shapes from the routes in app.py."""
+    user_id = 1
+    return [
+        ('dashboard: recent sales',
+         db.select(Sale.id).where(Sale.user_id == user_id).order_by(Sale.date.desc()).limit(5)),
+        ('dashboard: recent purchases',
+         db.select(Purchase.id).where(Purchase.user_id == user_id).order_by(Purchase.date.desc()).limit(5)),
+        ('transactions: bills page',
+         db.select(Invoice.id).where(Invoice.user_id == user_id).order_by(Invoice.date.desc(), Invoice.id.desc()).limit(20)),
+        ('transactions: model filter',
+         db.select(Sale.invoice_id).where(Sale.user_id == user_id, Sale.model_id == 1)),
+        ('ledger: purchases by model',
+         db.select(Purchase.id).where(Purchase.user_id == user_id, Purchase.model_id == 1).order_by(Purchase.date.desc())),
+        ('bill: sales on one bill',
+         db.select(Sale.id).where(Sale.invoice_id == 1).order_by(Sale.id)),
+        ('shop_details: recent sales',
+         db.select(Sale.id).where(Sale.user_id == user_id, Sale.shop_id == 1).order_by(Sale.date.desc()).limit(10)),
+        ('shop_details: recent payments',
+         db.select(Payment.id).where(Payment.user_id == user_id, Payment.shop_id == 1)
+         .order_by(Payment.payment_date.desc()).limit(10)),
+        ('pending_payments: aging',
+         db.select(Invoice.shop_id, db.func.sum(Invoice.due_amount))
+         .where(Invoice.user_id == user_id, Invoice.payment_status.in_(['pending', 'partial']))
+         .group_by(Invoice.shop_id)),
+        ('shop payment: unpaid bills',
+         db.select(Invoice.id).where(Invoice.user_id == user_id, Invoice.shop_id == 1,
+                                     Invoice.payment_status.in_(['pending', 'partial'])).order_by(Invoice.date)),
+        ('incentives: monthly total',
+         db.select(db.func.sum(Incentive.amount))
+         .where(Incentive.user_id == user_id, Incentive.year == 2025, Incentive.month == 1)),
+        ('sale: IMEI history',
+         db.select(Sale.id).where(Sale.user_id == user_id, Sale.imei_number == '123456789012345')),
+        ('search: device unit by IMEI',
+         db.select(DeviceUnit.id).where(DeviceUnit.user_id == user_id, DeviceUnit.imei == '123456789012345')),
+        ('brands: models of a brand',
+         db.select(Model.id).where(Model.brand_id == 1)),
+        ('inventory: available units page',
+         db.select(DeviceUnit.id).where(DeviceUnit.user_id == user_id, DeviceUnit.status == 'in_stock')
+         .order_by(DeviceUnit.purchase_id.desc()).limit(24)),
+        ('inventory: units of a model',
+         db.select(DeviceUnit.id).where(DeviceUnit.user_id == user_id, DeviceUnit.model_id == 1,
+                                        DeviceUnit.status == 'sold')),
+    ]
+
+def explain_report(title):
+    """Print the database's plan for each report query."""
+    dialect = db.engine.dialect.name
+    prefix = 'EXPLAIN QUERY PLAN' if dialect == 'sqlite' else 'EXPLAIN'
+    print(f"\n📋 {title} ({dialect})")
+    print("-" * 50)
+    with db.engine.connect() as conn:
+        for name, statement in report_queries():
+            sql = str(statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            rows = conn.execute(db.text(f'{prefix} {sql}')).mappings().all()
+            if dialect == 'sqlite':
+                plan = '; '.join(row['detail'] for row in rows)
+                uses_index = ' INDEX ' in plan or 'PRIMARY KEY' in plan
+            else:
+                plan = '; '.join(
+                    f"{row.get('table')}: {row.get('type')} key={row.get('key')} rows={row.get('rows')}"
+                    for row in rows
+                )
+                uses_index = all(row.get('key') for row in rows)
+            print(f"{'✅' if uses_index else '⚠️ '} {name}: {plan}")
+
+def declared_indexes():
+    """{index name: (table name, Index)} for every index declared on the models."""
+    return {
+        index.name: (table.name, index)
+        for table in db.metadata.sorted_tables
+        for index in table.indexes
+    }
+
+def create_index(index, table_name, existing_by_table):
+    """Create one index unless the database already has it."""
+    if index.name in existing_by_table.get(table_name, set()):
+        return False
+    print(f"🔧 Creating {index.name} on {table_name} ({', '.join(col.name for col in index.columns)})")
+    index.create(db.engine)
+    existing_by_table.setdefault(table_name, set()).add(index.name)
+    return True
+
+def drop_index(name, table_name, existing_by_table):
+    """Drop one index removed from the models, if the database still has it."""
+    if name not in existing_by_table.get(table_name, set()):
+        return False
+    print(f"🔧 Dropping {name} on {table_name}")
+    table = db.Table(table_name, db.MetaData(), autoload_with=db.engine)
+    next(index for index in table.indexes if index.name == name).drop(db.engine)
+    existing_by_table[table_name].discard(name)
+    return True
+
+def apply_index_migrations():
+    """Create (or drop) the indexes of every migration version not yet recorded."""
+    from sqlalchemy import inspect
+    migration_table.create(db.engine, checkfirst=True)
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    existing_by_table = {
+        name: {index['name'] for index in inspector.get_indexes(name)} for name in existing_tables
+    }
+    indexes = declared_indexes()
+
+    with db.engine.connect() as conn:
+        applied = {row.version for row in conn.execute(db.select(migration_table.c.version))}
+
+    for version, description, index_names in INDEX_MIGRATIONS:
+        if version in applied:
+            print(f"✅ Migration {version} ({description}) already applied")
+            continue
+
+        missing_tables = {
+            DROPPED_INDEXES[name][0] if name in DROPPED_INDEXES else indexes[name][0] for name in index_names
+        } - existing_tables
+        if missing_tables:
+            print(f"⚠️  Migration {version} needs tables {', '.join(sorted(missing_tables))} - run update_database.py first")
+            return False
+
+        print(f"🚀 Applying migration {version}: {description}")
+        for name in index_names:
+            if name in DROPPED_INDEXES:
+                table_name, dropped_in = DROPPED_INDEXES[name]
+                if version == dropped_in:
+                    drop_index(name, table_name, existing_by_table)
+                continue
+            table_name, index = indexes[name]
+            create_index(index, table_name, existing_by_table)
+
+        with db.engine.begin() as conn:
+            conn.execute(migration_table.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        print(f"✅ Migration {version} applied")
+    return True
+
+def create_missing_indexes():
+    """Create every other model index that is missing from the database."""
+    from sqlalchemy import inspect
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = 0
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            print(f"⚠️  Table {table.name} does not exist - run update_database.py first")
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            print(f"🔧 Creating {index.name} on {table.name} ({', '.join(col.name for col in index.columns)})")
+            index.create(db.engine)
+            created += 1
+
+    print(f"✅ Created {created} other missing indexes")
+    return True
+
+if __name__ == "__main__":
+    explain = len(sys.argv) > 1 and sys.argv[1] == '--explain'
+
+    print("🚀 Index Migration Tool")
+    print("=" * 50)
+
+    try:
+        with app.app_context():
+            if explain:
+                explain_report("Query plans before migration")
+            if apply_index_migrations():
+                create_missing_indexes()
+            if explain:
+                explain_report("Query plans after migration")
+    except Exception as e:
+        print(f"\n❌ Migration failed: {e}")
+        sys.exit(1)
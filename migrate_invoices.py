@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Migration Script: Backfill invoice headers for existing sales
+Creates the invoice table, adds sale.invoice_id and gives every sale a bill
+header. Sales sharing a bill number become one invoice with their totals;
+sales without a bill number get an invoice each. Safe to run more than once -
+sales that already have an invoice are skipped.
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app import app, db, Sale, Invoice, invoice_payment_status
+
+BATCH_SIZE = 500
+
+def create_invoice_table():
+    """Create the invoice table and the sale.invoice_id column if they don't exist."""
+    from sqlalchemy import inspect, text
+    inspector = inspect(db.engine)
+    if 'invoice' in inspector.get_table_names():
+        print("✅ invoice table already exists")
+    else:
+        db.create_all()
+        print("✅ invoice table created")
+
+    columns = [col['name'] for col in inspector.get_columns('sale')]
+    if 'invoice_id' not in columns:
+        db.session.execute(text('ALTER TABLE sale ADD COLUMN invoice_id INTEGER REFERENCES invoice (id)'))
+        db.session.execute(text('CREATE INDEX ix_sale_invoice_id ON sale (invoice_id)'))
+        db.session.commit()
+        print("✅ Added invoice_id column to sale")
+
+def backfill_numbered_bills():
+    """Pass 1: one invoice per (user, bill number) that has unlinked sales."""
+    bills = db.session.query(
+        Sale.user_id, Sale.bill_number,
+        db.func.min(Sale.date), db.func.max(Sale.due_date),
+        db.func.max(Sale.customer_type), db.func.max(Sale.customer_name), db.func.max(Sale.shop_id),
+        db.func.count(Sale.id), db.func.sum(Sale.sale_price),
+        db.func.sum(Sale.paid_amount), db.func.sum(Sale.due_amount)
+    ).filter(
+        Sale.invoice_id.is_(None),
+        Sale.bill_number.isnot(None)
+    ).group_by(Sale.user_id, Sale.bill_number).order_by(db.func.min(Sale.id)).all()
+
+    existing = {
+        (user_id, bill_number)
+        for user_id, bill_number in db.session.query(Invoice.user_id, Invoice.bill_number).filter(
+            Invoice.bill_number.isnot(None)
+        )
+    }
+
+    created = 0
+    rows = []
+    for (user_id, bill_number, date, due_date, customer_type, customer_name, shop_id,
+         item_count, total_amount, paid_amount, due_amount) in bills:
+        if (user_id, bill_number) in existing:
+            print(f"⚠️  Bill {bill_number} (user {user_id}) already has an invoice - "
+                  f"run reconcile_summaries.py --rebuild after this migration")
+            continue
+        rows.append({
+            'bill_number': bill_number,
+            'customer_type': customer_type,
+            'customer_name': customer_name,
+            'shop_id': shop_id,
+            'item_count': item_count,
+            'total_amount': total_amount or 0,
+            'paid_amount': paid_amount or 0,
+            'due_amount': due_amount or 0,
+            'payment_status': invoice_payment_status(paid_amount or 0, due_amount or 0),
+            'due_date': due_date,
+            'date': date,
+            'user_id': user_id
+        })
+        if len(rows) >= BATCH_SIZE:
+            db.session.bulk_insert_mappings(Invoice, rows)
+            db.session.commit()
+            created += len(rows)
+            rows = []
+    if rows:
+        db.session.bulk_insert_mappings(Invoice, rows)
+        db.session.commit()
+        created += len(rows)
+
+    # Link the sales to their header in one correlated UPDATE
+    header_id = db.select(Invoice.id).where(
+        Invoice.user_id == Sale.user_id,
+        Invoice.bill_number == Sale.bill_number
+    ).scalar_subquery()
+    linked = Sale.query.filter(
+        Sale.invoice_id.is_(None),
+        Sale.bill_number.isnot(None)
+    ).update({Sale.invoice_id: header_id}, synchronize_session=False)
+    db.session.commit()
+
+    print(f"✅ Created {created} invoices for numbered bills and linked {linked} sales")
+
+def backfill_single_sales():
+    """Pass 2: an invoice of its own for each sale without a bill number."""
+    created = 0
+    last_id = 0
+    while True:
+        sales = Sale.query.filter(
+            Sale.id > last_id,
+            Sale.invoice_id.is_(None),
+            Sale.bill_number.is_(None)
+        ).order_by(Sale.id).limit(BATCH_SIZE).all()
+        if not sales:
+            break
+
+        invoices = []
+        for sale in sales:
+            invoice = Invoice(
+                customer_type=sale.customer_type,
+                customer_name=sale.customer_name,
+                shop_id=sale.shop_id,
+                item_count=1,
+                total_amount=sale.sale_price,
+                paid_amount=sale.paid_amount or 0,
+                due_amount=sale.due_amount or 0,
+                payment_status=invoice_payment_status(sale.paid_amount or 0, sale.due_amount or 0),
+                due_date=sale.due_date,
+                date=sale.date,
+                user_id=sale.user_id
+            )
+            db.session.add(invoice)
+            invoices.append((sale, invoice))
+        db.session.flush()
+        for sale, invoice in invoices:
+            sale.invoice_id = invoice.id
+        db.session.commit()
+        created += len(invoices)
+        last_id = sales[-1].id
+
+    print(f"✅ Created {created} invoices for sales without a bill number")
+
+def verify_migration():
+    """Check that every sale has an invoice and the totals agree."""
+    unlinked = Sale.query.filter(Sale.invoice_id.is_(None)).count()
+    sale_total = db.session.query(db.func.coalesce(db.func.sum(Sale.sale_price), 0)).scalar()
+    invoice_total = db.session.query(db.func.coalesce(db.func.sum(Invoice.total_amount), 0)).scalar()
+
+    print(f"📊 Invoices: {Invoice.query.count()}")
+    print(f"📊 Sales without an invoice: {unlinked}")
+    print(f"📊 Sales total: PKR {sale_total:,.2f}, invoice total: PKR {invoice_total:,.2f}")
+    return unlinked == 0 and round(sale_total - invoice_total, 2) == 0
+
+if __name__ == "__main__":
+    print("🚀 Invoice Backfill Tool")
+    print("=" * 50)
+
+    try:
+        with app.app_context():
+            create_invoice_table()
+            backfill_numbered_bills()
+            backfill_single_sales()
+
+            if verify_migration():
+                print("\n🎉 Migration completed successfully!")
+            else:
+                print("\n⚠️  Invoice totals differ from sales - run python reconcile_summaries.py --rebuild")
+    except Exception as e:
+        print(f"\n❌ Migration failed: {e}")
+        sys.exit(1)
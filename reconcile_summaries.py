@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Maintenance Script: Verify or rebuild summary tables
+The stock_level counters, the profit_rollup table, the shop_balance table and the
+invoice header totals are updated in the same transaction as every purchase, sale,
+payment and incentive. This script recomputes them
+from the source rows and reports any drift. It also checks the fiscal periods in
+calendar_month against FISCAL_YEAR_START_MONTH, and that each saved IMEI Bloom
+filter contains every IMEI of its user's device units. Run with --rebuild to replace the
+stored values with the recomputed ones. Schedule it nightly, e.g.:
+
+    15 3 * * * cd /path/to/app && python reconcile_summaries.py --rebuild
+
+Usage:
+    python reconcile_summaries.py            # verify only
+    python reconcile_summaries.py --rebuild  # verify and fix drift
+"""
+
+import os
+import sys
+from collections import defaultdict
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from app import (app, db, Purchase, Sale, StockLevel, Model, Incentive, ProfitRollup, ShopBalance, CalendarMonth,
+                 Invoice, DeviceUnit, ImeiFilter, BloomFilter, drop_imei_filter,
+                 fiscal_year_of, fiscal_quarter_of, invoice_payment_status,
+                 INCENTIVE_ROLLUP_MODEL_ID, INCENTIVE_ROLLUP_INVENTORY_TYPE, INCENTIVE_ROLLUP_CUSTOMER_TYPE)
+
+ROLLUP_FIELDS = ('revenue', 'cost', 'profit', 'units', 'incentives')
+
+def expected_stock_levels():
+    """Recompute {(user_id, model_id, inventory_type): (purchased, sold, available)} from the source rows."""
+    expected = defaultdict(lambda: [0, 0, 0])
+    for user_id, model_id, inventory_type, purchased in db.session.query(
+        Purchase.user_id, Purchase.model_id, Purchase.inventory_type, db.func.sum(Purchase.quantity)
+    ).group_by(Purchase.user_id, Purchase.model_id, Purchase.inventory_type):
+        expected[(user_id, model_id, inventory_type)][0] = int(purchased or 0)
+
+    for user_id, model_id, inventory_type, sold in db.session.query(
+        Sale.user_id, Sale.model_id, Sale.inventory_type, db.func.count(Sale.id)
+    ).group_by(Sale.user_id, Sale.model_id, Sale.inventory_type):
+        expected[(user_id, model_id, inventory_type)][1] = int(sold)
+
+    # Superseded units (older duplicates found by migrate_device_units.py) are purchased but not available
+    for user_id, model_id, inventory_type, superseded in db.session.query(
+        DeviceUnit.user_id, DeviceUnit.model_id, Purchase.inventory_type, db.func.count(DeviceUnit.id)
+    ).join(Purchase, DeviceUnit.purchase_id == Purchase.id).filter(
+        DeviceUnit.status == 'superseded'
+    ).group_by(DeviceUnit.user_id, DeviceUnit.model_id, Purchase.inventory_type):
+        expected[(user_id, model_id, inventory_type)][2] = -int(superseded)
+
+    return {key: (purchased, sold, purchased - sold + adjustment)
+            for key, (purchased, sold, adjustment) in expected.items()}
+
+def reconcile_stock_levels(rebuild=False):
+    """Compare stock_level with purchases and sales; optionally fix the differences."""
+    expected = expected_stock_levels()
+    stored = {
+        (level.user_id, level.model_id, level.inventory_type): level
+        for level in StockLevel.query.all()
+    }
+
+    drift = 0
+    for key in sorted(set(expected) | set(stored), key=str):
+        purchased, sold, available = expected.get(key, (0, 0, 0))
+        level = stored.get(key)
+        current = (level.purchased, level.sold, level.available) if level else (0, 0, 0)
+        if current == (purchased, sold, available):
+            continue
+
+        drift += 1
+        user_id, model_id, inventory_type = key
+        print(f"⚠️  user {user_id}, model {model_id} ({inventory_type}): "
+              f"stored {current[0]}/{current[1]}/{current[2]}, "
+              f"expected {purchased}/{sold}/{available} (purchased/sold/available)")
+
+        if rebuild:
+            if level is None:
+                level = StockLevel(user_id=user_id, model_id=model_id, inventory_type=inventory_type)
+                db.session.add(level)
+            level.purchased = purchased
+            level.sold = sold
+            level.available = available
+
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Rebuilt {drift} stock counters")
+    elif drift:
+        print(f"❌ {drift} stock counters differ - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(stored)} stock counters match purchases and sales")
+    return drift == 0
+
+def ensure_profit_rollup_schema():
+    """Recreate profit_rollup if it predates the customer_type column (it only holds derived data)."""
+    from sqlalchemy import inspect
+    columns = [col['name'] for col in inspect(db.engine).get_columns('profit_rollup')]
+    if 'customer_type' not in columns:
+        ProfitRollup.__table__.drop(db.engine)
+        ProfitRollup.__table__.create(db.engine)
+        print("✅ Recreated profit_rollup with customer_type - run with --rebuild to fill it")
+
+def expected_profit_rollup():
+    """Recompute {(user_id, year, month, brand_id, model_id, inventory_type, customer_type): totals}."""
+    expected = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    sales = db.session.query(
+        Sale.user_id, Sale.date, Model.brand_id, Sale.model_id, Sale.inventory_type, Sale.customer_type,
+        Sale.sale_price, Sale.purchase_price, Sale.profit
+    ).join(Model, Model.id == Sale.model_id).yield_per(1000)
+    for user_id, date, brand_id, model_id, inventory_type, customer_type, sale_price, purchase_price, profit in sales:
+        totals = expected[(user_id, date.year, date.month, brand_id, model_id, inventory_type, customer_type or '')]
+        totals['revenue'] += sale_price
+        totals['cost'] += purchase_price
+        totals['profit'] += profit
+        totals['units'] += 1
+
+    for user_id, year, month, brand_id, amount in db.session.query(
+        Incentive.user_id, Incentive.year, Incentive.month, Incentive.brand_id, db.func.sum(Incentive.amount)
+    ).group_by(Incentive.user_id, Incentive.year, Incentive.month, Incentive.brand_id):
+        key = (user_id, year, month, brand_id, INCENTIVE_ROLLUP_MODEL_ID,
+               INCENTIVE_ROLLUP_INVENTORY_TYPE, INCENTIVE_ROLLUP_CUSTOMER_TYPE)
+        expected[key]['incentives'] += amount or 0
+
+    return expected
+
+def reconcile_profit_rollup(rebuild=False):
+    """Compare profit_rollup with sales and incentives; optionally fix the differences."""
+    expected = expected_profit_rollup()
+    stored = {
+        (row.user_id, row.year, row.month, row.brand_id, row.model_id, row.inventory_type, row.customer_type): row
+        for row in ProfitRollup.query.all()
+    }
+
+    drift = 0
+    for key in sorted(set(expected) | set(stored), key=str):
+        totals = expected.get(key, dict.fromkeys(ROLLUP_FIELDS, 0))
+        row = stored.get(key)
+        current = {field: getattr(row, field) if row else 0 for field in ROLLUP_FIELDS}
+        if all(round(current[field] - totals[field], 2) == 0 for field in ROLLUP_FIELDS):
+            continue
+
+        drift += 1
+        user_id, year, month, brand_id, model_id, inventory_type, customer_type = key
+        slice_name = f"{inventory_type}, {customer_type}" if model_id != INCENTIVE_ROLLUP_MODEL_ID else 'incentives'
+        print(f"⚠️  user {user_id}, {year}-{month:02d}, brand {brand_id}, model {model_id} ({slice_name}): "
+              f"stored {current}, expected {totals}")
+
+        if rebuild:
+            if row is None:
+                row = ProfitRollup(user_id=user_id, year=year, month=month, brand_id=brand_id,
+                                   model_id=model_id, inventory_type=inventory_type, customer_type=customer_type)
+                db.session.add(row)
+            for field in ROLLUP_FIELDS:
+                setattr(row, field, totals[field])
+
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Rebuilt {drift} profit rollup rows")
+    elif drift:
+        print(f"❌ {drift} profit rollup rows differ - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(stored)} profit rollup rows match sales and incentives")
+    return drift == 0
+
+def reconcile_shop_balances(rebuild=False):
+    """Compare shop_balance with the shop sales; optionally fix the differences."""
+    expected = {
+        (user_id, shop_id): (billed or 0, paid or 0, outstanding or 0)
+        for user_id, shop_id, billed, paid, outstanding in db.session.query(
+            Sale.user_id, Sale.shop_id,
+            db.func.sum(Sale.sale_price), db.func.sum(Sale.paid_amount), db.func.sum(Sale.due_amount)
+        ).filter(Sale.shop_id.isnot(None)).group_by(Sale.user_id, Sale.shop_id)
+    }
+    stored = {(balance.user_id, balance.shop_id): balance for balance in ShopBalance.query.all()}
+
+    drift = 0
+    for key in sorted(set(expected) | set(stored)):
+        totals = expected.get(key, (0, 0, 0))
+        balance = stored.get(key)
+        current = (balance.billed, balance.paid, balance.outstanding) if balance else (0, 0, 0)
+        if all(round(a - b, 2) == 0 for a, b in zip(current, totals)):
+            continue
+
+        drift += 1
+        user_id, shop_id = key
+        print(f"⚠️  user {user_id}, shop {shop_id}: stored {current}, expected {totals} (billed/paid/outstanding)")
+
+        if rebuild:
+            if balance is None:
+                balance = ShopBalance(user_id=user_id, shop_id=shop_id)
+                db.session.add(balance)
+            balance.billed, balance.paid, balance.outstanding = totals
+
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Rebuilt {drift} shop balances")
+    elif drift:
+        print(f"❌ {drift} shop balances differ - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(stored)} shop balances match shop sales")
+    return drift == 0
+
+def reconcile_invoices(rebuild=False):
+    """Compare the invoice header totals with their sales; optionally fix the differences."""
+    expected = {
+        invoice_id: (item_count, total or 0, paid or 0, due or 0)
+        for invoice_id, item_count, total, paid, due in db.session.query(
+            Sale.invoice_id, db.func.count(Sale.id),
+            db.func.sum(Sale.sale_price), db.func.sum(Sale.paid_amount), db.func.sum(Sale.due_amount)
+        ).filter(Sale.invoice_id.isnot(None)).group_by(Sale.invoice_id)
+    }
+    unlinked = Sale.query.filter(Sale.invoice_id.is_(None)).count()
+
+    invoices = Invoice.query.all()
+    drift = 0
+    for invoice in invoices:
+        totals = expected.get(invoice.id, (0, 0, 0, 0))
+        status = invoice_payment_status(totals[2], totals[3])
+        current = (invoice.item_count, invoice.total_amount, invoice.paid_amount, invoice.due_amount)
+        if current[0] == totals[0] and all(round(a - b, 2) == 0 for a, b in zip(current[1:], totals[1:])) \
+                and invoice.payment_status == status:
+            continue
+
+        drift += 1
+        print(f"⚠️  invoice {invoice.id} ({invoice.bill_number}): stored {current} {invoice.payment_status}, "
+              f"expected {totals} {status} (items/total/paid/due)")
+
+        if rebuild:
+            invoice.item_count, invoice.total_amount, invoice.paid_amount, invoice.due_amount = totals
+            invoice.payment_status = status
+
+    if unlinked:
+        print(f"⚠️  {unlinked} sales have no invoice - run python migrate_invoices.py")
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Rebuilt {drift} invoice headers")
+    elif drift:
+        print(f"❌ {drift} invoice headers differ - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(invoices)} invoice headers match their sales")
+    return drift == 0 and unlinked == 0
+
+def reconcile_calendar(rebuild=False):
+    """Compare the fiscal columns of calendar_month with the configured fiscal year start"""
+    start_month = app.config['FISCAL_YEAR_START_MONTH']
+    rows = CalendarMonth.query.all()
+    drift = 0
+    for row in rows:
+        fiscal_year = fiscal_year_of(row.year, row.month)
+        fiscal_quarter = fiscal_quarter_of(row.month)
+        if (row.fiscal_year, row.fiscal_quarter) == (fiscal_year, fiscal_quarter):
+            continue
+        drift += 1
+        if rebuild:
+            row.fiscal_year, row.fiscal_quarter = fiscal_year, fiscal_quarter
+
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Updated the fiscal period of {drift} calendar months")
+    elif drift:
+        print(f"❌ {drift} calendar months use another fiscal year start - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(rows)} calendar months match the fiscal year start (month {start_month})")
+    return drift == 0
+
+def reconcile_imei_filters(rebuild=False):
+    """Check each saved IMEI filter against the user's device units; optionally drop stale ones."""
+    filters = ImeiFilter.query.all()
+    drift = 0
+    for row in filters:
+        bloom = BloomFilter(row.num_bits, row.num_hashes, row.bits)
+        missing = sum(
+            1 for (imei,) in db.session.query(DeviceUnit.imei).filter_by(user_id=row.user_id).yield_per(5000)
+            if imei not in bloom
+        )
+        if not missing:
+            continue
+
+        drift += 1
+        print(f"⚠️  user {row.user_id}: IMEI filter is missing {missing} purchased IMEIs")
+        if rebuild:
+            drop_imei_filter(row.user_id)
+
+    if rebuild and drift:
+        db.session.commit()
+        print(f"✅ Dropped {drift} stale IMEI filters (rebuilt on next use)")
+    elif drift:
+        print(f"❌ {drift} IMEI filters are missing IMEIs - run with --rebuild to fix")
+    else:
+        print(f"✅ {len(filters)} IMEI filters contain every purchased IMEI")
+    return drift == 0
+
+if __name__ == "__main__":
+    rebuild = len(sys.argv) > 1 and sys.argv[1] == '--rebuild'
+
+    print("🚀 Summary Reconciliation Tool")
+    print("=" * 50)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            ensure_profit_rollup_schema()
+            ok = reconcile_stock_levels(rebuild)
+            ok = reconcile_profit_rollup(rebuild) and ok
+            ok = reconcile_shop_balances(rebuild) and ok
+            ok = reconcile_invoices(rebuild) and ok
+            ok = reconcile_calendar(rebuild) and ok
+            ok = reconcile_imei_filters(rebuild) and ok
+        sys.exit(0 if ok or rebuild else 1)
+    except Exception as e:
+        print(f"\n❌ Reconciliation failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,106 @@
+// Scan mode shared by the purchase and sale forms: buffer scans on the server
+// in micro-batches instead of one request per device.
+//
+// The page needs #scan_input, #scan_status, #scan_session_id and #imei_numbers.
+// Options:
+//   mode      - 'purchase' or 'sale', checked by the server for each session
+//   startUrl  - url_for('start_scan_session')
+//   onResults - optional callback(data) run after each batch is shown
+// Returns {pending, flush}; forms call flush() before submitting while pending().
+const SCAN_FLUSH_DELAY = 50;   // ms to wait for more scans before sending
+const SCAN_BATCH_SIZE = 20;    // send immediately once this many scans are queued
+
+function setupScanSession({mode, startUrl, onResults}) {
+    let sessionId = null;
+    let queue = [];
+    let timer = null;
+    let inFlight = null;
+
+    function start() {
+        return fetch(startUrl, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({mode: mode})
+        })
+        .then(response => response.json())
+        .then(data => {
+            sessionId = data.session_id;
+            document.getElementById('scan_session_id').value = sessionId;
+            // The buffer on the server is now the source of truth for the IMEI list
+            const textarea = document.getElementById('imei_numbers');
+            textarea.readOnly = true;
+            textarea.required = false;
+        });
+    }
+
+    function queueScan(imei) {
+        queue.push(imei);
+        clearTimeout(timer);
+        if (queue.length >= SCAN_BATCH_SIZE) {
+            flush();
+        } else {
+            timer = setTimeout(flush, SCAN_FLUSH_DELAY);
+        }
+    }
+
+    function flush() {
+        clearTimeout(timer);
+        if (!queue.length) return inFlight || Promise.resolve();
+        const batch = queue;
+        queue = [];
+        const ready = sessionId ? Promise.resolve() : start();
+        // Batches go out one at a time so results come back in scan order
+        inFlight = Promise.all([ready, inFlight]).then(() =>
+            fetch(`/scan_session/${sessionId}/scan`, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({imeis: batch})
+            })
+        )
+        .then(response => response.json())
+        .then(data => showResults(data, batch))
+        .catch(() => {
+            // Put the batch back so the next flush retries it
+            queue = batch.concat(queue);
+            document.getElementById('scan_status').textContent = 'Connection problem - scans will be retried';
+        });
+        return inFlight;
+    }
+
+    function showResults(data, batch) {
+        const status = document.getElementById('scan_status');
+        if (data.error) {
+            queue = batch.concat(queue);
+            status.textContent = data.error;
+            return;
+        }
+        const textarea = document.getElementById('imei_numbers');
+        const rejected = [];
+        data.results.forEach(result => {
+            if (result.valid) {
+                textarea.value = textarea.value ? textarea.value + '\n' + result.imei : result.imei;
+            } else {
+                rejected.push(`${result.imei}: ${result.message}`);
+            }
+        });
+        if (onResults) onResults(data);
+        status.textContent = `${data.count} devices scanned` + (rejected.length ? ` - rejected ${rejected.join(', ')}` : '');
+        status.className = rejected.length ? 'form-text text-danger' : 'form-text text-success';
+    }
+
+    document.getElementById('scan_input').addEventListener('keydown', function(e) {
+        // Barcode scanners type the code and press Enter
+        if (e.key === 'Enter') {
+            e.preventDefault();
+            const imei = this.value.trim();
+            this.value = '';
+            if (imei) queueScan(imei);
+        }
+    });
+
+    return {
+        pending: () => Boolean(queue.length || inFlight),
+        // Resolves once every queued scan reached the server
+        flush: () => flush().then(() => { inFlight = null; })
+    };
+}
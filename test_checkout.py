@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Test script for the sale and payment write paths: two checkouts selling the
+same device, and forms resubmitted with the same idempotency key.
+Each check runs in its own Python process against a throwaway SQLite database,
+so nothing is written to the database configured in .env.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from app import app, db
+from app import User, Brand, Model, Shop, Supplier, Sale, Payment, IdempotencyKey
+from werkzeug.security import generate_password_hash
+
+TEST_EMAIL = 'checkout@example.com'
+TEST_PASSWORD = 'checkout-test'
+
+def run_in_test_database(check):
+    """Run check() in a fresh process whose DATABASE_URL is a temporary SQLite file"""
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(directory, 'test.db'))
+        script = os.path.abspath(sys.modules[check.__module__].__file__)
+        result = subprocess.run([sys.executable, script, check.__name__],
+                                env=env, capture_output=True, text=True)
+    print(result.stdout)
+    if result.returncode != 0:
+        print(result.stderr)
+    return result.returncode == 0
+
+def create_test_data():
+    """Create the tables and a user, brand, model, shop and supplier; returns their ids"""
+    db.create_all()
+    user = User(name='Checkout Test', email=TEST_EMAIL, password_hash=generate_password_hash(TEST_PASSWORD))
+    brand = Brand(name='Checkout Brand')
+    db.session.add_all([user, brand])
+    db.session.flush()
+    model = Model(brand_id=brand.id, name='Checkout Model')
+    shop = Shop(name='Checkout Shop', owner_name='Test')
+    supplier = Supplier(name='Checkout Supplier')
+    db.session.add_all([model, shop, supplier])
+    db.session.commit()
+    return dict(user=user.id, brand=brand.id, model=model.id, shop=shop.id, supplier=supplier.id)
+
+def logged_in_client():
+    client = app.test_client()
+    client.post('/login', data={'email': TEST_EMAIL, 'password': TEST_PASSWORD})
+    return client
+
+def take_flashes(client):
+    """Flash messages queued for the client, clearing them"""
+    with client.session_transaction() as flask_session:
+        return flask_session.pop('_flashes', [])
+
+def purchase_devices(client, ids, imeis):
+    return client.post('/add_purchase', data={
+        'model_id': ids['model'], 'inventory_type': 'new', 'quantity': len(imeis), 'purchase_price': 100,
+        'imei_numbers': '\n'.join(imeis), 'supplier_id': ids['supplier'], 'bill_number': '', 'paid_amount': 0
+    })
+
+def sale_form(ids, imei, **fields):
+    form = {
+        'model_id': ids['model'], 'imei_number': imei, 'sale_price': 150, 'purchase_price': 100,
+        'inventory_type': 'new', 'customer_type': 'individual', 'customer_name': 'Walk-in', 'paid_amount': 150
+    }
+    form.update(fields)
+    return form
+
+def check_concurrent_sales_of_one_imei():
+    """Two checkouts selling the same IMEI at once: one sale, one retry message"""
+    imei = '351234567890123'
+    with app.app_context():
+        ids = create_test_data()
+    purchase_devices(logged_in_client(), ids, [imei])
+
+    clients = [logged_in_client() for _ in range(2)]
+    barrier = threading.Barrier(len(clients))
+    flashes = []
+
+    def sell(client):
+        barrier.wait()
+        client.post('/add_sale', data=sale_form(ids, imei))
+        flashes.extend(take_flashes(client))
+
+    threads = [threading.Thread(target=sell, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        sales = Sale.query.filter_by(imei_number=imei).count()
+    errors = [text for category, text in flashes if category == 'error']
+    print(f"✓ Sale rows for the IMEI: {sales}")
+    print(f"✓ Messages: {flashes}")
+    assert sales == 1
+    assert [category for category, _ in flashes].count('success') == 1
+    assert len(errors) == 1 and 'retry the sale' in errors[0]
+    print("✓ Second checkout was refused with a retry message")
+
+def check_resubmitted_sale_is_replayed():
+    """The same sale form posted twice writes one sale and replays the first redirect"""
+    imei = '351234567890124'
+    with app.app_context():
+        ids = create_test_data()
+    client = logged_in_client()
+    purchase_devices(client, ids, [imei])
+    take_flashes(client)
+
+    form = sale_form(ids, imei, idempotency_key='sale-key-1')
+    first = client.post('/add_sale', data=form)
+    first_flashes = take_flashes(client)
+    second = client.post('/add_sale', data=form)
+    second_flashes = take_flashes(client)
+
+    with app.app_context():
+        sales = Sale.query.filter_by(imei_number=imei).count()
+    print(f"✓ Sale rows after two submits: {sales}")
+    assert sales == 1
+    assert first.status_code == second.status_code == 302
+    assert second.headers['Location'] == first.headers['Location']
+    assert second_flashes == first_flashes and first_flashes[0][0] == 'success'
+    print("✓ Second submit replayed the first result")
+
+def check_resubmitted_shop_payment_is_replayed():
+    """The same shop payment posted twice writes one payment; other values under that key are refused"""
+    imei = '351234567890125'
+    with app.app_context():
+        ids = create_test_data()
+    client = logged_in_client()
+    purchase_devices(client, ids, [imei])
+    client.post('/add_sale', data=sale_form(ids, imei, customer_type='shop', shop_id=ids['shop'], paid_amount=0))
+    take_flashes(client)
+
+    form = {'shop_id': ids['shop'], 'amount': 50, 'payment_method': 'cash', 'idempotency_key': 'payment-key-1'}
+    first = client.post('/add_shop_payment', data=form)
+    first_flashes = take_flashes(client)
+    second = client.post('/add_shop_payment', data=form)
+    second_flashes = take_flashes(client)
+    client.post('/add_shop_payment', data=dict(form, amount=60))
+    changed_flashes = take_flashes(client)
+
+    with app.app_context():
+        payments = [payment.amount for payment in Payment.query.filter_by(shop_id=ids['shop'])]
+    print(f"✓ Payments after three submits: {payments}")
+    assert payments == [50]
+    assert second.headers['Location'] == first.headers['Location']
+    assert second_flashes == first_flashes and first_flashes[0][0] == 'success'
+    assert changed_flashes[0][0] == 'error' and 'other values' in changed_flashes[0][1]
+    print("✓ Resubmit replayed, and the same key with another amount was refused")
+
+def check_rolled_back_sale_releases_key():
+    """A sale that fails and rolls back leaves its key free for the retry"""
+    imei = '351234567890126'
+    with app.app_context():
+        ids = create_test_data()
+    client = logged_in_client()
+
+    form = sale_form(ids, imei, idempotency_key='sale-key-2')
+    client.post('/add_sale', data=form)
+    failed_flashes = take_flashes(client)
+    with app.app_context():
+        stored_keys = IdempotencyKey.query.filter_by(key='sale-key-2').count()
+    assert failed_flashes[0][0] == 'error' and 'No longer in stock' in failed_flashes[0][1]
+    assert stored_keys == 0
+    print("✓ Failed sale left no stored key")
+
+    purchase_devices(client, ids, [imei])
+    take_flashes(client)
+    client.post('/add_sale', data=form)
+    retry_flashes = take_flashes(client)
+    with app.app_context():
+        sales = Sale.query.filter_by(imei_number=imei).count()
+    assert sales == 1 and retry_flashes[0][0] == 'success'
+    print("✓ Retry with the same key went through")
+
+def test_concurrent_sales_of_one_imei():
+    """Test that one IMEI sold at two checkouts at once gives one sale"""
+    print("🧪 Testing concurrent sales of one IMEI...")
+    assert run_in_test_database(check_concurrent_sales_of_one_imei)
+    return True
+
+def test_resubmitted_sale_is_replayed():
+    """Test that a resubmitted sale form is not written twice"""
+    print("🧪 Testing resubmitted sale...")
+    assert run_in_test_database(check_resubmitted_sale_is_replayed)
+    return True
+
+def test_resubmitted_shop_payment_is_replayed():
+    """Test that a resubmitted shop payment is not written twice"""
+    print("🧪 Testing resubmitted shop payment...")
+    assert run_in_test_database(check_resubmitted_shop_payment_is_replayed)
+    return True
+
+def test_rolled_back_sale_releases_key():
+    """Test that a failed sale can be retried with the same form"""
+    print("🧪 Testing retry after a failed sale...")
+    assert run_in_test_database(check_rolled_back_sale_releases_key)
+    return True
+
+def main():
+    """Run all tests"""
+    tests = [
+        test_concurrent_sales_of_one_imei,
+        test_resubmitted_sale_is_replayed,
+        test_resubmitted_shop_payment_is_replayed,
+        test_rolled_back_sale_releases_key
+    ]
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+        except AssertionError:
+            print(f"❌ {test.__name__} failed")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Inside run_in_test_database: run one check against the temporary database
+        globals()[sys.argv[1]]()
+    else:
+        main()
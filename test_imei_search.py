@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Test script for IMEI search suggestions: only near matches are suggested.
+Runs against a throwaway SQLite database like test_checkout.py.
+"""
+
+import sys
+from app import app
+from test_checkout import run_in_test_database, create_test_data, logged_in_client, take_flashes, purchase_devices
+
+def check_unrelated_imeis_are_not_suggested():
+    """Autocomplete and a search miss only suggest IMEIs close to what was typed"""
+    with app.app_context():
+        ids = create_test_data()
+    client = logged_in_client()
+    purchase_devices(client, ids, ['111111111', '222222222', '333333333'])
+    take_flashes(client)
+
+    suggestions = [item['imei'] for item in client.get('/imei_suggestions?q=1111').get_json()]
+    print(f"✓ Suggestions for 1111: {suggestions}")
+    assert suggestions == ['111111111']
+
+    client.post('/search_device_result', data={'imei': '111111112'})
+    miss_flashes = take_flashes(client)
+    print(f"✓ Search miss: {miss_flashes}")
+    assert miss_flashes[0][1].endswith('Similar IMEIs in your inventory: 111111111')
+
+    client.post('/search_device_result', data={'imei': '987654321'})
+    unrelated_flashes = take_flashes(client)
+    assert unrelated_flashes[0][1] == 'IMEI 987654321 not found in your inventory!'
+    print("✓ Unrelated IMEIs were not suggested")
+
+def test_unrelated_imeis_are_not_suggested():
+    """Test that IMEI suggestions leave out unrelated IMEIs"""
+    print("🧪 Testing IMEI suggestions...")
+    assert run_in_test_database(check_unrelated_imeis_are_not_suggested)
+    return True
+
+def main():
+    """Run all tests"""
+    tests = [
+        test_unrelated_imeis_are_not_suggested
+    ]
+    passed = 0
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+        except AssertionError:
+            print(f"❌ {test.__name__} failed")
+
+    print(f"\n📊 Test Results: {passed}/{len(tests)} tests passed")
+    return passed == len(tests)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Inside run_in_test_database: run one check against the temporary database
+        globals()[sys.argv[1]]()
+    else:
+        main()